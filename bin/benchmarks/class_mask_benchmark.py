@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmark of the class masks (src/class_masks.py) against np.isin, on 512x512 training tiles
+and full 3660x3660 HLS tiles. The Fmask rows show why QA bits are decoded with a bitwise AND rather
+than a lookup table.
+
+@Time    : 17/10/2026
+@Author  : Colm Keyes
+@Email   : keyesco@tcd.ie
+@File    : class_mask_benchmark.py
+"""
+
+import timeit
+
+import numpy as np
+
+from src.class_masks import bit_mask, class_mask, lut_mask
+from src.hls_stacks_prep import fmask_bitmask
+
+repeats = 5
+rng = np.random.default_rng(0)
+
+for size in (512, 3660):
+    # AGB band as written by the pipeline (int16 classes 0-11, -9999 nodata)
+    agb = rng.integers(0, 12, (size, size)).astype(np.int16)
+    agb[:size // 10] = -9999
+    # Fmask QA bits (uint8, 255 fill)
+    fmask = rng.integers(0, 256, (size, size)).astype(np.uint8)
+    # RADD alert confidence band (0 none, 2 low, 3 high)
+    radd = rng.choice(np.array([0, 2, 3], dtype=np.uint16), (size, size), p=[0.9, 0.05, 0.05])
+
+    valid_classes = [2, 3, 4, 5]
+    scattered_classes = [1, 3, 4, 8]  # not a contiguous run, goes through the lookup table
+    bitmask = fmask_bitmask(('cloud', 'shadow'))
+    fmask_lut = (np.arange(256) & bitmask) != 0
+
+    assert np.array_equal(np.isin(agb, valid_classes), class_mask(agb, valid_classes))
+    assert np.array_equal(np.isin(agb, scattered_classes), class_mask(agb, scattered_classes))
+    assert np.array_equal(np.isin(radd, [3]), class_mask(radd, [3]))
+    assert np.array_equal(bit_mask(fmask, bitmask), lut_mask(fmask_lut, fmask))
+
+    cases = [
+        ('AGB 2-5', lambda: np.isin(agb, valid_classes), lambda: class_mask(agb, valid_classes)),
+        ('AGB 1,3,4,8', lambda: np.isin(agb, scattered_classes), lambda: class_mask(agb, scattered_classes)),
+        ('RADD conf. 3', lambda: np.isin(radd, [3]), lambda: class_mask(radd, [3])),
+        ('Fmask bit lut', lambda: bit_mask(fmask, bitmask), lambda: lut_mask(fmask_lut, fmask)),
+    ]
+    print(f"{size}x{size}")
+    for name, baseline, lookup in cases:
+        baseline_time = min(timeit.repeat(baseline, number=1, repeat=repeats))
+        lookup_time = min(timeit.repeat(lookup, number=1, repeat=repeats))
+        print(f"  {name:16s} np.isin/AND {baseline_time * 1e3:8.2f} ms   class_masks {lookup_time * 1e3:8.2f} ms   "
+              f"speedup {baseline_time / lookup_time:5.1f}x")
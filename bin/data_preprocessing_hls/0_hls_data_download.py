@@ -14,6 +14,7 @@ from tqdm import tqdm
 import requests
 import urllib3
 from pathlib import Path
+from src.granule_catalog import GranuleCatalog
 
 # Suppress insecure request warnings
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
@@ -33,6 +34,9 @@ logger = logging.getLogger(__name__)
 output_dir = '/media/colm-the-conjurer/writable/data/hls'
 os.makedirs(output_dir, exist_ok=True)
 
+# Granule catalog of what is already on disk, used to skip existing granules without globbing
+catalog = GranuleCatalog(output_dir)
+
 # EarthData credentials
 # You will be prompted for these if not stored in your .netrc file
 # Or you can set them here:
@@ -221,14 +225,12 @@ def process_tile_hls(tile, collection_type, start_date, end_date, cloud_cover=10
         # Download the granules
     # Download the granules
         # Download the granules
-        import glob
-
         # Build list of granules that actually need downloading
+        catalog.update([tile_dir])
         granules_to_download = []
         for granule in results:
             title = getattr(granule, 'native-id', getattr(granule, 'uuid', str(granule)))
-            pattern = os.path.join(tile_dir, f"{title}*.tif")
-            if glob.glob(pattern):
+            if catalog.has_granule(title):
                 logger.info(f"Granule {title} already on disk. Skipping.")
             else:
                 granules_to_download.append((granule, title))
@@ -244,6 +246,7 @@ def process_tile_hls(tile, collection_type, start_date, end_date, cloud_cover=10
                     local_path=tile_dir
                 )
                 logger.info(f"Download finished. Files: {downloaded_files}")
+                catalog.update([tile_dir])
                 # Optionally log each title
                 with open(tile_log, 'a') as log:
                     for _, title in granules_to_download:
@@ -25,7 +25,8 @@ import numpy as np
 pd.set_option('display.max_rows', 500)
 pd.set_option('display.max_columns', 500)
 pd.set_option('display.width', 1000)
-from src.hls_stacks_prep import prep as HLSstacks
+from src.hls_stacks_prep import prep as HLSstacks, STACK_SUFFIXES
+from src.granule_catalog import GranuleCatalog
 # from utils import [additional relevant utility functions or classes if any]
 if __name__ == '__main__':
     """Main execution block for HLS data preprocessing"""
@@ -57,7 +58,6 @@ if __name__ == '__main__':
     cropped_radd_alert_path = os.path.join(radd_alert_path, '3.cropped_radd_alerts')
     merged_radd_alerts = os.path.join(radd_alert_path, 'merged_radd_alerts_qgis_int16_compressed.tif')
     combined_radd_sen2_stack_path = os.path.join(base_path, '6.stacks_radd')
-    fmaskwarped_folder = os.path.join(base_path, '8.1.fmaskwarped')
     #fmask_applied_folder = os.path.join(base_path, 'stacks_radd_fmask_corrected')
     fmask_stack_folder = os.path.join(base_path, '8.2.stacks_radd_forest_fmask')
     hansen_folder = os.path.join(base_path, 'hansen_treecover')
@@ -65,6 +65,15 @@ if __name__ == '__main__':
     # sen2_agb_radd_stack_path = os.path.join(base_path, 'stacks_agb_radd')
     agb_class_file = os.path.join(land_cover_path, 'Kalimantan_land_cover.tif')
     forest_stacks_folder = os.path.join(base_path, '7.stacks_radd_forest')
+    # Granule catalog over the HLS download folders, shared by every step below instead of
+    # re-walking tile_*/S30|L30. Only folders changed since the last run are re-listed.
+    catalog = GranuleCatalog(base_path_2)
+    catalog.update()
+
+    # Tile-dates whose Fmask cloud/shadow fraction is above this are skipped before any stacking,
+    # the Fmask step would blank them out anyway. None processes everything.
+    max_cloud_fraction = 0.9
+
     # Initialize HLSstacks objects for both sensors
     hls_processors = []
     for sensor in sensors:
@@ -74,7 +83,8 @@ if __name__ == '__main__':
             sensor['bands'], 
             radd_alert_path, 
             land_cover_path,
-            sensor_type=sensor['type']
+            sensor_type=sensor['type'],
+            catalog=catalog
         )
         hls_processors.append(hls_data)
 
@@ -84,7 +94,6 @@ if __name__ == '__main__':
         radd_alert_path,
         cropped_land_cover_path,
         cropped_radd_alert_path,
-        fmaskwarped_folder,
         fmask_stack_folder,
         hansen_folder,
         forest_stacks_folder
@@ -99,24 +108,44 @@ if __name__ == '__main__':
     ## Step 1 (optional): Resample Radd Alerts to match sensor resolution (30m)
     #################
     # resample radd alerts to 30m (only need to do once)
-    #hls_processors[0].resample_radd_alerts(merged_radd_alerts)
+    #hls_processors[0].resample_radd_alerts(merged_radd_alerts, chunk_size=2048, workers=8)
+    # or one output per UTM zone (49N/49S/50N/50S), so every stack gets a same-CRS crop
+    #hls_processors[0].resample_radd_alerts(merged_radd_alerts, workers=8, utm_zones=True)
 
 
 
 
+    #################
+    ## Fused alternative to Steps 2-8: stack, label with RADD, mask forest loss and Fmask in one pass,
+    ## writing only the final stacks to fmask_stack_folder (no 2.stacks ... 7.stacks_radd_forest intermediates)
+    #################
+    # for processor in hls_processors:
+    #     processor.write_fused_stacks(os.path.join(radd_alert_path, 'radd_alerts_borneo_v2025-03-30.tif'),
+    #                                  hansen_folder, fmask_stack_folder, block_budget_mb=64,
+    #                                  loss_year_cache_dir=os.path.join(hansen_folder, "lossyear_cache"),
+    #                                  max_cloud_fraction=max_cloud_fraction)
+
+
     #################
     ## Step 2: Write HLS images to Stack (both L30 and S30)
     #################
     # for processor in hls_processors:
-    # #     # Process and stack imagery for each sensor
-    #     processor.write_hls_rasterio_stack()
+    # #     # Process and stack imagery for each sensor, tile-dates spread over a process pool
+    #     processor.write_hls_rasterio_stack(workers=8, max_open_datasets=32, block_budget_mb=64,
+    #                                        max_cloud_fraction=max_cloud_fraction)
+    #     # or reference the band files from lightweight VRT stacks instead of copying them
+    #     # processor.write_hls_rasterio_stack(output_format='VRT')
+    # or stack S30 and L30 together in one band order (B02, B03, B04, B8A, B11, B12), keeping only the
+    # less cloudy sensor when both observed a tile on the same day
+    # hls_processors[0].write_harmonized_stacks(workers=8, max_open_datasets=32, block_budget_mb=64,
+    #                                           max_cloud_fraction=max_cloud_fraction)
 
 
     ##########
     # Step 3: Crop radd alerts to HLS stacks (both L30 and S30)
     #########
     # for hls_file in os.listdir(stack_path_list):
-    #     if hls_file.endswith('_stack.tif'):
+    #     if hls_file.endswith(STACK_SUFFIXES):
     #         hls_file_path = os.path.join(stack_path_list, hls_file)
     #
     #         # Determine which processor to use based on sensor type in filename
@@ -126,7 +155,8 @@ if __name__ == '__main__':
     #         processor.crop_single_stack(
     #             hls_file_path,
     #             os.path.join(radd_alert_path, 'radd_alerts_borneo_v2025-03-30.tif'),  #'resampled_merged_radd_alerts_qgis_int16_compressed_30m.tif'),
-    #             cropped_radd_alert_path
+    #             cropped_radd_alert_path,
+    #             radd_confidence=None  # (3,) keeps only highly certain alerts
     #         )
     #
     #
@@ -158,7 +188,7 @@ if __name__ == '__main__':
     # os.makedirs(stacks_radd_path, exist_ok=True)
     #
     # for hls_file in os.listdir(stack_path_list):
-    #     if hls_file.endswith('_stack.tif') and not hls_file.endswith("reordered.tif"):
+    #     if hls_file.endswith(STACK_SUFFIXES) and not hls_file.endswith("reordered.tif"):
     #         hls_file_path = os.path.join(stack_path_list, hls_file)
     #         tile, date = hls_file.split('_')[0].split(".")
     #
@@ -194,7 +224,8 @@ if __name__ == '__main__':
     ## Step 7: Mask Sen2_agb_radd stacks by Hansen Forest Loss. Remove disturbances detected prior to RADD start date (2021)
     ##########
 
-    # hls_data.forest_loss_mask(combined_radd_sen2_stack_path,hansen_folder,forest_stacks_folder)
+    # hls_data.forest_loss_mask(combined_radd_sen2_stack_path,hansen_folder,forest_stacks_folder,
+    #                           cache_dir=os.path.join(hansen_folder, "lossyear_cache"))
 
 
     ##########
@@ -203,50 +234,48 @@ if __name__ == '__main__':
 
     # Process each Sentinel-2 stack file with the corresponding FMask file
     for processor in hls_processors:
-        # Find all tile directories for this sensor
-        sensor_tiles_path = os.path.join(base_path_2)
-        for tile_dir in os.listdir(sensor_tiles_path):
-            # Ignore non-tile directories (e.g., ignore the "stacks" folder)
-            if not os.path.isdir(os.path.join(sensor_tiles_path, tile_dir)) or tile_dir == "stacks":
-                continue
+        # Cloud fractions from the prescreen index (only new or changed Fmasks are read)
+        cloud_fractions = processor.prescreen_cloud_fraction() if max_cloud_fraction is not None else {}
+
+        # Look up this sensor's Fmask files in the granule catalog
+        for granule in catalog.query(sensor=processor.sensor_type, band='Fmask'):
+            tile = granule['tile']
+            date = granule['date']
 
-            # Build sensor path within each tile directory (e.g. .../tile_x21_y28/S30)
-            sensor_path = os.path.join(sensor_tiles_path, tile_dir, processor.sensor_type)
-            if not os.path.exists(sensor_path):
+            if max_cloud_fraction is not None and cloud_fractions.get(f"{tile}.{date}", 0.0) > max_cloud_fraction:
+                print(f"Skipping {tile}.{date} - cloud fraction above {max_cloud_fraction}")
                 continue
 
-            for fmask_file in os.listdir(sensor_path):
-                if fmask_file.endswith('.Fmask.tif'):
-                    parts = fmask_file.split('.')
-                    tile = parts[2]
-                    date = parts[3][:7]
-
-                    # For L30, use the naming convention: <date>_<tile>_L30_forest_masked_stack.tif.
-                    # For S30, use the existing naming convention: <tile>.<date>_S30_forest_stack.tif.
-                    sentinel_file = f"{date}_{tile}_forest_masked_stack.tif"
-
-
-                    sentinel_stack_path = os.path.join(forest_stacks_folder, sentinel_file)
-
-                    fmask_path = os.path.join(sensor_path, fmask_file)
-                    fmaskwarped_file = os.path.join(fmaskwarped_folder, f"{tile}_{date}_fmaskwarped.tif")
-                    # fmask_stack_file keeps the same naming as earlier based on the "standard" convention.
-                    fmask_stack_file = os.path.join(fmask_stack_folder,
-                                                    sentinel_file.replace("_stack.tif", "_fmask_stack.tif"))
-
-                    # Check that both required files exist before processing
-                    if os.path.exists(sentinel_stack_path) and os.path.exists(fmask_path) and not os.path.exists(fmask_stack_file):
-                        if not os.path.exists(fmaskwarped_file):
-                            processor.warp_rasters([fmask_path, sentinel_stack_path], fmaskwarped_file)
-                        processor.apply_fmask(sentinel_stack_path, fmaskwarped_file, fmask_stack_file)
-                    else:
-                        # print(f"Missing required files for tile {tile} on date {date}:")
-                        if not os.path.exists(sentinel_stack_path):
-                            print(f"  Sentinel stack missing: {sentinel_stack_path}")
-                        if not os.path.exists(fmask_path):
-                            print(f"  Fmask file missing: {fmask_path}")
-                        if os.path.exists(fmask_stack_file):
-                            print(f" Fmask processed stack already exists: {fmask_stack_file}, skipping...")
+            # For L30, use the naming convention: <date>_<tile>_L30_forest_masked_stack.tif.
+            # For S30, use the existing naming convention: <tile>.<date>_S30_forest_stack.tif.
+            sentinel_file = f"{date}_{tile}_forest_masked_stack.tif"
+
+
+            sentinel_stack_path = os.path.join(forest_stacks_folder, sentinel_file)
+
+            fmask_path = granule['path']
+            # fmask_stack_file keeps the same naming as earlier based on the "standard" convention.
+            fmask_stack_file = os.path.join(fmask_stack_folder,
+                                            sentinel_file.replace("_stack.tif", "_fmask_stack.tif"))
+
+            # Check that both required files exist before processing
+            if os.path.exists(sentinel_stack_path) and os.path.exists(fmask_path) and not os.path.exists(fmask_stack_file):
+                # The raw Fmask is resampled onto the stack grid inside apply_fmask
+                processor.apply_fmask(sentinel_stack_path, fmask_path, fmask_stack_file)
+            else:
+                # print(f"Missing required files for tile {tile} on date {date}:")
+                if not os.path.exists(sentinel_stack_path):
+                    print(f"  Sentinel stack missing: {sentinel_stack_path}")
+                if not os.path.exists(fmask_path):
+                    print(f"  Fmask file missing: {fmask_path}")
+                if os.path.exists(fmask_stack_file):
+                    print(f" Fmask processed stack already exists: {fmask_stack_file}, skipping...")
+
+
+    ##########
+    ## Step 9 (optional): Append the final stacks to per-MGRS-tile Zarr cubes (time, band, y, x)
+    ##########
+    # hls_processors[0].export_cube(fmask_stack_folder, os.path.join(base_path, '9.cubes'))
 
 
     # for processor in hls_processors:
@@ -65,14 +65,24 @@ if __name__ == '__main__':
         if file.endswith('_forest_masked_fmask_stack.tif'):
             # if any(site in file for site in test_sites):
             image_path = os.path.join(source_dir, file)
-            data_manager.crop_to_tiles(image_path,output_dir)
+            # padded edge tiles keep the MGRS tile borders; all-nodata tiles are never written
+            data_manager.crop_to_tiles(image_path, output_dir, overlap=0, pad_edges=True, skip_empty=True, workers=8)
             print(f"cropping finished: {file}")
 
+    # Alternatively pack the tiles into tar shards (binary label + image per tile, index.json with alert counts),
+    # replacing steps 10, 12 and 13; stream them with dataset_management.ShardDataset(min_alert_pixels=7500)
+    # in place of step 11. AGB filtering, normalization and the step 14 split still have to happen at load time.
+    # stacks = [os.path.join(source_dir, f) for f in sorted(os.listdir(source_dir)) if f.endswith('_forest_masked_fmask_stack.tif')]
+    # data_manager.crop_to_shards(stacks, os.path.join(output_dir, 'shards'))
+
     #############
     ## Step 11: Re-Filter tiled images based on minimal labels requirements. typical limits: 1000-5000.
     #############
 
-    alert_stacks = model_funcs.filter_stacks(output_dir,".tif",1,7500)#output_dir, 1,0)#1000)
+    # counts are cached in <output_dir>/alert_index.sqlite, so a threshold sweep only reads the tiles once:
+    # for threshold in [100, 7500, 10000, 15000]:
+    #     model_funcs.filter_stacks(output_dir, ".tif", 1, threshold, delete=False, workers=8)
+    alert_stacks = model_funcs.filter_stacks(output_dir,".tif",1,7500, workers=8)#output_dir, 1,0)#1000)
     distribution = model_funcs.calculate_alert_distribution(alert_stacks,20)
     print(distribution)
 
@@ -88,7 +98,7 @@ if __name__ == '__main__':
     ## step 13, alter labels
     #############
     #
-    # model_funcs.alter_radd_data_to_label(output_dir)
+    # model_funcs.alter_radd_data_to_label(output_dir, in_place=True, workers=8)
 
     #############
     ## step 14, split tiles into train_val_test
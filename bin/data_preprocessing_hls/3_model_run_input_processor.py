@@ -34,6 +34,10 @@ val_globnorm_15000 = r"E:\Data\Sentinel2_data\30pc_cc\Tiles_512_30pc_cc\globalno
 train_nofilter = r"E:\Data\Sentinel2_data\30pc_cc\Tiles_512_30pc_cc\no_filter\train"
 val_nofilter = r"E:\Data\Sentinel2_data\30pc_cc\Tiles_512_30pc_cc\no_filter\val"
 tile_size = 512
+# True: write <dir>/band_scaling.json and normalize at read time (ApplyBandScaling in the model config),
+# tiles keep their native dtype. False: rewrite the tiles as float32 *_normalized.tif copies.
+# Must agree with band_scaling_file in bin/run_commands/run_config.py (None when False).
+on_the_fly_normalization = True
 
 if __name__ == '__main__':
     model_funcs = Loader(output_folder,  train_dir, val_dir, output_folder,tile_size)
@@ -58,18 +62,27 @@ if __name__ == '__main__':
 
         valid_classes = [2, 3, 4, 5]  # Intact Montane Forest, Secondary and Degraded Forest, Peat Swamp Forest, Mangrove Forest
         nodata_value = -9999
-        model_funcs.filter_stacks_and_radd_by_AGB(input_file, output_file) #,valid_classes, nodata_value)#val_narrow_dir_test)
+        model_funcs.filter_stacks_and_radd_by_AGB(input_file, output_file, workers=8) #,valid_classes, nodata_value)#val_narrow_dir_test)
 
         #######
         ## Step 15: Global Normalisation
         #######
         #
 
-        global_min, global_max = model_funcs.compute_global_min_max(input_file)
-        model_funcs.normalize_images_global(input_file,output_file, global_min, global_max)
-        new_global_means, new_global_stds = model_funcs.compute_global_mean_std(input_file)
-        print(f"min: {global_min}, new means: {new_global_means}")
-        print(f"max: {global_max}, new stds: {new_global_stds}")
+        if on_the_fly_normalization:
+            scaling = model_funcs.write_band_scaling(input_file, os.path.join(output_file, 'band_scaling.json'),
+                                                     clip_percentiles=(0.5, 99.5), workers=8)
+            print(scaling)
+        else:
+            # one stats pass (cached in sidecars) + one block-wise write; clips at the 0.5/99.5 percentiles,
+            # pass clip_percentiles=None for the previous raw min/max scaling
+            global_min, global_max, new_global_means, new_global_stds = model_funcs.normalize_images_fused(
+                input_file, output_file, clip_percentiles=(0.5, 99.5), workers=8)
+            print(f"min: {global_min}, new means: {new_global_means}")
+            print(f"max: {global_max}, new stds: {new_global_stds}")
+        # global_min, global_max = model_funcs.compute_global_min_max(input_file)
+        # model_funcs.normalize_images_global(input_file,output_file, global_min, global_max)
+        # new_global_means, new_global_stds = model_funcs.compute_global_mean_std(input_file)
 
 
 
@@ -80,7 +93,7 @@ if __name__ == '__main__':
         ###
         suffix = "_radd_labelled_agb.tif" #"radd_modified_radd_agb.tif"
 
-        alert_stacks = model_funcs.filter_stacks(input_file,suffix, 1,100)
+        alert_stacks = model_funcs.filter_stacks(input_file,suffix, 1,100, workers=8)
         distribution = model_funcs.calculate_alert_distribution(alert_stacks,20)
         print(distribution)
 
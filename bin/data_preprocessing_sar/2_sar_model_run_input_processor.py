@@ -14,6 +14,10 @@ sar_model_processing = SARLoader(sen2_stack_dir, output_dir,data_type)
 # Step 1: Calculate Global Statistics for SAR Bands
 global_min, global_max = sar_model_processing.compute_global_min_max(output_dir, bands=[6, 7])
 
+# Alternatively store the scaling next to the HLS bands' and normalize at read time (ApplyBandScaling),
+# skipping the *_masked_normalized.tif copies of Step 2 and the renames that follow
+# sar_model_processing.write_band_scaling(output_dir, os.path.join(output_dir, 'band_scaling.json'), bands=[6, 7])
+
 # Step 2: Normalize SAR bands in each stack using global statistics
 for file in os.listdir(output_dir):
     if file.endswith(f'_sentinel_agb_normalized_sar.tif') and data_type in file and "T49MDU" in file:
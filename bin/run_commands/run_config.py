@@ -41,6 +41,22 @@ cfg.img_norm_cfg = dict(
 # Update bands
 cfg.bands = [0, 1, 2,3,4,5]
 
+# Normalize at read time from the band scaling file that 3_model_run_input_processor.py writes for the
+# training tiles (on_the_fly_normalization = True), with the tiles kept in their native dtype as
+# *_sentinel_agb.tif. The inputs are then 0-1, so img_norm_cfg and the pipelines' normalize steps
+# switch to the scaled bands' stats stored in the same file. Pass the same file to
+# model_inference.py -band_scaling. Set to None for pre-normalized *_sentinel_agb_normalized.tif tiles
+# (on_the_fly_normalization = False).
+band_scaling_file = os.path.join(cfg.data_root, "no_filter", "train", "band_scaling.json")
+if band_scaling_file:
+    from src.custom_pipelines import add_band_scaling
+    cfg.custom_imports = dict(imports=["src.custom_pipelines"], allow_failed_imports=False)
+    for pipeline in [cfg.train_pipeline, cfg.test_pipeline, cfg.data.train.pipeline,
+                     cfg.data.val.pipeline, cfg.data.test.pipeline]:
+        cfg.img_norm_cfg = add_band_scaling(pipeline, band_scaling_file, cfg.bands)
+    for split in [cfg.data.train, cfg.data.val, cfg.data.test]:
+        split.img_suffix = "_sentinel_agb.tif"
+
 # Update classes
 cfg.CLASSES = ("Forest", "Disturbed_Forest")
 
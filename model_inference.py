@@ -35,6 +35,7 @@ def parse_args():
     parser.add_argument('-output', help='path to save output image')
     parser.add_argument('-input_type', help='file type of input images',default="tif")
     parser.add_argument('-bands', help='bands in the file where to find the relevant data',default=None)
+    parser.add_argument('-band_scaling', help='band scaling JSON the model was trained with (run_config band_scaling_file)',default=None)
     
     args = parser.parse_args()
     
@@ -156,7 +157,7 @@ def inference_on_file(model, target_image, output_image, custom_test_pipeline):
         
     return time_taken
 
-def process_test_pipeline(custom_test_pipeline, bands=None):
+def process_test_pipeline(custom_test_pipeline, bands=None, band_scaling_file=None):
     
     # change extracted bands if necessary
     if bands is not None:
@@ -167,6 +168,13 @@ def process_test_pipeline(custom_test_pipeline, bands=None):
             
             custom_test_pipeline[extract_index[0]]['bands'] = eval(bands)
             
+    # normalize at read time exactly like training, for models trained on native-dtype tiles
+    if band_scaling_file is not None:
+        from src.custom_pipelines import add_band_scaling
+        extract = [x for x in custom_test_pipeline if x['type'] == 'BandsExtract']
+        model_bands = extract[0]['bands'] if extract else [0, 1, 2, 3, 4, 5]
+        add_band_scaling(custom_test_pipeline, band_scaling_file, model_bands)
+
     collect_index = [i for i, x in enumerate(custom_test_pipeline) if x['type'].find('Collect') > -1]
     
     # adapt collected keys if necessary
@@ -177,7 +185,7 @@ def process_test_pipeline(custom_test_pipeline, bands=None):
     
     return custom_test_pipeline
 
-def inference_on_files(config_path, ckpt, input_type, input_path, output_path, bands):
+def inference_on_files(config_path, ckpt, input_type, input_path, output_path, bands, band_scaling_file=None):
     # load model
     config = Config.fromfile(config_path)
     config.model.backbone.pretrained = None
@@ -199,7 +207,7 @@ def inference_on_files(config_path, ckpt, input_type, input_path, output_path, b
         os.makedirs(output_path)
 
     # modify test pipeline if necessary
-    custom_test_pipeline = process_test_pipeline(model.cfg.data.test.pipeline, bands)
+    custom_test_pipeline = process_test_pipeline(model.cfg.data.test.pipeline, bands, band_scaling_file)
 
     # for each image predict and save to disk
     for i, target_image in enumerate(target_images):
@@ -224,8 +232,9 @@ def main():
     input_path = args.input
     output_path = args.output
     bands = args.bands
+    band_scaling_file = args.band_scaling
     
-    inference_on_files(config_path, ckpt, input_type, input_path, output_path, bands)
+    inference_on_files(config_path, ckpt, input_type, input_path, output_path, bands, band_scaling_file)
     
 if __name__ == "__main__":
 
@@ -1,9 +1,16 @@
 # Package initialization
 __version__ = "0.1.0"
 __all__ = [
+    'alert_index',
+    'band_statistics',
+    'class_masks',
+    'datacube',
     'dataset_management',
+    'granule_catalog',
     'hls_stacks_prep', 
     'model_analysis',
     'model_input_processor',
+    'output_profiles',
+    'tile_shards',
     'utility_functions'
 ]
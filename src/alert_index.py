@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent index of per-tile RADD alert statistics, so Loader.filter_stacks threshold sweeps are
+queries instead of a full re-read of every label tile.
+
+Each label tile is read once, block by block, in a process pool: alert pixel count, nodata fraction
+and the AGB class histogram of its sentinel tile are stored in SQLite next to the tiles, keyed by
+the size and mtime of both the label and the sentinel tile, so only tiles where either file is new
+or rewritten are re-read.
+
+@Time    : 17/10/2026
+@Author  : Colm Keyes
+@Email   : keyesco@tcd.ie
+@File    : alert_index.py
+"""
+
+import json
+import os
+import sqlite3
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import rasterio
+
+from src.band_statistics import sidecar_path
+
+# AGB land classification values, 0 (none) to 11 (Inland Water), see Loader.filter_stacks_and_radd_by_AGB
+AGB_CLASSES = 12
+
+# Sentinel tiles that can carry the AGB band (7) of a label tile, in order of preference
+SENTINEL_SUFFIXES = ('_sentinel_agb.tif', '_sentinel.tif', '_sentinel_agb_normalized.tif')
+
+# Files of one tile removed together with a label tile that fails the filter. Besides the files the
+# original filter_stacks removed, this includes the native-dtype _sentinel_agb.tif tile, which is the
+# model input when normalizing at read time (ApplyBandScaling) and must not outlive its label.
+COMPANION_SUFFIXES = ('_radd_.tif', '_radd.tif', '_sentinel.tif', '_sentinel_agb.tif', '_sentinel_agb_normalized.tif')
+
+
+def _index_tile(label_path, sentinel_path, nodata_value):
+    """Alert and nodata pixel counts of a label tile and the AGB histogram of its sentinel tile."""
+    alert_count = nodata_count = pixel_count = 0
+    with rasterio.open(label_path) as src:
+        nodata = src.nodata if src.nodata is not None else nodata_value
+        for _, window in src.block_windows(1):
+            labels = src.read(1, window=window)
+            alert_count += int(np.count_nonzero(labels > 0))
+            nodata_count += int(np.count_nonzero(labels == nodata))
+            pixel_count += labels.size
+
+    agb_hist = None
+    if sentinel_path is not None:
+        with rasterio.open(sentinel_path) as src:
+            if src.count >= 7:
+                hist = np.zeros(AGB_CLASSES, dtype=np.int64)
+                for _, window in src.block_windows(7):
+                    agb = src.read(7, window=window)
+                    classes = agb[(agb >= 0) & (agb < AGB_CLASSES)].astype(np.int64)
+                    hist += np.bincount(classes, minlength=AGB_CLASSES)
+                agb_hist = json.dumps(hist.tolist())
+    return alert_count, nodata_count, pixel_count, agb_hist
+
+
+class AlertIndex:
+    """
+    SQLite index of the label tiles (<base><suffix>) of one directory.
+    """
+
+    COLUMNS = ('path', 'base', 'size', 'mtime', 'sentinel_size', 'sentinel_mtime', 'alert_count', 'nodata_count',
+               'pixel_count', 'agb_hist')
+
+    def __init__(self, directory, suffix, nodata_value=-9999, db_path=None):
+        """
+        Args:
+            directory (str): Tile directory.
+            suffix (str): Label tile suffix, e.g. '_radd_labelled_agb.tif'. Alerts are read from band 1.
+            nodata_value (float): Label nodata, used when the tiles have none set.
+            db_path (str, optional): Index file. Defaults to <directory>/alert_index.sqlite.
+        """
+        self.directory = directory
+        self.suffix = suffix
+        self.nodata_value = nodata_value
+        self.db_path = db_path or os.path.join(directory, 'alert_index.sqlite')
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        with self._conn:
+            self._conn.executescript("""
+                CREATE TABLE IF NOT EXISTS tiles (
+                    path TEXT PRIMARY KEY,
+                    base TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    mtime REAL NOT NULL,
+                    sentinel_size INTEGER,
+                    sentinel_mtime REAL,
+                    alert_count INTEGER NOT NULL,
+                    nodata_count INTEGER NOT NULL,
+                    pixel_count INTEGER NOT NULL,
+                    agb_hist TEXT
+                );
+                CREATE INDEX IF NOT EXISTS idx_tiles_alerts ON tiles (alert_count);
+            """)
+            # Indexes from before the sentinel columns: their rows get re-read once a sentinel exists
+            columns = [row['name'] for row in self._conn.execute("PRAGMA table_info(tiles)")]
+            for column, sql_type in (('sentinel_size', 'INTEGER'), ('sentinel_mtime', 'REAL')):
+                if column not in columns:
+                    self._conn.execute(f"ALTER TABLE tiles ADD COLUMN {column} {sql_type}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._conn.close()
+
+    def _sentinel_path(self, base):
+        for sentinel_suffix in SENTINEL_SUFFIXES:
+            path = os.path.join(self.directory, base + sentinel_suffix)
+            if os.path.exists(path):
+                return path
+        return None
+
+    def update(self, workers=None, force=False):
+        """
+        Indexes label tiles whose label or sentinel tile is new or rewritten, and drops tiles no
+        longer on disk.
+
+        Args:
+            workers (int, optional): Process pool size for the tiles that need reading.
+            force (bool): Re-read every tile.
+
+        Returns:
+            int: Number of tiles read.
+        """
+        on_disk, sentinels = {}, {}
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(self.suffix) and entry.is_file():
+                base = entry.name[:-len(self.suffix)]
+                stat = entry.stat()
+                path = os.path.abspath(entry.path)
+                sentinels[path] = self._sentinel_path(base)
+                if sentinels[path] is not None:
+                    sentinel_stat = os.stat(sentinels[path])
+                    sentinel_key = (sentinel_stat.st_size, sentinel_stat.st_mtime)
+                else:
+                    sentinel_key = (None, None)
+                on_disk[path] = (base, stat.st_size, stat.st_mtime) + sentinel_key
+
+        with self._lock:
+            known = {row['path']: (row['size'], row['mtime'], row['sentinel_size'], row['sentinel_mtime'])
+                     for row in self._conn.execute("SELECT path, size, mtime, sentinel_size, sentinel_mtime FROM tiles")}
+        stale = [path for path, key in on_disk.items() if force or known.get(path) != key[1:]]
+        gone = [path for path in known if path not in on_disk]
+
+        label_paths = stale
+        sentinel_paths = [sentinels[path] for path in stale]
+        nodata_values = [self.nodata_value] * len(stale)
+        if not workers or workers <= 1:
+            results = list(map(_index_tile, label_paths, sentinel_paths, nodata_values))
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(_index_tile, label_paths, sentinel_paths, nodata_values,
+                                            chunksize=max(1, len(stale) // (workers * 4))))
+
+        rows = [(path,) + on_disk[path] + result for path, result in zip(stale, results)]
+        with self._lock, self._conn:
+            self._conn.executemany("DELETE FROM tiles WHERE path = ?", [(path,) for path in gone])
+            self._conn.executemany(
+                f"INSERT OR REPLACE INTO tiles ({', '.join(self.COLUMNS)}) VALUES ({', '.join('?' * len(self.COLUMNS))})",
+                rows)
+
+        print(f"Alert index updated: {len(stale)}/{len(on_disk)} tiles read, {len(gone)} removed")
+        return len(stale)
+
+    def query(self, min_alert_pixels=None, max_alert_pixels=None, max_nodata_fraction=None, agb_classes=None):
+        """
+        Looks up indexed tiles.
+
+        Args:
+            min_alert_pixels (int, optional): Keep tiles with at least this many alert pixels.
+            max_alert_pixels (int, optional): Keep tiles with fewer than this many alert pixels.
+            max_nodata_fraction (float, optional): Keep tiles with at most this fraction of nodata labels.
+            agb_classes (list, optional): Keep tiles with at least one pixel of these AGB classes.
+
+        Returns:
+            list: One dict per tile with the index columns (agb_hist as a list or None), plus
+                  nodata_fraction, ordered by path.
+        """
+        clauses, params = [], []
+        if min_alert_pixels is not None:
+            clauses.append("alert_count >= ?")
+            params.append(min_alert_pixels)
+        if max_alert_pixels is not None:
+            clauses.append("alert_count < ?")
+            params.append(max_alert_pixels)
+        if max_nodata_fraction is not None:
+            clauses.append("nodata_count <= ? * pixel_count")
+            params.append(max_nodata_fraction)
+
+        sql = f"SELECT {', '.join(self.COLUMNS)} FROM tiles"
+        if clauses:
+            sql += " WHERE " + " AND ".join(clauses)
+        sql += " ORDER BY path"
+
+        with self._lock:
+            rows = [dict(row) for row in self._conn.execute(sql, params).fetchall()]
+        for row in rows:
+            row['agb_hist'] = json.loads(row['agb_hist']) if row['agb_hist'] else None
+            row['nodata_fraction'] = row['nodata_count'] / row['pixel_count'] if row['pixel_count'] else 1.0
+        if agb_classes is not None:
+            rows = [row for row in rows
+                    if row['agb_hist'] and any(row['agb_hist'][c] for c in agb_classes if c < AGB_CLASSES)]
+        return rows
+
+    def delete_tiles(self, rows, batch_size=500):
+        """
+        Deletes tiles and their companion files (sentinel, RADD, stats sidecars) from disk and index.
+
+        Args:
+            rows (list): Tiles as returned by query.
+            batch_size (int): Tiles per index transaction.
+
+        Returns:
+            int: Number of files removed.
+        """
+        removed = 0
+        for start in range(0, len(rows), batch_size):
+            batch = rows[start:start + batch_size]
+            for row in batch:
+                for suffix in COMPANION_SUFFIXES + (self.suffix,):
+                    for path in (os.path.join(self.directory, row['base'] + suffix),
+                                 sidecar_path(os.path.join(self.directory, row['base'] + suffix))):
+                        if os.path.exists(path):
+                            os.remove(path)
+                            removed += 1
+            with self._lock, self._conn:
+                self._conn.executemany("DELETE FROM tiles WHERE path = ?", [(row['path'],) for row in batch])
+            print(f"Removed {start + len(batch)}/{len(rows)} stacks")
+        return removed
@@ -0,0 +1,484 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming per-band statistics for normalization configs (img_norm_cfg).
+
+Files are read block by block and reduced to per-band (count, mean, M2) partial aggregates, which
+merge exactly with Chan's parallel form of Welford's algorithm. Memory is O(bands) whatever the tile
+size, and per-file aggregates can be computed in a process pool and reduced at the end.
+
+Per-file aggregates (count, sum, sumsq, mean, M2, min, max and a quantile sketch) can also be cached
+in a JSON sidecar next to each tile (<tile>.stats.json), computed in a single block pass, so global
+statistics over any subset of tiles are a reduction over the sidecars without re-reading pixels.
+
+The sketch buckets values on one fixed logarithmic grid shared by every file and band (bucket k
+holds |v| in (gamma^(k-1), gamma^k]), so per-file sketches merge exactly by adding counts, and any
+quantile read from the merged sketch is within SKETCH_ALPHA relative error of the exact value.
+
+The resulting per-band scale and offset can be stored in a band scaling file and applied at read
+time (apply_band_scaling, or the ApplyBandScaling pipeline transform in custom_pipelines), so tiles
+stay in their native dtype instead of being rewritten as float32 *_normalized.tif copies.
+
+@Time    : 17/10/2026
+@Author  : Colm Keyes
+@Email   : keyesco@tcd.ie
+@File    : band_statistics.py
+"""
+
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import numpy as np
+import rasterio
+
+
+class BandMoments:
+    """
+    Per-band count, mean and sum of squared deviations from the mean (M2).
+    """
+
+    def __init__(self, count, mean, m2):
+        self.count = np.asarray(count, dtype=np.int64)
+        self.mean = np.asarray(mean, dtype=np.float64)
+        self.m2 = np.asarray(m2, dtype=np.float64)
+
+    @classmethod
+    def empty(cls, n_bands):
+        return cls(np.zeros(n_bands), np.zeros(n_bands), np.zeros(n_bands))
+
+    @classmethod
+    def from_block(cls, block, valid):
+        """
+        Moments of the valid pixels of a block.
+
+        Args:
+            block (np.ndarray): (bands, rows, cols) pixel values.
+            valid (np.ndarray): Boolean array of the same shape, True where a pixel counts.
+        """
+        block = block.astype(np.float64)
+        count = valid.sum(axis=(1, 2))
+        total = np.where(valid, block, 0).sum(axis=(1, 2))
+        mean = np.divide(total, count, out=np.zeros_like(total), where=count > 0)
+        deviation = np.where(valid, block - mean[:, None, None], 0)
+        m2 = np.square(deviation).sum(axis=(1, 2))
+        return cls(count, mean, m2)
+
+    def merge(self, other):
+        """Chan et al. pairwise combination, exact for any split of the data."""
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        safe_count = np.maximum(count, 1)
+        mean = self.mean + delta * other.count / safe_count
+        m2 = self.m2 + other.m2 + np.square(delta) * self.count * other.count / safe_count
+        return BandMoments(count, mean, m2)
+
+    @property
+    def std(self):
+        """Population standard deviation per band (0 for bands without valid pixels)."""
+        variance = np.divide(self.m2, self.count, out=np.zeros_like(self.m2), where=self.count > 0)
+        return np.sqrt(variance)
+
+    def to_img_norm_cfg(self):
+        """Means and stds as plain floats, in the form cfg.img_norm_cfg expects."""
+        return dict(means=[float(m) for m in self.mean], stds=[float(s) for s in self.std])
+
+
+def file_moments(file_path, bands=None, nan_value=-9999):
+    """
+    Streams one raster block by block into BandMoments.
+
+    Args:
+        file_path (str): Raster to read.
+        bands (list, optional): 1-based band indexes. Defaults to all bands.
+        nan_value (float): Pixel value excluded from the statistics, as are NaNs.
+
+    Returns:
+        BandMoments: One entry per requested band.
+    """
+    with rasterio.open(file_path) as src:
+        if bands is None:
+            bands = list(range(1, src.count + 1))
+        moments = BandMoments.empty(len(bands))
+        for _, window in src.block_windows(1):
+            block = src.read(bands, window=window)
+            valid = block != nan_value
+            if np.issubdtype(block.dtype, np.floating):
+                valid &= np.isfinite(block)
+            moments = moments.merge(BandMoments.from_block(block, valid))
+    return moments
+
+
+def reduce_moments(moments, n_bands):
+    """Merges a sequence of BandMoments into one."""
+    total = BandMoments.empty(n_bands)
+    for m in moments:
+        total = total.merge(m)
+    return total
+
+
+def band_statistics(files, bands=None, nan_value=-9999, workers=None):
+    """
+    Mean and standard deviation of each band over all valid pixels of all files.
+
+    Args:
+        files (list): Raster paths.
+        bands (list, optional): 1-based band indexes. Defaults to all bands of the first file.
+        nan_value (float): Pixel value excluded from the statistics.
+        workers (int, optional): Process pool size for the per-file pass. None or 1 runs in this process.
+
+    Returns:
+        dict: {'means': [...], 'stds': [...]} as Python floats, ready for cfg.img_norm_cfg.
+    """
+    if not files:
+        raise ValueError("No files to compute band statistics from.")
+    if bands is None:
+        with rasterio.open(files[0]) as src:
+            bands = list(range(1, src.count + 1))
+
+    per_file = partial(file_moments, bands=bands, nan_value=nan_value)
+    if not workers or workers <= 1:
+        moments = map(per_file, files)
+        return reduce_moments(moments, len(bands)).to_img_norm_cfg()
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # map() yields in submission order, so the reduction is deterministic
+        moments = executor.map(per_file, files, chunksize=max(1, len(files) // (workers * 4)))
+        return reduce_moments(moments, len(bands)).to_img_norm_cfg()
+
+
+def list_files(directories, suffix):
+    """Sorted paths of the files ending in suffix across directories."""
+    return sorted(os.path.join(directory, f) for directory in directories
+                  for f in os.listdir(directory) if f.endswith(suffix))
+
+
+# Sidecar file next to each raster
+SIDECAR_SUFFIX = '.stats.json'
+
+# Relative accuracy of the quantile sketches in the sidecars (0.5%)
+SKETCH_ALPHA = 0.005
+_SKETCH_GAMMA = (1 + SKETCH_ALPHA) / (1 - SKETCH_ALPHA)
+# Values with a smaller magnitude count as zero
+_SKETCH_MIN_VALUE = 1e-9
+
+
+def sidecar_path(file_path):
+    return file_path + SIDECAR_SUFFIX
+
+
+def remove_sidecar(file_path):
+    """Deletes the stats sidecar of a raster, if any (call when the raster itself is deleted)."""
+    if os.path.exists(sidecar_path(file_path)):
+        os.remove(sidecar_path(file_path))
+
+
+def _rule_key(rule):
+    """('gt', 0) -> 'gt:0'."""
+    op, value = rule
+    if op not in ('gt', 'ge', 'ne'):
+        raise ValueError("Invalid validity rule. Use ('gt', value), ('ge', value) or ('ne', value).")
+    return f"{op}:{float(value):g}"
+
+
+def _valid_mask(block, rule):
+    op, value = rule
+    if op == 'gt':
+        valid = block > value
+    elif op == 'ge':
+        valid = block >= value
+    else:
+        valid = block != value
+    if np.issubdtype(block.dtype, np.floating):
+        valid &= np.isfinite(block)
+    return valid
+
+
+def _sketch_keys(magnitudes):
+    """Bucket of each positive magnitude on the fixed sketch grid."""
+    return np.ceil(np.log(magnitudes) / np.log(_SKETCH_GAMMA)).astype(np.int64)
+
+
+class QuantileSketch:
+    """
+    Mergeable quantile sketch: counts per bucket of the fixed logarithmic grid, for positive and
+    negative values separately, plus a count of zeros.
+    """
+
+    def __init__(self, positive=None, negative=None, zero=0):
+        self.positive = positive if positive is not None else {}
+        self.negative = negative if negative is not None else {}
+        self.zero = int(zero)
+
+    @staticmethod
+    def _add_counts(target, keys, counts):
+        for key, count in zip(keys.tolist(), counts.tolist()):
+            target[key] = target.get(key, 0) + count
+
+    def add(self, values):
+        values = np.asarray(values, dtype=np.float64).ravel()
+        magnitudes = np.abs(values)
+        small = magnitudes < _SKETCH_MIN_VALUE
+        self.zero += int(small.sum())
+        for target, selected in ((self.positive, (values > 0) & ~small), (self.negative, (values < 0) & ~small)):
+            if selected.any():
+                self._add_counts(target, *np.unique(_sketch_keys(magnitudes[selected]), return_counts=True))
+        return self
+
+    def merge(self, other):
+        merged = QuantileSketch(dict(self.positive), dict(self.negative), self.zero + other.zero)
+        for target, source in ((merged.positive, other.positive), (merged.negative, other.negative)):
+            for key, count in source.items():
+                target[key] = target.get(key, 0) + count
+        return merged
+
+    @property
+    def count(self):
+        return self.zero + sum(self.positive.values()) + sum(self.negative.values())
+
+    def quantiles(self, percentiles):
+        """Values at the given percentiles (0-100), NaN for an empty sketch."""
+        # Buckets in ascending value order: negatives by descending magnitude, zero, positives
+        keys = sorted(self.negative, reverse=True)
+        values = [-2 * _SKETCH_GAMMA ** k / (_SKETCH_GAMMA + 1) for k in keys]
+        counts = [self.negative[k] for k in keys]
+        values.append(0.0)
+        counts.append(self.zero)
+        keys = sorted(self.positive)
+        values += [2 * _SKETCH_GAMMA ** k / (_SKETCH_GAMMA + 1) for k in keys]
+        counts += [self.positive[k] for k in keys]
+
+        cumulative = np.cumsum(counts)
+        if not len(cumulative) or cumulative[-1] == 0:
+            return np.full(len(percentiles), np.nan)
+        ranks = np.asarray(percentiles, dtype=np.float64) / 100 * (cumulative[-1] - 1)
+        return np.asarray(values)[np.searchsorted(cumulative, ranks, side='right')]
+
+    def to_json(self):
+        return {'zero': self.zero,
+                'positive': [list(self.positive), list(self.positive.values())],
+                'negative': [list(self.negative), list(self.negative.values())]}
+
+    @classmethod
+    def from_json(cls, entry):
+        return cls(dict(zip(*entry['positive'])), dict(zip(*entry['negative'])), entry['zero'])
+
+
+def _compute_band_stats(src, bands, rule):
+    """One block pass over an open raster: moments, sums, min/max and a quantile sketch per band."""
+    moments = BandMoments.empty(len(bands))
+    total = np.zeros(len(bands))
+    total_sq = np.zeros(len(bands))
+    band_min = np.full(len(bands), np.inf)
+    band_max = np.full(len(bands), -np.inf)
+    sketches = [QuantileSketch() for _ in bands]
+    for _, window in src.block_windows(1):
+        block = src.read(bands, window=window).astype(np.float64)
+        valid = _valid_mask(block, rule)
+        moments = moments.merge(BandMoments.from_block(block, valid))
+        total += np.where(valid, block, 0).sum(axis=(1, 2))
+        total_sq += np.where(valid, np.square(block), 0).sum(axis=(1, 2))
+        band_min = np.minimum(band_min, np.where(valid, block, np.inf).min(axis=(1, 2)))
+        band_max = np.maximum(band_max, np.where(valid, block, -np.inf).max(axis=(1, 2)))
+        for i, sketch in enumerate(sketches):
+            sketch.add(block[i][valid[i]])
+
+    stats = {}
+    for i, band in enumerate(bands):
+        has_pixels = moments.count[i] > 0
+        stats[str(band)] = {
+            'count': int(moments.count[i]),
+            'sum': float(total[i]),
+            'sumsq': float(total_sq[i]),
+            'mean': float(moments.mean[i]),
+            'm2': float(moments.m2[i]),
+            'min': float(band_min[i]) if has_pixels else None,
+            'max': float(band_max[i]) if has_pixels else None,
+            'sketch': sketches[i].to_json(),
+        }
+    return stats
+
+
+def file_stats(file_path, bands, rule=('gt', 0), refresh=False):
+    """
+    Per-band statistics of one raster, from its sidecar when that is still current.
+
+    The sidecar is keyed by the raster's size and mtime (any rewrite invalidates it) and holds one
+    entry per validity rule and band, so other band subsets and rules are added incrementally.
+
+    Args:
+        file_path (str): Raster path.
+        bands (list): 1-based band indexes.
+        rule (tuple): Which pixels count: ('gt', v) for value > v, ('ge', v) for value >= v,
+                      ('ne', v) for value != v. NaNs never count.
+        refresh (bool): Recompute even if the sidecar is current.
+
+    Returns:
+        list: One dict per band with count, sum, sumsq, mean, m2, min, max and sketch (QuantileSketch
+              JSON).
+    """
+    stat = os.stat(file_path)
+    path = sidecar_path(file_path)
+    sidecar = None
+    if not refresh and os.path.exists(path):
+        try:
+            with open(path) as f:
+                sidecar = json.load(f)
+        except ValueError:
+            sidecar = None  # truncated or corrupt, rebuild
+    if (sidecar is None or sidecar.get('size') != stat.st_size or sidecar.get('mtime') != stat.st_mtime
+            or sidecar.get('sketch_alpha') != SKETCH_ALPHA):
+        sidecar = {'size': stat.st_size, 'mtime': stat.st_mtime, 'sketch_alpha': SKETCH_ALPHA, 'rules': {}}
+
+    entry = sidecar['rules'].setdefault(_rule_key(rule), {})
+    missing = [band for band in bands if str(band) not in entry]
+    if missing:
+        with rasterio.open(file_path) as src:
+            entry.update(_compute_band_stats(src, missing, rule))
+        with open(path + '.tmp', 'w') as f:
+            json.dump(sidecar, f)
+        os.replace(path + '.tmp', path)
+    return [entry[str(band)] for band in bands]
+
+
+def reduce_file_stats(per_file, n_bands):
+    """
+    Exact global statistics from per-file stats (as returned by file_stats).
+
+    Returns:
+        dict: count, mean, std (population), min, max and sum per band as numpy arrays, and the merged
+              per-band QuantileSketch list under 'sketches'. min/max are inf/-inf for bands without
+              valid pixels.
+    """
+    moments = BandMoments.empty(n_bands)
+    band_min = np.full(n_bands, np.inf)
+    band_max = np.full(n_bands, -np.inf)
+    total = np.zeros(n_bands)
+    sketches = [QuantileSketch() for _ in range(n_bands)]
+    for stats in per_file:
+        moments = moments.merge(BandMoments([s['count'] for s in stats], [s['mean'] for s in stats],
+                                            [s['m2'] for s in stats]))
+        for i, s in enumerate(stats):
+            if s['count']:
+                band_min[i] = min(band_min[i], s['min'])
+                band_max[i] = max(band_max[i], s['max'])
+                total[i] += s['sum']
+                sketches[i] = sketches[i].merge(QuantileSketch.from_json(s['sketch']))
+    return {'count': moments.count, 'mean': moments.mean, 'std': moments.std,
+            'min': band_min, 'max': band_max, 'sum': total, 'sketches': sketches}
+
+
+def sketch_quantiles(stats, percentiles):
+    """
+    Per-band percentiles from reduced stats (reduce_file_stats), within SKETCH_ALPHA relative error
+    and clamped to the exact global min/max.
+
+    Returns:
+        np.ndarray: (len(percentiles), n_bands)
+    """
+    result = np.stack([sketch.quantiles(percentiles) for sketch in stats['sketches']], axis=1)
+    return np.clip(result, stats['min'], stats['max'])
+
+
+def global_file_stats(files, bands, rule=('gt', 0), workers=None):
+    """
+    Global per-band statistics over files, reading pixels only for files without a current sidecar.
+
+    Args:
+        files (list): Raster paths.
+        bands (list): 1-based band indexes.
+        rule (tuple): Validity rule, see file_stats.
+        workers (int, optional): Process pool size for files that need (re)computing.
+
+    Returns:
+        dict: See reduce_file_stats.
+    """
+    return reduce_file_stats(collect_file_stats(files, bands, rule, workers), len(bands))
+
+
+def collect_file_stats(files, bands, rule=('gt', 0), workers=None):
+    """file_stats for every file, in order, computing missing sidecars in an optional process pool."""
+    per_file_stats = partial(file_stats, bands=bands, rule=rule)
+    if not workers or workers <= 1:
+        return [per_file_stats(f) for f in files]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(per_file_stats, files, chunksize=max(1, len(files) // (workers * 4))))
+
+
+def write_band_scaling(path, bands, low, high, nodata_value, rule, means=None, stds=None):
+    """
+    Stores per-band scale and offset mapping [low, high] to [0, 1] in a JSON band scaling file.
+
+    Bands already in the file are replaced and others kept, so HLS and SAR bands of the same stacks
+    can be written by their own loaders into one file.
+
+    Args:
+        path (str): Band scaling JSON path.
+        bands (list): 1-based band indexes, matching low and high.
+        low, high (array-like): Values mapped to 0 and 1; values outside are clipped.
+        nodata_value (float): Written for pixels that fail the rule.
+        rule (tuple): Validity rule of the pixels to scale, see file_stats.
+        means, stds (array-like, optional): Mean and std of the scaled bands, for img_norm_cfg.
+
+    Returns:
+        dict: The full band scaling.
+    """
+    scaling = load_band_scaling(path) if os.path.exists(path) else {'bands': {}}
+    scaling['nodata'] = float(nodata_value)
+    for i, band in enumerate(bands):
+        span = float(high[i]) - float(low[i])
+        scale = 1.0 / span if span > 0 else 0.0
+        entry = {'scale': scale, 'offset': -float(low[i]) * scale, 'low': float(low[i]), 'high': float(high[i]),
+                 'rule': [rule[0], float(rule[1])]}
+        if means is not None:
+            entry.update(mean=float(means[i]), std=float(stds[i]))
+        scaling['bands'][str(band)] = entry
+    with open(path + '.tmp', 'w') as f:
+        json.dump(scaling, f, indent=2)
+    os.replace(path + '.tmp', path)
+    return scaling
+
+
+def load_band_scaling(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def scaled_img_norm_cfg(scaling, bands):
+    """
+    img_norm_cfg (means, stds) of scaled inputs, for the model config normalize step that follows
+    ApplyBandScaling. Bands without stored stats get mean 0 / std 1.
+
+    Args:
+        scaling (dict): As written by write_band_scaling.
+        bands (list): 0-based stack band indexes the model reads (cfg.bands), in model order.
+    """
+    entries = [scaling['bands'].get(str(band + 1), {}) for band in bands]
+    return dict(means=[float(e.get('mean', 0.0)) for e in entries],
+                stds=[float(e.get('std', 1.0)) or 1.0 for e in entries])
+
+
+def apply_band_scaling(img, scaling, channel_axis=0):
+    """
+    Scales a tile read in its native dtype: value * scale + offset, clipped to [0, 1], for each band
+    in the scaling; pixels failing the band's rule become nodata. Other bands are only cast.
+
+    Args:
+        img (np.ndarray): Tile with all bands of the stack, band k at index k - 1 of channel_axis.
+        scaling (dict): As written by write_band_scaling.
+        channel_axis (int): 0 for (band, y, x) rasterio reads, -1 for (y, x, band) pipeline images.
+
+    Returns:
+        np.ndarray: float32 copy of img.
+    """
+    out = np.moveaxis(img.astype(np.float32), channel_axis, 0)
+    nodata = np.float32(scaling['nodata'])
+    for band, entry in scaling['bands'].items():
+        index = int(band) - 1
+        if index >= out.shape[0]:
+            continue
+        band_data = out[index]
+        valid = _valid_mask(band_data, tuple(entry['rule']))
+        scaled = np.clip(band_data * np.float32(entry['scale']) + np.float32(entry['offset']), 0, 1)
+        out[index] = np.where(valid, scaled, nodata)
+    return np.moveaxis(out, 0, channel_axis)
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""
+Custom data pipeline transforms
+"""
+"""
+@Time    : 17/10/2026
+@Author  : Colm Keyes
+@Email   : keyesco@tcd.ie
+@File    : custom_pipelines
+"""
+
+import numpy as np
+from mmseg.datasets.builder import PIPELINES
+from src.band_statistics import apply_band_scaling, load_band_scaling, scaled_img_norm_cfg
+
+
+@PIPELINES.register_module()
+class ApplyBandScaling(object):
+    """
+    Normalizes the loaded image at read time with a band scaling file written by
+    Loader.write_band_scaling / SARLoader.write_band_scaling, so the training and inference tiles can
+    stay in their native dtype instead of float32 *_normalized.tif copies.
+
+    Goes right after LoadGeospatialImageFromFile and before BandsExtract, since the scaling is keyed by
+    the stack's band numbers. Config usage (with custom_imports=dict(imports=['src.custom_pipelines'])):
+
+        dict(type='ApplyBandScaling', scaling_file='/data/band_scaling.json')
+    """
+
+    def __init__(self, scaling_file, channel_axis=-1):
+        """
+        Args:
+            scaling_file (str): Band scaling JSON.
+            channel_axis (int): Band axis of results['img'], -1 for the (y, x, band) loaded images.
+        """
+        self.scaling_file = scaling_file
+        self.channel_axis = channel_axis
+        self.scaling = load_band_scaling(scaling_file)
+
+    def __call__(self, results):
+        results['img'] = apply_band_scaling(np.asarray(results['img']), self.scaling, self.channel_axis)
+        return results
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}(scaling_file={self.scaling_file}, channel_axis={self.channel_axis})"
+
+
+def add_band_scaling(pipeline, scaling_file, bands):
+    """
+    Inserts ApplyBandScaling right after the image load of a pipeline config (once), and points its
+    normalize step (any step with means/stds) at the stats of the scaled bands, so the raw-DN
+    img_norm_cfg isn't applied to 0-1 inputs. Use the same call for the train, val and test pipelines.
+
+    Args:
+        pipeline (list): Pipeline config dicts, modified in place.
+        scaling_file (str): Band scaling JSON.
+        bands (list): 0-based stack band indexes the model reads (cfg.bands).
+
+    Returns:
+        dict: The img_norm_cfg applied, for cfg.img_norm_cfg.
+
+    Raises:
+        ValueError: If the pipeline has no LoadGeospatialImageFromFile step.
+    """
+    img_norm_cfg = scaled_img_norm_cfg(load_band_scaling(scaling_file), bands)
+    if not any(step['type'] == 'ApplyBandScaling' for step in pipeline):
+        load_steps = [i for i, step in enumerate(pipeline) if step['type'] == 'LoadGeospatialImageFromFile']
+        if not load_steps:
+            raise ValueError("Pipeline has no LoadGeospatialImageFromFile step to insert ApplyBandScaling after")
+        pipeline.insert(load_steps[0] + 1, dict(type='ApplyBandScaling', scaling_file=scaling_file))
+    for step in pipeline:
+        if 'means' in step and 'stds' in step:
+            step.update(img_norm_cfg)
+    return img_norm_cfg
@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+"""
+Per-MGRS-tile Zarr datacubes of processed HLS stacks, with dimensions (time, band, y, x).
+
+One cube replaces the hundreds of single-date GeoTIFFs of a tile. Appends use one date per time
+chunk, so adding a date only writes that date's chunks and rewrites nothing else. For reading,
+TileCube.rechunk rewrites the committed dates into one time chunk over small spatial chunks, so a
+pixel's time series is a single chunk read; export_stacks_to_cubes does that after its appends.
+Dates appended after a rechunk start new chunks until the next rechunk. Zarr is an optional
+dependency, imported on first use.
+
+@Time    : 17/10/2026
+@Author  : Colm Keyes
+@Email   : keyesco@tcd.ie
+@File    : datacube.py
+"""
+
+import os
+
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+
+
+def _import_zarr():
+    try:
+        import zarr
+    except ImportError as e:
+        raise ImportError("Datacubes need the optional 'zarr' package: pip install zarr") from e
+    return zarr
+
+
+def stack_tile_date(filename):
+    """
+    Tile and date of a stack file, for both naming schemes used by the pipeline.
+
+    Args:
+        filename (str): e.g. 'T49MDU.2023241_S30_stack.tif' or '2023241_T49MDU_forest_masked_fmask_stack.tif'
+
+    Returns:
+        tuple: (tile, date), e.g. ('T49MDU', '2023241')
+    """
+    first, second = os.path.basename(filename).split('_')[:2]
+    if '.' in first:
+        tile, date = first.split('.')
+        return tile, date
+    return second, first
+
+
+class TileCube:
+    """
+    Zarr store holding every date of one MGRS tile as a 'data' array of shape (time, band, y, x).
+
+    Dates, CRS, transform, band names and nodata live in the group attributes. Dates are kept in
+    append order; pixel_series and read_date look them up by value. attrs['dates'] is the commit
+    record: slice t of 'data' is valid only for t < len(dates), so a slice left by an interrupted
+    append is ignored by reads and overwritten by the next append. attrs['array'] names the array
+    holding the dates ('data' until the first rechunk), switched only once a rechunked copy is complete.
+    """
+
+    def __init__(self, path, time_chunk=1, spatial_chunk=128):
+        """
+        Args:
+            path (str): Cube directory, e.g. <cube_dir>/T49MDU.zarr. Created on the first append.
+            time_chunk (int): Dates per chunk. 1 (default) never rewrites existing chunks on append;
+                              larger values read a pixel series in fewer chunks, but every append
+                              rewrites the chunks of the last time block.
+            spatial_chunk (int): Chunk height and width in pixels.
+        """
+        self.path = path
+        self.time_chunk = time_chunk
+        self.spatial_chunk = spatial_chunk
+        self._zarr = _import_zarr()
+        self._group = self._zarr.open_group(path, mode='a')
+
+    @property
+    def dates(self):
+        return list(self._group.attrs.get('dates', []))
+
+    @property
+    def bands(self):
+        return list(self._group.attrs.get('bands', []))
+
+    @property
+    def data(self):
+        """The (time, band, y, x) zarr array, or None before the first append. May hold one trailing
+        uncommitted slice after an interrupted append; index it with len(dates)."""
+        name = self._group.attrs.get('array', 'data')
+        return self._group[name] if name in self._group else None
+
+    def _create_array(self, name, shape, chunks, dtype, fill_value):
+        # zarr 3 uses create_array (compressed with zstd by default), zarr 2 create_dataset (blosc)
+        create = getattr(self._group, 'create_array', None) or self._group.create_dataset
+        return create(name, shape=shape, chunks=chunks, dtype=dtype, fill_value=fill_value)
+
+    def _create(self, src):
+        shape = (0, src.count, src.height, src.width)
+        chunks = (self.time_chunk, src.count, min(self.spatial_chunk, src.height), min(self.spatial_chunk, src.width))
+        fill_value = src.nodata if src.nodata is not None else 0
+        self._create_array('data', shape, chunks, src.dtypes[0], fill_value)
+        self._group.attrs.update({
+            'array': 'data',
+            'dates': [],
+            'crs': src.crs.to_wkt(),
+            'transform': list(src.transform)[:6],
+            'bands': [d or f"Band {i}" for i, d in enumerate(src.descriptions, start=1)],
+            'nodata': src.nodata,
+        })
+
+    def _check_grid(self, src, stack_path):
+        attrs = self._group.attrs
+        same_grid = (rasterio.crs.CRS.from_wkt(attrs['crs']) == src.crs
+                     and np.allclose(attrs['transform'], list(src.transform)[:6])
+                     and self.data.shape[1:] == (src.count, src.height, src.width))
+        if not same_grid:
+            raise ValueError(f"{stack_path} is not on the grid of cube {self.path}")
+
+    def append(self, stack_path, date=None):
+        """
+        Adds one stack as a new date. Existing dates are skipped.
+
+        Args:
+            stack_path (str): Stack GeoTIFF/VRT on the cube's grid.
+            date (str, optional): YYYYDDD date. Defaults to the date in the stack's file name.
+
+        Returns:
+            bool: True if the date was added, False if it was already in the cube.
+        """
+        if date is None:
+            _, date = stack_tile_date(stack_path)
+        if date in self.dates:
+            return False
+
+        with rasterio.open(stack_path) as src:
+            if self.data is None:
+                self._create(src)
+            else:
+                self._check_grid(src, stack_path)
+
+            data = self.data
+            # Committed dates decide the slice, dropping any slice an interrupted append left behind
+            t = len(self.dates)
+            data.resize((t + 1,) + tuple(data.shape[1:]))
+
+            # Write in strips of whole chunk rows to bound memory
+            for row_off in range(0, src.height, self.spatial_chunk):
+                window = Window(0, row_off, src.width, min(self.spatial_chunk, src.height - row_off))
+                data[t, :, row_off:row_off + int(window.height), :] = src.read(window=window)
+
+        # Record the date last, so an interrupted append leaves no half-written date listed
+        self._group.attrs['dates'] = self.dates + [date]
+        return True
+
+    def rechunk(self, time_chunk=None, spatial_chunk=32):
+        """
+        Rewrites the committed dates into a read-optimized layout, by default all dates in one time
+        chunk over spatial_chunk x spatial_chunk pixels, so pixel_series reads a single chunk.
+
+        The copy goes to a new array and attrs['array'] is switched to it only when complete, so an
+        interrupted rechunk leaves the cube as it was. Later appends go into the time chunk after the
+        copied dates, rewriting its chunks on every append until the next rechunk.
+
+        Args:
+            time_chunk (int, optional): Dates per chunk. Defaults to the number of committed dates.
+            spatial_chunk (int): Chunk height and width in pixels. Smaller chunks keep a single-pixel
+                                 series read small when the time chunk is long.
+
+        Returns:
+            bool: True if the cube was rewritten, False if it already had this layout.
+        """
+        old = self.data
+        dates = self.dates
+        if old is None or not dates:
+            return False
+        n_bands, height, width = old.shape[1:]
+        time_chunk = time_chunk or len(dates)
+        chunks = (time_chunk, n_bands, min(spatial_chunk, height), min(spatial_chunk, width))
+        if tuple(old.chunks) == chunks and old.shape[0] == len(dates):
+            return False
+
+        old_name = self._group.attrs.get('array', 'data')
+        # Alternate between two names so the copy never overwrites the array in use
+        name = 'data_b' if old_name != 'data_b' else 'data_a'
+        if name in self._group:
+            del self._group[name]
+        new = self._create_array(name, (len(dates),) + tuple(old.shape[1:]), chunks, old.dtype, old.fill_value)
+
+        # Copy in blocks of the larger of the two spatial chunks, over all dates at once
+        step = max(old.chunks[2], chunks[2])
+        for row_off in range(0, height, step):
+            for col_off in range(0, width, step):
+                rows = slice(row_off, min(row_off + step, height))
+                cols = slice(col_off, min(col_off + step, width))
+                new[:, :, rows, cols] = old[:len(dates), :, rows, cols]
+
+        self._group.attrs['array'] = name
+        del self._group[old_name]
+        return True
+
+    def read_date(self, date):
+        """(band, y, x) array of one date."""
+        return self.data[self.dates.index(date)]
+
+    def pixel_series(self, row, col):
+        """
+        Time series of one pixel, sorted by date.
+
+        Returns:
+            tuple: (list of dates, array of shape (time, band))
+        """
+        dates = self.dates
+        series = self.data[:len(dates), :, row, col]
+        order = np.argsort(dates)
+        return [dates[i] for i in order], series[order]
+
+
+def export_stacks_to_cubes(stack_folder, cube_dir, suffix='_stack.tif', time_chunk=1, spatial_chunk=128,
+                           series_spatial_chunk=32):
+    """
+    Appends every stack in a folder to its tile's cube (<cube_dir>/<tile>.zarr), in date order.
+    Dates already in a cube are skipped, so re-running only adds new stacks.
+
+    Appends write time_chunk dates per chunk (1: no chunk is rewritten). Cubes not yet in the read
+    layout (new dates here or from TileCube.append) are then rechunked, all dates in one time chunk over series_spatial_chunk pixels, so a
+    pixel series is one chunk read. series_spatial_chunk=None keeps the append layout.
+
+    Returns:
+        dict: {tile: TileCube}
+    """
+    os.makedirs(cube_dir, exist_ok=True)
+    stacks = sorted((stack_tile_date(f), f) for f in os.listdir(stack_folder) if f.endswith(suffix))
+
+    cubes = {}
+    for (tile, date), stack_file in stacks:
+        if tile not in cubes:
+            cubes[tile] = TileCube(os.path.join(cube_dir, f"{tile}.zarr"), time_chunk, spatial_chunk)
+        if cubes[tile].append(os.path.join(stack_folder, stack_file), date):
+            print(f"Appended {stack_file} to {cubes[tile].path}")
+        else:
+            print(f"{date} already in {cubes[tile].path}, skipping.")
+
+    if series_spatial_chunk is not None:
+        for tile in sorted(cubes):
+            if cubes[tile].rechunk(spatial_chunk=series_spatial_chunk):
+                print(f"Rechunked {cubes[tile].path} to {len(cubes[tile].dates)} dates per chunk")
+    return cubes
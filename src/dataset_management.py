@@ -14,11 +14,17 @@ import os
 import shutil
 import rasterio
 import numpy as np
-from torch.utils.data import Dataset, random_split
+from torch.utils.data import Dataset, IterableDataset, get_worker_info, random_split
 from rasterio.windows import Window
 import matplotlib.pyplot as plt
 import shutil
 import torch
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from src.output_profiles import cog_profile, add_overviews
+from src.datacube import stack_tile_date
+from src.tile_shards import ShardWriter, iter_shard_tiles, shard_paths
+from src.model_input_processor import radd_labels, radd_yydoy
 # from sklearn.model_selection import train_test_split
 
 class CustomDataset(Dataset):
@@ -32,14 +38,107 @@ class CustomDataset(Dataset):
     def __getitem__(self, idx):
         return self.pairs[idx]
 
+def _tile_offsets(size, tile_size, stride, pad_edges):
+    """Tile offsets along one axis: full tiles only, plus a last partial tile covering the edge if pad_edges."""
+    offsets = list(range(0, size - tile_size + 1, stride))
+    covered = offsets[-1] + tile_size if offsets else 0
+    if pad_edges and covered < size:
+        offsets.append(offsets[-1] + stride if offsets else 0)
+    return offsets
+
+
+def _crop_tile_row(row_off, image_path, output_folder, col_offs, tile_size, skip_empty, mask_band, codec):
+    """Writes one row of tiles for DatasetManagement.crop_to_tiles. Returns (written, skipped)."""
+    written = skipped = 0
+    stack_name = os.path.splitext(os.path.basename(image_path))[0]
+    with rasterio.open(image_path) as src:
+        fill_value = src.nodata if src.nodata is not None else 0
+        for col_off in col_offs:
+            tile_path = os.path.join(output_folder, f"{stack_name}_{col_off}_{row_off}.tif")
+            if os.path.exists(tile_path):
+                continue
+
+            window = Window(col_off, row_off, tile_size, tile_size)
+            partial_tile = row_off + tile_size > src.height or col_off + tile_size > src.width
+            if skip_empty:
+                # Mask of the part inside the raster, from the internal mask or nodata of one band
+                inside = window.intersection(Window(0, 0, src.width, src.height))
+                if not src.read_masks(mask_band, window=inside).any():
+                    skipped += 1
+                    continue
+
+            tile = src.read(window=window, boundless=partial_tile, fill_value=fill_value)
+            tile_profile = cog_profile({
+                'driver': 'GTiff',
+                'height': tile.shape[1],
+                'width': tile.shape[2],
+                'count': src.count,
+                'dtype': tile.dtype,
+                'crs': src.crs,
+                'nodata': src.nodata,
+                'transform': rasterio.windows.transform(window, src.transform)
+            }, codec)
+            with rasterio.open(tile_path, 'w', **tile_profile) as tile_dst:
+                tile_dst.write(tile)
+            written += 1
+    return written, skipped
+
+
+class ShardDataset(IterableDataset):
+    """
+    Streams (image, label) tiles from tar shards written by DatasetManagement.crop_to_shards.
+
+    Shards are read sequentially and split between DataLoader workers, so each worker opens only its
+    own shards. With shuffle=True the shard order changes every epoch (set_epoch) and tiles are
+    shuffled within a buffer of shuffle_buffer tiles.
+    """
+
+    def __init__(self, shard_folder, min_alert_pixels=None, shuffle=False, shuffle_buffer=256, seed=42,
+                 return_meta=False):
+        self.paths = shard_paths(shard_folder, min_alert_pixels)
+        self.min_alert_pixels = min_alert_pixels
+        self.shuffle = shuffle
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.return_meta = return_meta
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        paths = list(self.paths)
+        generator = torch.Generator().manual_seed(self.seed + self.epoch)
+        if self.shuffle:
+            paths = [paths[i] for i in torch.randperm(len(paths), generator=generator).tolist()]
+        worker = get_worker_info()
+        if worker is not None:
+            paths = paths[worker.id::worker.num_workers]
+
+        buffer = []
+        for image, label, meta in iter_shard_tiles(paths, self.min_alert_pixels):
+            sample = (torch.from_numpy(image), torch.from_numpy(label))
+            if self.return_meta:
+                sample += (meta,)
+            if not self.shuffle:
+                yield sample
+                continue
+            buffer.append(sample)
+            if len(buffer) >= self.shuffle_buffer:
+                yield buffer.pop(torch.randint(len(buffer), (1,), generator=generator).item())
+        while buffer:
+            yield buffer.pop(torch.randint(len(buffer), (1,), generator=generator).item())
+
+
 class DatasetManagement:
-    def __init__(self, source_dir, train_dir, val_dir, output_folder, tile_size=512, val_split=0.25):
+    def __init__(self, source_dir, train_dir, val_dir, output_folder, tile_size=512, val_split=0.25, codec='auto'):
         self.source_dir = source_dir
         self.train_dir = train_dir
         self.val_dir = val_dir
         self.output_folder = output_folder
         self.tile_size = tile_size
         self.val_split = val_split
+        self.codec = codec  # output compression, see output_profiles.cog_profile
         self.pairs = []
 
     def _save_raster(self, data, profile, filename, folder):
@@ -47,47 +146,111 @@ class DatasetManagement:
         output_path = os.path.join(folder, filename)
         num_bands = 1 if len(data.shape) == 2 else data.shape[0]
         profile.update(count=num_bands)
-        with rasterio.open(output_path, 'w', **profile) as dst:
+        with rasterio.open(output_path, 'w', **cog_profile(profile, self.codec)) as dst:
             if num_bands == 1:
                 dst.write(data, 1)
             else:
                 for i in range(num_bands):
                     dst.write(data[i, :, :], i + 1)
+            add_overviews(dst, self.codec)
 
     ##########
     ## Crop radd_sen2 stack to 512 tile size
     ##########
 
-    def crop_to_tiles(self, image_path, output_folder):
+    def crop_to_tiles(self, image_path, output_folder, overlap=0, pad_edges=False, skip_empty=False, mask_band=1,
+                      workers=None):
+        """
+        Crops a stack into tile_size tiles named <stack>_<col>_<row>.tif. Existing tiles are skipped.
+
+        The defaults reproduce the original grid: no overlap, incomplete edge tiles dropped, every
+        tile written.
+
+        Args:
+            image_path (str): Stack to tile.
+            output_folder (str): Tile folder.
+            overlap (int): Pixels shared by neighbouring tiles (stride = tile_size - overlap).
+            pad_edges (bool): Also write the incomplete tiles along the right and bottom edges, padded
+                              with nodata (0 if the stack has none), so no border pixels are lost.
+            skip_empty (bool): Don't write tiles whose mask_band is fully masked (nodata or internal
+                               mask). Only the mask is read for those, so they cost no band reads.
+            mask_band (int): Band whose mask decides emptiness.
+            workers (int, optional): Process pool size; each worker crops whole rows of tiles.
+
+        Returns:
+            tuple: (tiles written, empty tiles skipped)
+        """
+        stride = self.tile_size - overlap
+        if stride <= 0:
+            raise ValueError(f"overlap {overlap} must be smaller than tile_size {self.tile_size}")
         with rasterio.open(image_path) as src:
-            for j in range(0, src.height, self.tile_size):
-                for i in range(0, src.width, self.tile_size):
-                    # Save each tile
-                    tile_filename = f"{os.path.splitext(os.path.basename(image_path))[0]}_{i}_{j}.tif"
-                    tile_path = os.path.join(output_folder, tile_filename)
-
-                    if os.path.exists(tile_path):
-                        continue
-
-                    window = Window(i, j, self.tile_size, self.tile_size)
-                    if src.height - j < self.tile_size or src.width - i < self.tile_size:
-                        continue  # Skip incomplete tiles at the edge
-
-                    tile = src.read(window=window)
-
-                    with rasterio.open(
-                            tile_path,
-                            'w',
-                            driver='GTiff',
-                            height=tile.shape[1],
-                            width=tile.shape[2],
-                            count=src.count,
-                            dtype=tile.dtype,
-                            crs=src.crs,
-                            transform=rasterio.windows.transform(window, src.transform)
-                    ) as tile_dst:
-                        tile_dst.write(tile)
-            src.close()
+            row_offs = _tile_offsets(src.height, self.tile_size, stride, pad_edges)
+            col_offs = _tile_offsets(src.width, self.tile_size, stride, pad_edges)
+
+        crop_row = partial(_crop_tile_row, image_path=image_path, output_folder=output_folder, col_offs=col_offs,
+                           tile_size=self.tile_size, skip_empty=skip_empty, mask_band=mask_band, codec=self.codec)
+        if not workers or workers <= 1:
+            counts = list(map(crop_row, row_offs))
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                counts = list(executor.map(crop_row, row_offs))
+        written = sum(c[0] for c in counts)
+        skipped = sum(c[1] for c in counts)
+        if skip_empty:
+            print(f"{os.path.basename(image_path)}: {written} tiles written, {skipped} empty tiles skipped")
+        return written, skipped
+
+    def crop_to_shards(self, image_paths, output_folder, shard_size=1024, prefix='tiles', nodata_value=-9999):
+        """
+        crop_to_tiles, split_tiles and alter_radd_data_to_label (steps 10, 12 and 13) in one pass,
+        packing the tiles into tar shards instead of one GeoTIFF per tile (see src/tile_shards.py).
+        Band 1 of each stack (RADD alerts) becomes the label, binarized with radd_labels against the
+        stack date so alerts after it are nodata_value; the other bands are the image. Edge windows
+        smaller than tile_size are skipped, as in crop_to_tiles.
+
+        Every tile's metadata (tile id, shard, source stack, window, date, MGRS tile, alert count,
+        CRS and transform) goes into the shard indexes and <output_folder>/index.json. Rewrites the
+        folder's shards; ShardDataset streams them for training and inference.
+
+        The shards are not yet:
+            - AGB filtered (filter_stacks_and_radd_by_AGB); mask image band 7 with class_mask at load
+              time if needed,
+            - normalized; scale at read time with a band scaling file (Loader.write_band_scaling),
+            - alert filtered (step 11) or split (step 14); pass min_alert_pixels to ShardDataset and
+              split on index.json (tile, date) instead.
+
+        Args:
+            image_paths (list): Stacks named <YYYYDDD>_<tile>_... or <tile>.<YYYYDDD>_..., to tile.
+            output_folder (str): Shard folder.
+            shard_size (int): Tiles per shard.
+            prefix (str): Shard file name prefix.
+            nodata_value (int): Label of alerts after the stack date.
+
+        Returns:
+            list: The combined index.
+        """
+        with ShardWriter(output_folder, prefix, shard_size) as writer:
+            for image_path in image_paths:
+                stack_name = os.path.splitext(os.path.basename(image_path))[0]
+                tile, date = stack_tile_date(image_path)
+                if not date.isdigit() or len(date) != 7:
+                    raise ValueError(f"No YYYYDDD date in {image_path}, needed to mask alerts after it in the labels")
+                reference = radd_yydoy(date)
+                with rasterio.open(image_path) as src:
+                    if not rasterio.dtypes.in_dtype_range(nodata_value, src.dtypes[0]):
+                        raise ValueError(f"nodata {nodata_value} does not fit the {src.dtypes[0]} alert band of {image_path}")
+                    for j in range(0, src.height - self.tile_size + 1, self.tile_size):
+                        for i in range(0, src.width - self.tile_size + 1, self.tile_size):
+                            window = Window(i, j, self.tile_size, self.tile_size)
+                            data = src.read(window=window)
+                            label = radd_labels(data[0], reference, nodata_value)
+                            writer.write(f"{stack_name}_{i}_{j}".replace('.', '_'), data[1:], label,
+                                         source=os.path.basename(image_path), window=[i, j, self.tile_size, self.tile_size],
+                                         date=date, tile=tile, alert_count=int(np.count_nonzero(label == 1)),
+                                         crs=src.crs.to_string() if src.crs else None,
+                                         transform=list(rasterio.windows.transform(window, src.transform))[:6])
+                print(f"sharded: {image_path}")
+        return writer.index
 
     ##########
     ## Split 512 tiles into radd and sen2 stacks
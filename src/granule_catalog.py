@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent catalog of downloaded HLS granule files, so pipeline stages can look band files up by
+sensor, MGRS tile, date and band instead of walking every tile_*/S30|L30 folder on each run.
+
+@Time    : 17/10/2026
+@Author  : Colm Keyes
+@Email   : keyesco@tcd.ie
+@File    : granule_catalog.py
+"""
+
+import os
+import sqlite3
+import threading
+
+
+def parse_hls_filename(filename):
+    """
+    Splits an HLS band file name into its components.
+
+    Args:
+        filename (str): e.g. 'HLS.S30.T49MDU.2023241T022549.v2.0.B02.tif'
+
+    Returns:
+        dict or None: sensor, tile, date (YYYYDDD), granule id and band, or None for non-HLS files.
+    """
+    parts = filename.split('.')
+    if len(parts) < 8 or parts[0] != 'HLS' or parts[-1] != 'tif':
+        return None
+    return {
+        'sensor': parts[1],              # 'S30' or 'L30'
+        'tile': parts[2],                # 'T49MDU'
+        'date': parts[3][:7],            # '2023241'
+        'granule': '.'.join(parts[:6]),  # 'HLS.S30.T49MDU.2023241T022549.v2.0'
+        'band': parts[6],                # 'B02', ..., 'Fmask'
+    }
+
+
+class GranuleCatalog:
+    """
+    SQLite index of HLS band files below a download root laid out as <root>/tile_*/<sensor>/*.tif.
+
+    Folders are only re-listed when their modification time changes, so an update after a download
+    costs one stat per sensor folder rather than a listing of every file.
+    """
+
+    COLUMNS = ('path', 'folder', 'granule', 'sensor', 'tile', 'date', 'band', 'size', 'mtime')
+
+    def __init__(self, root, db_path=None):
+        """
+        Args:
+            root (str): HLS download root containing the tile_* folders.
+            db_path (str, optional): Catalog file. Defaults to <root>/granule_catalog.sqlite.
+        """
+        self.root = root
+        self.db_path = db_path or os.path.join(root, 'granule_catalog.sqlite')
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        with self._conn:
+            self._conn.executescript("""
+                CREATE TABLE IF NOT EXISTS granules (
+                    path TEXT PRIMARY KEY,
+                    folder TEXT NOT NULL,
+                    granule TEXT NOT NULL,
+                    sensor TEXT NOT NULL,
+                    tile TEXT NOT NULL,
+                    date TEXT NOT NULL,
+                    band TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    mtime REAL NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS folders (
+                    folder TEXT PRIMARY KEY,
+                    mtime REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS idx_granules_lookup ON granules (sensor, tile, date, band);
+                CREATE INDEX IF NOT EXISTS idx_granules_band ON granules (band, sensor);
+                CREATE INDEX IF NOT EXISTS idx_granules_granule ON granules (granule);
+                CREATE INDEX IF NOT EXISTS idx_granules_folder ON granules (folder);
+            """)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._conn.close()
+
+    def sensor_folders(self):
+        """Lists the <root>/tile_*/<sensor> folders currently on disk."""
+        folders = []
+        if not os.path.exists(self.root):
+            return folders
+        for tile_entry in os.scandir(self.root):
+            if not tile_entry.is_dir() or not tile_entry.name.startswith('tile_'):
+                continue
+            for sensor_entry in os.scandir(tile_entry.path):
+                if sensor_entry.is_dir():
+                    folders.append(sensor_entry.path)
+        return sorted(folders)
+
+    def update(self, folders=None, force=False):
+        """
+        Brings the catalog up to date with the files on disk.
+
+        Only folders whose mtime changed since the last update are re-listed. Adding, removing or
+        renaming files updates a folder's mtime; files rewritten in place do not, use force=True
+        to pick those up.
+
+        Args:
+            folders (list, optional): Sensor folders to check. Defaults to all tile_*/<sensor> folders.
+            force (bool): Re-list folders even if their mtime is unchanged.
+
+        Returns:
+            int: Number of folders that were re-listed.
+        """
+        if folders is None:
+            folders = self.sensor_folders()
+
+        rescanned = 0
+        with self._lock, self._conn:
+            known = dict(self._conn.execute("SELECT folder, mtime FROM folders").fetchall())
+            for folder in folders:
+                folder = os.path.abspath(folder)
+                if not os.path.isdir(folder):
+                    self._conn.execute("DELETE FROM granules WHERE folder = ?", (folder,))
+                    self._conn.execute("DELETE FROM folders WHERE folder = ?", (folder,))
+                    continue
+
+                folder_mtime = os.stat(folder).st_mtime
+                if not force and known.get(folder) == folder_mtime:
+                    continue
+
+                rows = []
+                for entry in os.scandir(folder):
+                    parsed = parse_hls_filename(entry.name)
+                    if parsed is None or not entry.is_file():
+                        continue
+                    stat = entry.stat()
+                    rows.append((entry.path, folder, parsed['granule'], parsed['sensor'], parsed['tile'],
+                                 parsed['date'], parsed['band'], stat.st_size, stat.st_mtime))
+
+                self._conn.execute("DELETE FROM granules WHERE folder = ?", (folder,))
+                self._conn.executemany(
+                    f"INSERT OR REPLACE INTO granules ({', '.join(self.COLUMNS)}) VALUES ({', '.join('?' * len(self.COLUMNS))})",
+                    rows)
+                self._conn.execute("INSERT OR REPLACE INTO folders (folder, mtime) VALUES (?, ?)",
+                                   (folder, folder_mtime))
+                rescanned += 1
+
+        print(f"Granule catalog updated: {rescanned}/{len(folders)} folders re-listed")
+        return rescanned
+
+    def query(self, sensor=None, tile=None, date=None, band=None):
+        """
+        Looks up catalogued band files. Each filter takes a single value or a list of values.
+
+        Args:
+            sensor (str or list, optional): 'S30' and/or 'L30'.
+            tile (str or list, optional): MGRS tile ids, e.g. 'T49MDU'.
+            date (str, list or tuple, optional): YYYYDDD date(s). A (start, end) tuple selects an
+                                                 inclusive date range.
+            band (str or list, optional): Band names, e.g. 'B02' or 'Fmask'.
+
+        Returns:
+            list: One dict per file with the catalog columns, ordered by sensor, tile, date, band.
+        """
+        clauses, params = [], []
+        for column, value in (('sensor', sensor), ('tile', tile), ('band', band)):
+            if value is None:
+                continue
+            values = [value] if isinstance(value, str) else list(value)
+            clauses.append(f"{column} IN ({', '.join('?' * len(values))})")
+            params.extend(values)
+
+        if isinstance(date, tuple):
+            clauses.append("date BETWEEN ? AND ?")
+            params.extend(date)
+        elif date is not None:
+            values = [date] if isinstance(date, str) else list(date)
+            clauses.append(f"date IN ({', '.join('?' * len(values))})")
+            params.extend(values)
+
+        sql = f"SELECT {', '.join(self.COLUMNS)} FROM granules"
+        if clauses:
+            sql += " WHERE " + " AND ".join(clauses)
+        sql += " ORDER BY sensor, tile, date, band, path"
+
+        with self._lock:
+            return [dict(row) for row in self._conn.execute(sql, params).fetchall()]
+
+    def tile_date_files(self, sensor, bands):
+        """
+        Groups band files by tile-date, in the same shape prep.write_hls_rasterio_stack uses.
+
+        Returns:
+            dict: {'T49MDU.2023241': {'B02': path, ...}, ...}
+        """
+        tile_date_files = {}
+        for row in self.query(sensor=sensor, band=bands):
+            tile_date_files.setdefault(f"{row['tile']}.{row['date']}", {})[row['band']] = row['path']
+        return tile_date_files
+
+    def has_granule(self, granule):
+        """Returns True if any band file of the granule (e.g. 'HLS.S30.T49MDU.2023241T022549.v2.0') is catalogued."""
+        with self._lock:
+            return self._conn.execute("SELECT 1 FROM granules WHERE granule = ? LIMIT 1",
+                                      (granule,)).fetchone() is not None
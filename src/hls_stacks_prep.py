@@ -56,6 +56,21 @@ from shapely.ops import transform as shapely_transform
 from osgeo import gdal
 from osgeo_utils import gdal_merge as gm
 import glob
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+import shutil
+from contextlib import contextmanager
+from rasterio.vrt import WarpedVRT
+from rasterio.windows import Window
+from rasterio.warp import transform_bounds
+from rasterio.transform import array_bounds
+from shapely.strtree import STRtree
+from src.class_masks import bit_mask, class_mask
+from src.datacube import export_stacks_to_cubes
+from src.output_profiles import cog_profile, cog_creation_options, add_overviews, overview_factors
 
 
 warnings.simplefilter(action='ignore', category=FutureWarning)
@@ -67,12 +82,230 @@ pd.set_option('display.max_rows', 500)
 pd.set_option('display.max_columns', 500)
 pd.set_option('display.width', 1000)
 
+# Band stacks are either materialised GeoTIFFs or VRTs referencing the original HLS band files
+STACK_SUFFIXES = ('_stack.tif', '_stack.vrt')
+
+# Bit positions of the HLS v2.0 Fmask QA band
+FMASK_BITS = {'cirrus': 0, 'cloud': 1, 'adjacent_cloud': 2, 'shadow': 3, 'snow': 4, 'water': 5}
+
+# Common band order of harmonized S30 + L30 stacks (S30 names, see prep.band_mapping)
+HARMONIZED_BANDS = ['B02', 'B03', 'B04', 'B8A', 'B11', 'B12']
+
+# UTM zones covering Borneo, as (EPSG code, lon min, lon max, lat min, lat max) of the zone over the island
+UTM_ZONES = {
+    '49N': ('EPSG:32649', 108.0, 114.0, 0.0, 84.0),
+    '49S': ('EPSG:32749', 108.0, 114.0, -80.0, 0.0),
+    '50N': ('EPSG:32650', 114.0, 120.0, 0.0, 84.0),
+    '50S': ('EPSG:32750', 114.0, 120.0, -80.0, 0.0),
+}
+
+# Semaphore limiting concurrent stack writes (and so open GDAL datasets) in pool workers
+_open_datasets = None
+
+
+def _init_stack_worker(open_datasets):
+    global _open_datasets
+    _open_datasets = open_datasets
+
+
+def _budget_windows(width, height, block_height, row_bytes, budget_bytes):
+    """
+    Yield full-width row windows, aligned to the source block height, of at most budget_bytes each.
+    """
+    rows = (budget_bytes // max(row_bytes, 1)) // block_height * block_height
+    rows = max(block_height, rows)
+    for row_off in range(0, height, rows):
+        yield Window(0, row_off, width, min(rows, height - row_off))
+
+
+def fmask_bitmask(mask_classes):
+    """
+    OR of the Fmask bits for the given classes, e.g. ('cloud', 'shadow') -> 0b1010.
+    """
+    unknown = set(mask_classes) - set(FMASK_BITS)
+    if unknown:
+        raise ValueError(f"Invalid Fmask classes {sorted(unknown)}. Choose from {list(FMASK_BITS)}.")
+    bitmask = 0
+    for mask_class in mask_classes:
+        bitmask |= 1 << FMASK_BITS[mask_class]
+    return bitmask
+
+
+def cloud_fraction(fmask_path, mask_classes=('cloud', 'shadow'), decimation=1):
+    """
+    Fraction of valid Fmask pixels (not 255 fill) flagged with any of mask_classes, 1.0 if none are valid.
+
+    decimation > 1 reads every decimation-th pixel (nearest), from overviews where the file has them.
+    """
+    with rasterio.open(fmask_path) as fm:
+        out_shape = (max(1, fm.height // decimation), max(1, fm.width // decimation))
+        fmask_data = fm.read(1, out_shape=out_shape, resampling=Resampling.nearest)
+        fill = fm.nodata if fm.nodata is not None else 255
+    valid = fmask_data != fill
+    if not valid.any():
+        return 1.0
+    flagged = bit_mask(fmask_data, fmask_bitmask(mask_classes))
+    return float((flagged & valid).sum() / valid.sum())
+
+
+def _fits_dtype(value, dtype):
+    """True if value can be stored exactly in dtype, e.g. a nodata value in the output dtype."""
+    dtype = np.dtype(dtype)
+    if np.issubdtype(dtype, np.floating):
+        return True
+    info = np.iinfo(dtype)
+    return float(value).is_integer() and info.min <= value <= info.max
+
+
+@lru_cache(maxsize=None)
+def _cached_transformer(src_crs, dst_crs):
+    """pyproj Transformer between two CRS strings, built once per pair."""
+    return Transformer.from_crs(src_crs, dst_crs, always_xy=True)
+
+
+def _link_or_copy(src_path, dst_path):
+    """Hard link dst_path to src_path, copying instead where links aren't possible (other filesystem)."""
+    try:
+        os.link(src_path, dst_path)
+    except OSError:
+        shutil.copyfile(src_path, dst_path)
+
+
+@contextmanager
+def _open_on_grid(path, crs, transform, width, height, resampling=Resampling.nearest):
+    """
+    Open a raster for reading on a target grid. Rasters already on the grid are returned as is,
+    anything else is resampled on the fly through a WarpedVRT instead of a warped copy on disk.
+    """
+    with rasterio.open(path) as src:
+        if src.crs == crs and src.transform == transform and (src.width, src.height) == (width, height):
+            yield src
+        else:
+            with WarpedVRT(src, crs=crs, transform=transform, width=width, height=height,
+                           resampling=resampling) as vrt:
+                yield vrt
+
+
+def _write_vrt_stack(files, stack_file_path):
+    """
+    Write a VRT stack with one band per source file, referencing the band files instead of copying them.
+    """
+    vrt = gdal.BuildVRT(stack_file_path, [os.path.abspath(f) for f in files], separate=True)
+    if vrt is None:
+        raise RuntimeError(f"Could not build VRT stack {stack_file_path}")
+    vrt.FlushCache()
+    vrt = None  # close dataset so the VRT is written
+
+
+def _write_band_stack(files, stack_file_path, block_budget_mb=None, output_format='GTiff', codec='auto'):
+    """
+    Stack single-band rasters into one multi-band GeoTIFF or VRT.
+
+    Args:
+        files (list): Band file paths in stack order.
+        stack_file_path (str): Output stack path.
+        block_budget_mb (float, optional): When set, bands are streamed window by window so at most
+                                           this many MB of pixels (and GDAL block cache) are held
+                                           at once. None reads each band in full.
+        output_format (str): 'GTiff' copies the bands into the stack, 'VRT' references them.
+        codec (str or None): Output compression, see output_profiles.cog_profile. None keeps the
+                             band files' own layout.
+    """
+    if output_format == 'VRT':
+        _write_vrt_stack(files, stack_file_path)
+        return
+
+    # Read metadata of first file
+    with rasterio.open(files[0]) as src0:
+        meta = src0.meta
+        block_height, block_width = src0.block_shapes[0]
+
+    # Update meta to reflect the number of layers
+    meta.update(count=len(files))
+    meta = cog_profile(meta, codec)
+
+    if block_budget_mb is None:
+        with rasterio.open(stack_file_path, 'w', **meta) as dst:
+            for id, layer in enumerate(files, start=1):
+                with rasterio.open(layer) as src1:
+                    dst.write_band(id, src1.read(1))
+            add_overviews(dst, codec)
+        return
+
+    if codec is not None:
+        # Align windows to the output tiles so every window write lands on whole blocks
+        block_height = meta['blockysize']
+    elif block_width % 16 == 0 and block_height % 16 == 0 and block_width < meta['width']:
+        # Tile the output like the source so every window write lands on whole blocks
+        meta.update(tiled=True, blockxsize=block_width, blockysize=block_height)
+
+    budget_bytes = int(block_budget_mb * 1024 * 1024)
+    row_bytes = meta['width'] * np.dtype(meta['dtype']).itemsize
+    with rasterio.Env(GDAL_CACHEMAX=max(1, int(block_budget_mb))):
+        with rasterio.open(stack_file_path, 'w', **meta) as dst:
+            for id, layer in enumerate(files, start=1):
+                with rasterio.open(layer) as src1:
+                    for window in _budget_windows(meta['width'], meta['height'], block_height, row_bytes, budget_bytes):
+                        dst.write(src1.read(1, window=window), id, window=window)
+            add_overviews(dst, codec)
+
+
+def _write_stack_job(job):
+    """
+    Write one tile-date stack. Module level so it can be pickled into a process pool.
+
+    Args:
+        job (tuple): (band file paths in stack order, output stack path, job number, total jobs,
+                     keyword options for _write_band_stack).
+    """
+    files, stack_file_path, position, total, options = job
+
+    # Another worker or an earlier run may have produced the stack since the job list was built
+    if os.path.exists(stack_file_path):
+        print(f"[{os.getpid()}] {position}/{total} File {os.path.basename(stack_file_path)} already exists. Skipping creation.")
+        return stack_file_path
+
+    if _open_datasets is not None:
+        _open_datasets.acquire()
+    try:
+        _write_band_stack(files, stack_file_path, **options)
+    finally:
+        if _open_datasets is not None:
+            _open_datasets.release()
+
+    print(f"[{os.getpid()}] {position}/{total} File {os.path.basename(stack_file_path)} created in folder {os.path.dirname(stack_file_path)}")
+    return stack_file_path
+
+
+def _run_stack_jobs(jobs, options, workers=None, max_open_datasets=None):
+    """
+    Writes (band files, stack path) jobs sequentially or on a process pool, see write_hls_rasterio_stack.
+    """
+    jobs = [(files, path, i, len(jobs), options) for i, (files, path) in enumerate(jobs, start=1)]
+
+    if not workers or workers <= 1:
+        for job in jobs:
+            _write_stack_job(job)
+        return
+
+    # Each stack write holds two datasets open, so halve the cap to get the number of permits
+    open_datasets = None
+    if max_open_datasets:
+        open_datasets = multiprocessing.BoundedSemaphore(max(1, max_open_datasets // 2))
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_stack_worker,
+                             initargs=(open_datasets,)) as executor:
+        # map() yields in submission order, so failures surface deterministically
+        for _ in executor.map(_write_stack_job, jobs):
+            pass
+
+
 class prep:
     """
     A class for processing Sentinel-2 imagery data in preperation for assimilation by the Prithvi-100m model.
     """
 
-    def __init__(self, sentinel2_path, stack_path_list, bands, radd_alert_path, land_cover_path, shp=None, sensor_type='S30'):
+    def __init__(self, sentinel2_path, stack_path_list, bands, radd_alert_path, land_cover_path, shp=None, sensor_type='S30', catalog=None, codec='auto'):
         """
         Args:
             path (list): List of file paths to HLS imagery.
@@ -82,9 +315,14 @@ class prep:
                          For L30: ['B02', 'B03', 'B04', 'B05', 'B06', 'B07']
             shp (geopandas.GeoDataFrame, optional): GeoDataFrame containing study area polygon.
             sensor_type (str): Either 'S30' (Sentinel-2) or 'L30' (Landsat-8/9)
+            catalog (GranuleCatalog, optional): Granule catalog over sentinel2_path. When given, band
+                                                files are looked up in it instead of walking the tile folders.
+            codec (str or None): Compression for every raster written, see output_profiles.cog_profile
+                                 ('auto', 'ZSTD', 'DEFLATE', 'LERC', ...). None copies source profiles as-is.
 
         Attributes:
-            cube (None or xarray.DataArray): Multi-dimensional, named array for storing data.
+            cube (None or dict): {tile: datacube.TileCube} after export_cube, one (time, band, y, x)
+                                 Zarr cube per MGRS tile.
         """
 
         # Initialize class variables
@@ -94,6 +332,8 @@ class prep:
         self.shp = shp
         self.cube = None
         self.sensor_type = sensor_type
+        self.catalog = catalog
+        self.codec = codec
 
         # Band mapping between L30 and S30
         self.band_mapping = {
@@ -109,14 +349,69 @@ class prep:
         # Initialize a list to store titles of processed files (optional)
         self.titles = []
 
+        # Hansen lossyear footprint indexes per folder, and loss-year rasters already warped onto a
+        # stack grid, most recently used last
+        self._hansen_indexes = {}
+        self._loss_year_cache = OrderedDict()
+        self.loss_year_cache_size = 8
+
+        # Tile-level auxiliary crops made by crop_single_stack, {cache path: footprint key}
+        self._tile_crops = {}
+
     """"""""
     # Core Functionalities
     """"""""
 
-    def resample_radd_alerts(self, merged_radd_alerts):
+    def resample_radd_alerts(self, merged_radd_alerts, chunk_size=2048, workers=4, warp_mem_limit=256,
+                             utm_zones=False, zone_margin=0.5):
         """
         Resamples 'merged_radd_alerts.tif' to match the resolution of a Sentinel-2 image.
+
+        The output grid is warped in chunk_size x chunk_size windows on a thread pool, each thread
+        reading the mosaic through its own dataset handle, so memory stays bounded by the chunks in
+        flight rather than the whole mosaic.
+
+        Args:
+            merged_radd_alerts (str): RADD alert mosaic.
+            chunk_size (int): Output window size in pixels, rounded to the output block size.
+            workers (int): Threads warping chunks in parallel.
+            warp_mem_limit (int): GDAL warp memory limit per chunk, in MB.
+            utm_zones (bool): Write one output per UTM zone in UTM_ZONES instead of a single output in
+                              the first Sentinel-2 image's CRS, so stacks in every zone get a same-CRS
+                              crop.
+            zone_margin (float): Degrees added around each zone, HLS tiles reach past zone edges.
+
+        Returns:
+            str or dict: Output path, or {zone: output path} when utm_zones is True.
         """
+        # Manually set the desired output resolution (30m)
+        desired_resolution = (30.0, 30.0)
+
+        if utm_zones:
+            with rasterio.open(merged_radd_alerts) as merged_radd_dataset:
+                mosaic_bounds = transform_bounds(merged_radd_dataset.crs, 'EPSG:4326', *merged_radd_dataset.bounds)
+
+            resampled_radd_paths = {}
+            for zone, (zone_crs, lon_min, lon_max, lat_min, lat_max) in UTM_ZONES.items():
+                zone_box = box(lon_min - zone_margin, lat_min - zone_margin, lon_max + zone_margin, lat_max + zone_margin)
+                zone_extent = zone_box.intersection(box(*mosaic_bounds))
+                if zone_extent.is_empty or zone_extent.area == 0:
+                    print(f"RADD alerts don't reach UTM zone {zone}, skipping.")
+                    continue
+
+                # Calculate the zone's transform, snapped to whole 30m pixels
+                left, bottom, right, top = transform_bounds('EPSG:4326', zone_crs, *zone_extent.bounds)
+                left, top = np.floor(left / desired_resolution[0]) * desired_resolution[0], \
+                    np.ceil(top / desired_resolution[1]) * desired_resolution[1]
+                transform = Affine(desired_resolution[0], 0, left, 0, -desired_resolution[1], top)
+                width = int(np.ceil((right - left) / desired_resolution[0]))
+                height = int(np.ceil((top - bottom) / desired_resolution[1]))
+                resampled_radd_path = os.path.join(
+                    self.radd_alert_path, f'resampled_merged_radd_alerts_qgis_int16_compressed_30m_{zone}.tif')
+                self._warp_in_chunks(merged_radd_alerts, resampled_radd_path, zone_crs, transform, width, height,
+                                     chunk_size, workers, warp_mem_limit)
+                resampled_radd_paths[zone] = resampled_radd_path
+            return resampled_radd_paths
 
         # Use the first Sentinel-2 image to determine the target CRS
         sentinel_files = [f for f in os.listdir(self.sentinel2_path) if f.endswith('.tif')]
@@ -129,9 +424,6 @@ class prep:
 
         # Open the merged RADD alerts image
         with rasterio.open(merged_radd_alerts) as merged_radd_dataset:
-            # Manually set the desired output resolution (30m)
-            desired_resolution = (30.0, 30.0)
-
             # Calculate the new transform
             transform, width, height = calculate_default_transform(
                 merged_radd_dataset.crs, sentinel_crs,
@@ -140,102 +432,194 @@ class prep:
                 resolution=desired_resolution
             )
 
-            # Define metadata for the resampled dataset
-            out_meta = merged_radd_dataset.meta.copy()
-            out_meta.update({
-                "driver": "GTiff",
-                "height": height,
-                "width": width,
-                "transform": transform,
-                "crs": sentinel_crs,
-                "compress": "LZW",
-                "dtype": 'int16'
-            })
+        resampled_radd_path = os.path.join(self.radd_alert_path, 'resampled_merged_radd_alerts_qgis_int16_compressed_30m.tif')
+        self._warp_in_chunks(merged_radd_alerts, resampled_radd_path, sentinel_crs, transform, width, height,
+                             chunk_size, workers, warp_mem_limit)
+        return resampled_radd_path
 
-            # Perform the resampling
-            resampled_radd_path = os.path.join(self.radd_alert_path, 'resampled_merged_radd_alerts_qgis_int16_compressed_30m.tif')
-            with rasterio.open(resampled_radd_path, 'w', **out_meta) as dest:
-                for i in range(1, merged_radd_dataset.count + 1):
-                    reproject(
-                        source=rasterio.band(merged_radd_dataset, i),
-                        destination=rasterio.band(dest, i),
-                        src_transform=merged_radd_dataset.transform,
-                        src_crs=merged_radd_dataset.crs,
-                        dst_transform=transform,
-                        dst_crs=sentinel_crs,
-                        resampling=Resampling.nearest
-                    )
+    def _warp_in_chunks(self, src_path, dst_path, dst_crs, dst_transform, width, height, chunk_size=2048,
+                        workers=4, warp_mem_limit=256, resampling=Resampling.nearest):
+        """
+        Warps src_path onto a target grid as int16, chunk by chunk on a thread pool.
 
-        return resampled_radd_path
+        GDAL datasets can't be shared between threads, so every thread opens its own handle on the
+        source; writes to the output go through a lock. The output is always tiled (also with codec
+        None), since chunks finish in any order and a compressed striped file can't take that.
+        """
+        with rasterio.open(src_path) as src:
+            out_meta = src.meta.copy()
+        out_meta.update({
+            "driver": "GTiff",
+            "height": height,
+            "width": width,
+            "transform": dst_transform,
+            "crs": dst_crs,
+            "compress": "LZW",
+            "dtype": 'int16'
+        })
+        out_meta = cog_profile(out_meta, self.codec)
+        if not out_meta.get('tiled'):
+            block = min(512, 16 * -(-max(width, height) // 16))
+            out_meta.update(tiled=True, blockxsize=block, blockysize=block)
+        fill_value = out_meta['nodata'] if out_meta.get('nodata') is not None else 0
+
+        # Chunks are whole numbers of output blocks so threads never write to the same block
+        block = out_meta['blockxsize']
+        chunk_size = max(block, chunk_size // block * block)
+        windows = [Window(col_off, row_off, min(chunk_size, width - col_off), min(chunk_size, height - row_off))
+                   for row_off in range(0, height, chunk_size) for col_off in range(0, width, chunk_size)]
+
+        local = threading.local()
+        opened = []
+        write_lock = threading.Lock()
+
+        with rasterio.open(dst_path, 'w', **out_meta) as dest:
+            def warp_chunk(window):
+                if not hasattr(local, 'src'):
+                    local.src = rasterio.open(src_path)
+                    with write_lock:
+                        opened.append(local.src)
+                src = local.src
+
+                chunk = np.full((src.count, int(window.height), int(window.width)), fill_value, dtype=np.int16)
+                reproject(
+                    source=rasterio.band(src, list(range(1, src.count + 1))),
+                    destination=chunk,
+                    src_transform=src.transform,
+                    src_crs=src.crs,
+                    dst_transform=rasterio.windows.transform(window, dst_transform),
+                    dst_crs=dst_crs,
+                    dst_nodata=fill_value,
+                    resampling=resampling,
+                    num_threads=1,
+                    warp_mem_limit=warp_mem_limit
+                )
+                with write_lock:
+                    dest.write(chunk, window=window)
+
+            try:
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    # list() re-raises the first failed chunk here
+                    list(executor.map(warp_chunk, windows))
+            finally:
+                for src in opened:
+                    src.close()
+
+            add_overviews(dest, self.codec)
+
+        print(f"Resampled {src_path} to {dst_path} ({len(windows)} chunks)")
+        return dst_path
+
+    def crop_single_stack(self, sentinel_stack_path, single_image_path, output_path, radd_confidence=None):
+        """
+        Crops an auxiliary raster (RADD alerts, land cover) to the footprint of an HLS stack.
+
+        All dates of an MGRS tile share one footprint, so the crop is made once per (source raster,
+        footprint) into output_path/tile_cache and every date's output is a hard link to it (a copy
+        where links aren't possible). Don't open the outputs in r+ mode, that would edit every date.
 
-    def crop_single_stack(self, sentinel_stack_path, single_image_path, output_path):
+        radd_confidence keeps only RADD alerts of the given confidence classes in band 1 (e.g. (3,)
+        for highly certain alerts only, class_masks.RADD_HIGH_CONFIDENCE); other alerts become 0 in
+        every band. None keeps all alerts.
+        """
 
         ##############################
         ## AGB LAND CLASSIFICATION VERSION
         ##############################
-        with rasterio.open(sentinel_stack_path) as sentinel_stack, rasterio.open(single_image_path) as image_raster:
-            sentinel_bounds = sentinel_stack.bounds
-            sentinel_crs = sentinel_stack.crs
-            image_bounds = image_raster.bounds
-            image_crs = image_raster.crs
-
-            # Extract the relevant parts of the file name from the sentinel_stack_path
-            tile, date = os.path.basename(sentinel_stack_path).split('_')[0].split('.')
-            # date = os.path.basename(sentinel_stack_path).split('_')[0].split('.')
-
-            #identifier = f"{parts[0]}_{parts[1]}"
-
-            # Assuming the base name of the single_image_path is 'resampled_radd_alerts_int16_compressed.tif'
-            suffix = os.path.basename(single_image_path)
-
-            # Combine the identifier and suffix to form the output file name
-            output_file_name = f"{date}_{tile}_{suffix}"
-            output_file_path = os.path.join(output_path, output_file_name)
-
-            if os.path.exists(output_file_path):
-                print(f"File {output_file_path} already exists. Skipping cropping.")
-                return output_file_path # Skip the rest of the function
-
-
-            # Create transformers to WGS 84 (EPSG:4326)
-            transformer_to_wgs84_sentinel = Transformer.from_crs(sentinel_crs, 'EPSG:4326', always_xy=True)
-            transformer_to_wgs84_image = Transformer.from_crs(image_crs, 'EPSG:4326', always_xy=True)
+        with rasterio.open(sentinel_stack_path) as sentinel_stack:
+            sentinel_bounds = tuple(sentinel_stack.bounds)
+            sentinel_crs = sentinel_stack.crs.to_string()
+
+        # Extract the relevant parts of the file name from the sentinel_stack_path
+        tile, date = os.path.basename(sentinel_stack_path).split('_')[0].split('.')
+        # date = os.path.basename(sentinel_stack_path).split('_')[0].split('.')
+
+        #identifier = f"{parts[0]}_{parts[1]}"
+
+        # Assuming the base name of the single_image_path is 'resampled_radd_alerts_int16_compressed.tif'
+        suffix = os.path.basename(single_image_path)
+
+        # Combine the identifier and suffix to form the output file name
+        output_file_name = f"{date}_{tile}_{suffix}"
+        output_file_path = os.path.join(output_path, output_file_name)
+
+        if os.path.exists(output_file_path):
+            print(f"File {output_file_path} already exists. Skipping cropping.")
+            return output_file_path # Skip the rest of the function
+
+        cache_dir = os.path.join(output_path, 'tile_cache')
+        cached_path = os.path.join(cache_dir, f"{tile}_{suffix}")
+        footprint_key = {'source': os.path.abspath(single_image_path),
+                         'source_mtime': str(os.path.getmtime(single_image_path)),
+                         'footprint_crs': sentinel_crs,
+                         'footprint_bounds': json.dumps(sentinel_bounds),
+                         'radd_confidence': 'all' if radd_confidence is None else json.dumps(sorted(radd_confidence))}
+
+        if not self._tile_crop_is_current(cached_path, footprint_key):
+            os.makedirs(cache_dir, exist_ok=True)
+            # Unlink a stale crop rather than overwriting it, earlier outputs may be hard links to it
+            if os.path.exists(cached_path):
+                os.remove(cached_path)
+            if self._crop_to_footprint(sentinel_bounds, sentinel_crs, single_image_path, cached_path,
+                                       footprint_key, radd_confidence) is None:
+                return  # Optionally skip further processing
 
-            # Define the functions for coordinate transformation
-            def transform_to_wgs84_sentinel(x, y):
-                return transformer_to_wgs84_sentinel.transform(x, y)
+        _link_or_copy(cached_path, output_file_path)
+        print(f"written {output_file_path}")
+        return output_file_path
+
+    def _tile_crop_is_current(self, cached_path, footprint_key):
+        """True if cached_path exists and was cropped from the same source and footprint."""
+        if cached_path in self._tile_crops:
+            return self._tile_crops[cached_path] == footprint_key
+        if not os.path.exists(cached_path):
+            return False
+        with rasterio.open(cached_path) as cached:
+            tags = cached.tags(ns='tile_cache')
+        if all(tags.get(key) == value for key, value in footprint_key.items()):
+            self._tile_crops[cached_path] = footprint_key
+            return True
+        return False
+
+    def _crop_to_footprint(self, sentinel_bounds, sentinel_crs, single_image_path, output_file_path, footprint_key,
+                           radd_confidence=None):
+        """
+        Masks single_image_path to a stack footprint (through WGS 84) and writes the crop, tagged with
+        footprint_key so later runs can tell whether it is still current.
+        """
+        with rasterio.open(single_image_path) as image_raster:
+            image_bounds = image_raster.bounds
+            image_crs = image_raster.crs.to_string()
 
-            def transform_to_wgs84_image(x, y):
-                return transformer_to_wgs84_image.transform(x, y)
+            # Transformers to and from WGS 84 (EPSG:4326) are shared by every stack with the same CRS
+            transformer_to_wgs84_sentinel = _cached_transformer(sentinel_crs, 'EPSG:4326')
+            transformer_to_wgs84_image = _cached_transformer(image_crs, 'EPSG:4326')
 
             # Transform sentinel bounds and image bounds to WGS 84
-            sentinel_box_wgs84 = shapely_transform(transform_to_wgs84_sentinel, box(*sentinel_bounds))
-            image_box_wgs84 = shapely_transform(transform_to_wgs84_image, box(image_bounds.left, image_bounds.bottom, image_bounds.right, image_bounds.top))
+            sentinel_box_wgs84 = shapely_transform(transformer_to_wgs84_sentinel.transform, box(*sentinel_bounds))
+            image_box_wgs84 = shapely_transform(transformer_to_wgs84_image.transform, box(image_bounds.left, image_bounds.bottom, image_bounds.right, image_bounds.top))
 
             if not sentinel_box_wgs84.intersects(image_box_wgs84):
                 print("doesn't intersect in WGS 84")
-                return  # Optionally skip further processing
-
-            transformer_to_image_crs = Transformer.from_crs('EPSG:4326', image_crs, always_xy=True)
+                return None
 
-            def transform_to_image_crs(x, y):
-                return transformer_to_image_crs.transform(x, y)
+            transformer_to_image_crs = _cached_transformer('EPSG:4326', image_crs)
 
             # Transform sentinel_box_wgs84 back to the image raster's CRS
-            sentinel_box_image_crs = shapely_transform(transform_to_image_crs, sentinel_box_wgs84)
+            sentinel_box_image_crs = shapely_transform(transformer_to_image_crs.transform, sentinel_box_wgs84)
 
             # Now sentinel_box_image_crs is in the same CRS as the image raster
             # Proceed with masking using sentinel_box_image_crs
             image_cropped, transform = mask(image_raster, [sentinel_box_image_crs], crop=True, filled=False, pad=False, nodata=0)
 
-            # Mask or clip the image raster to the area of the Sentinel-2 stack, specifying the nodata value and transform
-            #mage_cropped, transform = mask(image_raster, [sentinel_box_wgs84], crop=True, filled=False, pad=False, nodata=0)
-
             ########
             ## Radd alerts contain values 2 and 3. 2 for uncertain events, 3 for hihgly certain events. we choose only certain events.
             ## We will see the difference in values between 2 and 3 only in radd alerts this time.
             ########
             # image_cropped.mask[0] = (image_cropped.data[0] != 3)
+            if radd_confidence is not None:
+                dropped = ~class_mask(image_cropped.data[0], radd_confidence)
+                image_cropped.data[:, dropped] = 0
 
             # Update the profile for the cropped image
             output_profile = image_raster.profile.copy()
@@ -245,20 +629,38 @@ class prep:
                 'transform': transform,
                 'count' : image_cropped.shape[0]  #1 ##is 1 for a single band crop
             })
-
-
-
+            output_profile = cog_profile(output_profile, self.codec)
 
             with rasterio.open(output_file_path, 'w', **output_profile) as dest:
                 dest.write(image_cropped[0], 1)
                 dest.write(image_cropped[1], 2)
+                dest.update_tags(ns='tile_cache', **footprint_key)
+                add_overviews(dest, self.codec)
                 print(f"written {output_file_path}")
-            return output_file_path
 
-    def write_hls_rasterio_stack(self):
+        self._tile_crops[output_file_path] = footprint_key
+        return output_file_path
+
+    def _collect_tile_date_files(self, bands=None, sensor_type=None):
         """
-        Write folder of HLS GeoTIFFs (either L30 or S30) to a GeoTIFF stack file.
+        Scan the tile_*/<sensor> folders and group band files by tile-date.
+
+        Args:
+            bands (list, optional): Bands to collect, e.g. self.bands + ['Fmask']. Defaults to self.bands.
+            sensor_type (str, optional): 'S30' or 'L30'. Defaults to self.sensor_type.
+
+        Returns:
+            dict: {'T49MDU.2023241': {'B02': path, ...}, ...}
         """
+        if bands is None:
+            bands = self.bands
+        if sensor_type is None:
+            sensor_type = self.sensor_type
+
+        if self.catalog is not None:
+            self.catalog.update()
+            return self.catalog.tile_date_files(sensor_type, bands)
+
         # Create a dictionary to hold file paths for each tile-date combination
         tile_date_files = {}
 
@@ -278,15 +680,15 @@ class prep:
             #     tile_path = os.path.join(tile_path, 'L30')
 
             # Look for sensor-specific folder within each tile
-            sensor_path = os.path.join(tile_path, self.sensor_type)
+            sensor_path = os.path.join(tile_path, sensor_type)
             print(f"Assessing {sensor_path}...")
             if not os.path.exists(sensor_path):
-                print(f"No {self.sensor_type} data found in {tile_path}")
+                print(f"No {sensor_type} data found in {tile_path}")
                 continue
                 
             # Ensure the sensor path exists and contains data
             if not os.listdir(sensor_path):
-                print(f"Empty {self.sensor_type} folder in {tile_path}")
+                print(f"Empty {sensor_type} folder in {tile_path}")
                 continue
                 
             # Collect all band files into the dictionary
@@ -294,12 +696,12 @@ class prep:
                 if file.endswith('.tif'):
                     # Extract relevant parts based on sensor type
                     parts = file.split('.')
-                    if self.sensor_type == 'S30':
+                    if sensor_type == 'S30':
                         # S30 format: HLS.S30.T{tile}.{date}T{time}.v2.0.B{band}.tif
                         if len(parts) >= 6 and parts[0] == 'HLS' and parts[1] == 'S30':
                             tile_date_key = f'{parts[2]}.{parts[3][:7]}'  # Tile and Date
                             band = parts[6]  # Extract band number from 'B02' etc
-                    elif self.sensor_type == 'L30':
+                    elif sensor_type == 'L30':
                         # L30 format: HLS.L30.T{tile}.{date}T{time}.v2.0.B{band}.tif
                         if len(parts) >= 6 and parts[0] == 'HLS' and parts[1] == 'L30':
                             tile_date_key = f'{parts[2]}.{parts[3][:7]}'  # Tile and Date
@@ -308,13 +710,111 @@ class prep:
                         continue
 
                     # Only process if band is in our target bands
-                    if f'{band}' in self.bands:
+                    if f'{band}' in bands:
                         if tile_date_key not in tile_date_files:
                             tile_date_files[tile_date_key] = {}
                         tile_date_files[tile_date_key][f'{band}'] = os.path.join(sensor_path, file)
 
-        # Process each tile-date set of files
-        for tile_date, band_files in tile_date_files.items():
+        return tile_date_files
+
+    def prescreen_cloud_fraction(self, sensor_type=None, mask_classes=('cloud', 'shadow'), decimation=4,
+                                 index_path=None, tile_dates=None):
+        """
+        Cloud/shadow fraction of every tile-date from its Fmask alone, before any stacking.
+
+        Fmasks are read decimated (from overviews where present) and the results kept in a JSON
+        sidecar index, {Fmask path: entry}, so each Fmask is only read again when it changes or is
+        screened with different mask_classes or decimation.
+
+        Args:
+            sensor_type (str, optional): 'S30' or 'L30'. Defaults to self.sensor_type.
+            mask_classes (tuple): Fmask classes counted as cloudy, see apply_fmask.
+            decimation (int): Read every decimation-th Fmask pixel.
+            index_path (str, optional): Sidecar index. Defaults to <sentinel2_path>/cloud_fraction_index.json.
+            tile_dates (iterable, optional): Only screen these tile-dates, e.g. {'T49MDU.2023241'}.
+
+        Returns:
+            dict: {'T49MDU.2023241': cloud fraction, ...}
+        """
+        if sensor_type is None:
+            sensor_type = self.sensor_type
+        if index_path is None:
+            index_path = os.path.join(self.sentinel2_path, 'cloud_fraction_index.json')
+
+        index = {}
+        if os.path.exists(index_path):
+            with open(index_path) as f:
+                index = json.load(f)
+
+        rule = f"{'+'.join(sorted(mask_classes))}@{decimation}"
+        fractions = {}
+        screened = 0
+        for tile_date, files in sorted(self._collect_tile_date_files(['Fmask'], sensor_type).items()):
+            if tile_dates is not None and tile_date not in tile_dates:
+                continue
+            fmask_path = files['Fmask']
+            mtime = os.path.getmtime(fmask_path)
+            entry = index.get(fmask_path)
+            if entry is None or entry['mtime'] != mtime or entry['rule'] != rule:
+                entry = {'tile_date': tile_date, 'sensor': sensor_type, 'mtime': mtime, 'rule': rule,
+                         'cloud_fraction': cloud_fraction(fmask_path, mask_classes, decimation)}
+                index[fmask_path] = entry
+                screened += 1
+            fractions[tile_date] = entry['cloud_fraction']
+
+        if screened:
+            # Write to a temporary file first so an interrupted run never leaves a truncated index
+            os.makedirs(os.path.dirname(os.path.abspath(index_path)), exist_ok=True)
+            with open(index_path + '.tmp', 'w') as f:
+                json.dump(index, f, indent=1)
+            os.replace(index_path + '.tmp', index_path)
+        print(f"Cloud prescreen ({sensor_type}): {screened} Fmasks read, {len(fractions) - screened} from {index_path}")
+        return fractions
+
+    def write_hls_rasterio_stack(self, workers=None, max_open_datasets=None, block_budget_mb=None, output_format='GTiff',
+                                 max_cloud_fraction=None):
+        """
+        Write folder of HLS GeoTIFFs (either L30 or S30) to a GeoTIFF stack file.
+
+        Args:
+            workers (int, optional): Number of processes writing stacks in parallel. None or 1 writes
+                                     sequentially in this process.
+            max_open_datasets (int, optional): Cap on GDAL datasets held open at once across the pool.
+                                               Each stack write holds two (the output and the band
+                                               being copied), so this allows max_open_datasets // 2
+                                               concurrent writes.
+            block_budget_mb (float, optional): Stream each band in block-aligned windows of at most
+                                               this many MB instead of reading whole bands, bounding
+                                               per-worker memory independent of tile size.
+            output_format (str): 'GTiff' writes {tile_date}_{sensor}_stack.tif copies of the bands.
+                                 'VRT' writes {tile_date}_{sensor}_stack.vrt files that reference
+                                 the original band files, which is near-instant and uses no extra disk.
+            max_cloud_fraction (float, optional): Skip tile-dates whose Fmask cloud/shadow fraction
+                                                  (see prescreen_cloud_fraction) is above this.
+        """
+        if output_format not in ('GTiff', 'VRT'):
+            raise ValueError("Invalid output format specified. Choose 'GTiff' or 'VRT'.")
+        stack_suffix = '_stack.vrt' if output_format == 'VRT' else '_stack.tif'
+
+        tile_date_files = self._collect_tile_date_files()
+        if max_cloud_fraction is not None:
+            cloud_fractions = self.prescreen_cloud_fraction()
+            cloudy = [tile_date for tile_date in tile_date_files
+                      if cloud_fractions.get(tile_date, 0.0) > max_cloud_fraction]
+            for tile_date in cloudy:
+                del tile_date_files[tile_date]
+            print(f"Skipping {len(cloudy)} tile-dates with cloud fraction above {max_cloud_fraction}")
+
+        stack_dir = 'bin/data_preprocessing_hls/data/hls/stacks'
+        os.makedirs(stack_dir, exist_ok=True)
+
+        # Ensure output directory exists
+        os.makedirs(self.stack_path_list, exist_ok=True)
+
+        # Build the job list in sorted tile-date order so runs are deterministic
+        jobs = []
+        for tile_date in sorted(tile_date_files):
+            band_files = tile_date_files[tile_date]
             # Skip if not all bands are present
             if len(band_files) != len(self.bands):
                 print(f"Skipping {tile_date} - missing bands (have {len(band_files)}, need {len(self.bands)})")
@@ -323,34 +823,98 @@ class prep:
             # Sort files according to band order specified in self.bands
             files = [band_files[band] for band in self.bands]
 
-            # Read metadata of first file
-            with rasterio.open(files[0]) as src0:
-                meta = src0.meta
-
-            # Update meta to reflect the number of layers
-            meta.update(count=len(files))
-
-            stack_dir = 'bin/data_preprocessing_hls/data/hls/stacks'
-            os.makedirs(stack_dir, exist_ok=True)
-
-            # Ensure output directory exists
-            os.makedirs(self.stack_path_list, exist_ok=True)
-            
-            # Write the stack
-            stack_file_path = os.path.join(self.stack_path_list, f'{tile_date}_{self.sensor_type}_stack.tif')
+            stack_file_path = os.path.join(self.stack_path_list, f'{tile_date}_{self.sensor_type}{stack_suffix}')
             if os.path.exists(stack_file_path):
                 print(
                     f"File {os.path.basename(stack_file_path)} already exists in folder {self.stack_path_list}. Skipping creation.")
+                continue
+            jobs.append((files, stack_file_path))
+
+        options = {'block_budget_mb': block_budget_mb, 'output_format': output_format, 'codec': self.codec}
+        _run_stack_jobs(jobs, options, workers, max_open_datasets)
+
+    def write_harmonized_stacks(self, workers=None, max_open_datasets=None, block_budget_mb=None,
+                                output_format='GTiff', mask_classes=('cloud', 'shadow'), max_cloud_fraction=None):
+        """
+        Writes one stack per tile-date from S30 and L30 together, in a common band order.
+
+        L30 bands are renamed to their S30 equivalents through self.band_mapping, giving the order
+        HARMONIZED_BANDS (B02, B03, B04, B8A, B11, B12; narrow NIR B8A matches L30 B05). When both
+        sensors observed a tile on the same day only the one with the lower Fmask cloud fraction is
+        stacked (S30 on ties), written as {tile_date}_{sensor}_stack.tif like write_hls_rasterio_stack,
+        so every later step processes each observation once. Fmasks are only screened for those
+        tile-dates, or for all of them with max_cloud_fraction.
+
+        Args:
+            workers, max_open_datasets, block_budget_mb, output_format: As in write_hls_rasterio_stack.
+            mask_classes (tuple): Fmask classes counted as cloudy, see apply_fmask.
+            max_cloud_fraction (float, optional): Skip tile-dates where even the chosen sensor is
+                                                  cloudier than this.
+
+        Returns:
+            dict: {tile_date: (chosen sensor, cloud fraction)} for the tile-dates that were stacked;
+                  the cloud fraction is None for unscreened single-sensor tile-dates.
+        """
+        if output_format not in ('GTiff', 'VRT'):
+            raise ValueError("Invalid output format specified. Choose 'GTiff' or 'VRT'.")
+        stack_suffix = '_stack.vrt' if output_format == 'VRT' else '_stack.tif'
+        os.makedirs(self.stack_path_list, exist_ok=True)
+
+        # Source band names, per sensor, in the harmonized order
+        sensor_bands = {}
+        for sensor_type, mapping in self.band_mapping.items():
+            to_source = {harmonized: source for source, harmonized in mapping.items()}
+            sensor_bands[sensor_type] = [to_source[band] for band in HARMONIZED_BANDS]
+
+        candidates = defaultdict(dict)
+        for sensor_type, bands in sensor_bands.items():
+            tile_date_files = self._collect_tile_date_files(bands + ['Fmask'], sensor_type)
+            for tile_date, band_files in tile_date_files.items():
+                if all(band in band_files for band in bands + ['Fmask']):
+                    candidates[tile_date][sensor_type] = band_files
+
+        pending = []
+        for tile_date in sorted(candidates):
+            existing = [sensor_type for sensor_type in sensor_bands if os.path.exists(
+                os.path.join(self.stack_path_list, f'{tile_date}_{sensor_type}{stack_suffix}'))]
+            if existing:
+                print(f"{tile_date} already stacked from {existing[0]}. Skipping creation.")
             else:
-                with rasterio.open(stack_file_path, 'w', **meta) as dst:
-                    for id, layer in enumerate(files, start=1):
-                        with rasterio.open(layer) as src1:
-                            dst.write_band(id, src1.read(1))
-                print(f"File {os.path.basename(stack_file_path)} created in folder {self.stack_path_list}")
+                pending.append(tile_date)
+
+        # Fmasks are only read where they decide something: both sensors observed, or a cloud limit
+        cloud_fractions = {}
+        for sensor_type in sensor_bands:
+            screen = {tile_date for tile_date in pending if sensor_type in candidates[tile_date]
+                      and (max_cloud_fraction is not None or len(candidates[tile_date]) > 1)}
+            cloud_fractions[sensor_type] = self.prescreen_cloud_fraction(sensor_type, mask_classes,
+                                                                         tile_dates=screen) if screen else {}
+
+        jobs, chosen = [], {}
+        for tile_date in pending:
+            # Lowest cloud fraction wins, S30 first on ties
+            fractions = {sensor_type: cloud_fractions[sensor_type].get(tile_date)
+                         for sensor_type in candidates[tile_date]}
+            sensor_type = min(fractions, key=lambda sensor: (fractions[sensor] or 0.0, sensor != 'S30'))
+            if max_cloud_fraction is not None and fractions[sensor_type] > max_cloud_fraction:
+                print(f"Skipping {tile_date} - cloud fraction {fractions[sensor_type]:.2f} above {max_cloud_fraction}")
+                continue
+            if len(fractions) > 1:
+                print(f"{tile_date}: both sensors observed, keeping {sensor_type} "
+                      f"(cloud fraction {', '.join(f'{k} {v:.2f}' for k, v in sorted(fractions.items()))})")
+            chosen[tile_date] = (sensor_type, fractions[sensor_type])
+
+            band_files = candidates[tile_date][sensor_type]
+            files = [band_files[band] for band in sensor_bands[sensor_type]]
+            jobs.append((files, os.path.join(self.stack_path_list, f'{tile_date}_{sensor_type}{stack_suffix}')))
+
+        options = {'block_budget_mb': block_budget_mb, 'output_format': output_format, 'codec': self.codec}
+        _run_stack_jobs(jobs, options, workers, max_open_datasets)
+        return chosen
 
     def merge_with_agb(self, agb_path, output_path):
         for sentinel_file in os.listdir(self.stack_path_list):
-            if sentinel_file.endswith('_stack.tif'):
+            if sentinel_file.endswith(STACK_SUFFIXES):
                 sentinel_stack_path = os.path.join(self.stack_path_list, sentinel_file)
 
                 # Extract components from filename (now includes sensor type)
@@ -379,64 +943,301 @@ class prep:
                     # Update the profile for the output file
                     output_profile = sentinel_stack.profile.copy()
                     output_profile.update(count=stacked_data.shape[0])
+                    output_profile = cog_profile(output_profile, self.codec)
 
                     # Write the stacked data to a new file with sensor type preserved
-                    output_file_name = sentinel_file.replace('_stack.tif', f'_{sensor}_agb_stack.tif')
+                    output_file_name = os.path.splitext(sentinel_file)[0].replace('_stack', f'_{sensor}_agb_stack.tif')
                     output_file_path = os.path.join(output_path, output_file_name)
                     with rasterio.open(output_file_path, 'w', **output_profile) as dst:
                         dst.write(stacked_data)
+                        add_overviews(dst, self.codec)
+
+    def _hansen_index(self, forest_loss_path):
+        """
+        Footprint index over the Hansen lossyear tiles in a folder, built once per folder.
+
+        Tile bounds are read from the file headers in WGS84 and kept in an STRtree, so a stack only
+        opens the (usually one or two) lossyear tiles it actually overlaps.
+
+        Returns:
+            tuple: (list of lossyear paths, STRtree of their footprints or None if there are none)
+        """
+        if forest_loss_path not in self._hansen_indexes:
+            paths, footprints = [], []
+            if os.path.exists(forest_loss_path):
+                for forest_loss_file in sorted(os.listdir(forest_loss_path)):
+                    if forest_loss_file.endswith(".tif") and 'lossyear' in forest_loss_file:
+                        forest_loss_file_path = os.path.join(forest_loss_path, forest_loss_file)
+                        with rasterio.open(forest_loss_file_path) as forest_loss:
+                            bounds = transform_bounds(forest_loss.crs, 'EPSG:4326', *forest_loss.bounds)
+                        paths.append(forest_loss_file_path)
+                        footprints.append(box(*bounds))
+            self._hansen_indexes[forest_loss_path] = (paths, STRtree(footprints) if footprints else None)
+        return self._hansen_indexes[forest_loss_path]
+
+    def loss_year_on_grid(self, forest_loss_path, crs, transform, width, height, cache_path=None):
+        """
+        Hansen loss year (years since 2000, 0 = no loss) warped onto a stack grid.
+
+        Only lossyear tiles whose footprint intersects the grid are warped. Results are cached in
+        memory per grid, so every date of the same MGRS tile reuses the first warp, and optionally on
+        disk at cache_path so later runs skip the warp too.
 
-    def forest_loss_mask(self, sentinel_stacks, forest_loss_path, output_path, reference_year=2021):
+        Args:
+            forest_loss_path (str): Folder with the Hansen lossyear GeoTIFFs.
+            crs, transform, width, height: Target grid, e.g. from the stack being masked.
+            cache_path (str, optional): GeoTIFF to read the warped loss year from, or write it to.
+
+        Returns:
+            tuple: (loss year array of shape (height, width), number of lossyear tiles warped)
+        """
+        key = (forest_loss_path, crs.to_string(), tuple(transform)[:6], width, height)
+        if key in self._loss_year_cache:
+            self._loss_year_cache.move_to_end(key)
+            return self._loss_year_cache[key]
+
+        loss_year = None
+        if cache_path and os.path.exists(cache_path):
+            with rasterio.open(cache_path) as cached:
+                if (cached.crs == crs and cached.transform == transform
+                        and (cached.width, cached.height) == (width, height)):
+                    loss_year = cached.read(1)
+                    n_warped = int(cached.tags().get('lossyear_tiles', 0))
+
+        if loss_year is None:
+            paths, index = self._hansen_index(forest_loss_path)
+            footprint = box(*transform_bounds(crs, 'EPSG:4326', *array_bounds(height, width, transform)))
+            candidates = sorted(index.query(footprint, predicate='intersects')) if index is not None else []
+
+            loss_year = np.zeros((height, width), dtype=np.uint8)
+            for i in candidates:
+                with rasterio.open(paths[i]) as forest_loss:
+                    warped = np.zeros((height, width), dtype=forest_loss.dtypes[0])
+                    reproject(
+                        source=rasterio.band(forest_loss, 1),
+                        destination=warped,
+                        src_transform=forest_loss.transform,
+                        src_crs=forest_loss.crs,
+                        dst_transform=transform,
+                        dst_crs=crs,
+                        resampling=Resampling.nearest)
+                # Hansen tiles don't overlap, so keeping the maximum just merges them
+                loss_year = np.maximum(loss_year, warped.astype(loss_year.dtype))
+            n_warped = len(candidates)
+
+            if cache_path:
+                os.makedirs(os.path.dirname(os.path.abspath(cache_path)), exist_ok=True)
+                cache_profile = cog_profile({'driver': 'GTiff', 'dtype': 'uint8', 'count': 1, 'width': width,
+                                             'height': height, 'crs': crs, 'transform': transform},
+                                            self.codec)
+                with rasterio.open(cache_path, 'w', **cache_profile) as dst:
+                    dst.write(loss_year, 1)
+                    dst.update_tags(lossyear_tiles=n_warped)
+
+        self._loss_year_cache[key] = (loss_year, n_warped)
+        while len(self._loss_year_cache) > self.loss_year_cache_size:
+            self._loss_year_cache.popitem(last=False)
+        return loss_year, n_warped
+
+    def forest_loss_mask(self, sentinel_stacks, forest_loss_path, output_path, reference_year=2021, cache_dir=None):
+        """
+        Sets pixels with Hansen forest loss before reference_year to nodata in every RADD stack.
+
+        Args:
+            sentinel_stacks (str): Folder with the *_radd_stack files.
+            forest_loss_path (str): Folder with the Hansen lossyear GeoTIFFs.
+            output_path (str): Folder for the *_forest_masked_stack.tif outputs.
+            reference_year (int): Loss from this year onwards is kept.
+            cache_dir (str, optional): Folder to keep one warped loss-year raster per MGRS tile in
+                                       between runs ({tile}_lossyear.tif).
+        """
         # Check if forest loss directory exists and has files
         # if not os.path.exists(forest_loss_path) or not os.listdir(forest_loss_path):
         #     print(f"No forest loss files found in {forest_loss_path}. Skipping forest loss masking.")
         #     return
 
-        for sentinel_file in os.listdir(sentinel_stacks):
-            output_file_name = sentinel_file.replace('_radd_stack.tif', '_forest_masked_stack.tif')
+        lossyear_paths, _ = self._hansen_index(forest_loss_path)
+
+        for sentinel_file in sorted(os.listdir(sentinel_stacks)):
+            output_file_name = os.path.splitext(sentinel_file)[0].replace('_radd_stack', '_forest_masked_stack.tif')
             output_file_path = os.path.join(output_path, output_file_name)
             if os.path.exists(output_file_path):
                 print(f"{output_file_name} already exists, skipping.")
                 continue
-            if sentinel_file.endswith('_radd_stack.tif'):
+            if sentinel_file.endswith(('_radd_stack.tif', '_radd_stack.vrt')):
                 sentinel_stack_path = os.path.join(sentinel_stacks, sentinel_file)
 
+                # Mask only when there are lossyear files to mask with
+                if not lossyear_paths:
+                    print(f"No valid forest loss files found for {sentinel_file}")
+                    continue
+
                 with rasterio.open(sentinel_stack_path) as sentinel_stack:
                     sentinel_data = sentinel_stack.read()
-                    sentinel_crs = sentinel_stack.crs
-                    output_profile = sentinel_stack.profile.copy()
 
-                    # Initialize mask tracking
-                    mask_applied = False
-
-                    for forest_loss_file in os.listdir(forest_loss_path):
-                        if forest_loss_file.endswith(".tif") and 'lossyear' in forest_loss_file:
-                            forest_loss_file_path = os.path.join(forest_loss_path, forest_loss_file)
-                            with rasterio.open(forest_loss_file_path) as forest_loss:
-                                forest_loss_data = np.zeros((1, sentinel_stack.height, sentinel_stack.width), dtype=rasterio.float32)
-                                reproject(
-                                    source=rasterio.band(forest_loss, 1),
-                                    destination=forest_loss_data[0],
-                                    src_transform=forest_loss.transform,
-                                    src_crs=forest_loss.crs,
-                                    dst_transform=sentinel_stack.transform,
-                                    dst_crs=sentinel_crs,
-                                    resampling=Resampling.nearest)
-
-                                # Apply forest loss mask
-                                current_year = reference_year - 2000
-                                mask_condition = (forest_loss_data[0] > 0) & (forest_loss_data[0] < current_year)
-                                sentinel_data[:, mask_condition] = sentinel_stack.nodata
-                                mask_applied = True
-
-                    if mask_applied:
-                        output_profile = sentinel_stack.profile.copy()
-
-                        with rasterio.open(output_file_path, 'w', **output_profile) as dst:
-                            dst.write(sentinel_data)
-                        print(f"Forest loss mask applied and saved to {output_file_path}")
-                    else:
-                        print(f"No valid forest loss files found for {sentinel_file}")
+                    # Stacks are named {date}_{tile}_..., all dates of a tile share one grid
+                    tile = sentinel_file.split('_')[1]
+                    cache_path = os.path.join(cache_dir, f"{tile}_lossyear.tif") if cache_dir else None
+                    loss_year, n_warped = self.loss_year_on_grid(
+                        forest_loss_path, sentinel_stack.crs, sentinel_stack.transform,
+                        sentinel_stack.width, sentinel_stack.height, cache_path)
+
+                    # Apply forest loss mask
+                    current_year = reference_year - 2000
+                    mask_condition = (loss_year > 0) & (loss_year < current_year)
+                    sentinel_data[:, mask_condition] = sentinel_stack.nodata
+
+                    output_profile = cog_profile(sentinel_stack.profile, self.codec)
+
+                    with rasterio.open(output_file_path, 'w', **output_profile) as dst:
+                        dst.write(sentinel_data)
+                        add_overviews(dst, self.codec)
+                    print(f"Forest loss mask applied ({n_warped} lossyear tiles) and saved to {output_file_path}")
+
+    def write_fused_stacks(self, radd_alerts_file, forest_loss_path, output_path, reference_year=2021,
+                           block_budget_mb=64, loss_year_cache_dir=None, mask_classes=('cloud', 'shadow'),
+                           max_cloud_fraction=None):
+        """
+        Runs stacking, RADD labelling, Hansen forest loss masking, Fmask cloud/shadow masking and band
+        reordering for every tile-date in one pass, writing only the final stack.
+
+        Equivalent to Steps 2, 3, 6, 7 and 8 of 1_hls_run_processing_prep.py, without the 2.stacks,
+        6.stacks_radd and 7.stacks_radd_forest intermediates. Outputs are named
+        {date}_{tile}_forest_masked_fmask_stack.tif like Step 8 and are laid out on the HLS band grid.
+
+        Args:
+            radd_alerts_file (str): RADD alerts raster (band 1 alert, band 2 date), in any CRS.
+            forest_loss_path (str or None): Folder with the Hansen lossyear GeoTIFFs, None to skip.
+            output_path (str): Folder for the final stacks.
+            reference_year (int): Forest loss from this year onwards is kept.
+            block_budget_mb (float): Pixels held in memory per block across all output bands.
+            loss_year_cache_dir (str, optional): See forest_loss_mask's cache_dir.
+            mask_classes (tuple): Fmask classes to mask, see apply_fmask.
+            max_cloud_fraction (float, optional): Skip tile-dates cloudier than this, see
+                                                  prescreen_cloud_fraction.
+        """
+        os.makedirs(output_path, exist_ok=True)
+        tile_date_files = self._collect_tile_date_files(self.bands + ['Fmask'])
+        cloud_fractions = self.prescreen_cloud_fraction(mask_classes=mask_classes) if max_cloud_fraction is not None else {}
+
+        for tile_date in sorted(tile_date_files):
+            band_files = tile_date_files[tile_date]
+            tile, date = tile_date.split('.')
+            output_file = os.path.join(output_path, f"{date}_{tile}_forest_masked_fmask_stack.tif")
+            if os.path.exists(output_file):
+                print(f"{os.path.basename(output_file)} already exists, skipping.")
+                continue
+            if any(band not in band_files for band in self.bands + ['Fmask']):
+                print(f"Skipping {tile_date} - missing bands or Fmask")
+                continue
+            if max_cloud_fraction is not None and cloud_fractions.get(tile_date, 0.0) > max_cloud_fraction:
+                print(f"Skipping {tile_date} - cloud fraction {cloud_fractions[tile_date]:.2f} above {max_cloud_fraction}")
+                continue
+
+            self._write_fused_stack([band_files[band] for band in self.bands], band_files['Fmask'],
+                                    radd_alerts_file, forest_loss_path, output_file, reference_year,
+                                    block_budget_mb, loss_year_cache_dir, mask_classes)
+
+    def _write_fused_stack(self, files, fmask_path, radd_alerts_file, forest_loss_path, output_file,
+                           reference_year=2021, block_budget_mb=64, loss_year_cache_dir=None,
+                           mask_classes=('cloud', 'shadow')):
+        """
+        Writes one [alert, date, HLS bands...] stack, masked by forest loss and Fmask, block by block.
+        """
+        bitmask = fmask_bitmask(mask_classes)
+
+        with rasterio.open(files[0]) as src0:
+            meta = src0.meta.copy()
+        crs, transform, width, height = meta['crs'], meta['transform'], meta['width'], meta['height']
+
+        # Tile-dates outside the RADD coverage have no labels, the same as crop_single_stack skipping them
+        with rasterio.open(radd_alerts_file) as radd:
+            radd_bounds = transform_bounds(radd.crs, 'EPSG:4326', *radd.bounds)
+            radd_dtype = radd.dtypes[0]
+        stack_bounds = transform_bounds(crs, 'EPSG:4326', *array_bounds(height, width, transform))
+        if not box(*stack_bounds).intersects(box(*radd_bounds)):
+            print(f"{os.path.basename(output_file)}: doesn't intersect RADD alerts in WGS 84, skipping.")
+            return None
+
+        loss_year = None
+        if forest_loss_path is not None:
+            tile = os.path.basename(output_file).split('_')[1]
+            cache_path = os.path.join(loss_year_cache_dir, f"{tile}_lossyear.tif") if loss_year_cache_dir else None
+            loss_year, _ = self.loss_year_on_grid(forest_loss_path, crs, transform, width, height, cache_path)
+            loss_year = (loss_year > 0) & (loss_year < reference_year - 2000)
+
+        # Same output as apply_fmask at the end of the step-by-step chain: a dtype holding both the
+        # labels and the bands (float32 only if that dtype can't hold the nodata value) plus a mask band
+        nodata_val = meta['nodata'] if meta['nodata'] is not None else -9999
+        dtype = np.result_type(radd_dtype, meta['dtype']).name
+        if not _fits_dtype(nodata_val, dtype):
+            dtype = 'float32'
+        meta.update(count=len(files) + 2, dtype=dtype, nodata=nodata_val)
+        meta = cog_profile(meta, self.codec)
+        block_height = meta.get('blockysize', 256)
+
+        budget_bytes = int(block_budget_mb * 1024 * 1024)
+        row_bytes = width * meta['count'] * np.dtype(meta['dtype']).itemsize
+        with rasterio.Env(GDAL_TIFF_INTERNAL_MASK=True, GDAL_CACHEMAX=max(1, int(block_budget_mb))), \
+                _open_on_grid(radd_alerts_file, crs, transform, width, height) as radd, \
+                _open_on_grid(fmask_path, crs, transform, width, height) as fmask, \
+                rasterio.open(output_file, 'w', **meta) as dst:
+            bands = [rasterio.open(f) for f in files]
+            try:
+                for window in _budget_windows(width, height, block_height, row_bytes, budget_bytes):
+                    block = np.zeros((meta['count'], int(window.height), int(window.width)), dtype=meta['dtype'])
+
+                    # RADD alert and date, 0 where there is no alert
+                    labels = radd.read([1, 2], window=window)
+                    if radd.nodata is not None:
+                        labels[labels == radd.nodata] = 0
+                    block[:2] = labels
+
+                    for i, band in enumerate(bands, start=2):
+                        block[i] = band.read(1, window=window)
+
+                    masked = bit_mask(fmask.read(1, window=window), bitmask)
+                    if loss_year is not None:
+                        rows, cols = window.toslices()
+                        masked |= loss_year[rows, cols]
+                    block[:, masked] = nodata_val
+
+                    dst.write(block, window=window)
+                    # 255 = valid, 0 = masked or nodata in any HLS band
+                    invalid = masked | (block[2:] == nodata_val).any(axis=0)
+                    dst.write_mask(np.where(invalid, 0, 255).astype(np.uint8), window=window)
+            finally:
+                for band in bands:
+                    band.close()
+
+            for i, description in enumerate(['alert', 'date'] + list(self.bands), start=1):
+                dst.set_band_description(i, description)
+            add_overviews(dst, self.codec)
+
+        print(f"Written fused stack: {output_file}")
+        return output_file
+
+    def export_cube(self, stack_folder, cube_dir, suffix='_stack.tif', time_chunk=1, spatial_chunk=128,
+                    series_spatial_chunk=32):
+        """
+        Appends the stacks in stack_folder to per-MGRS-tile Zarr cubes (<cube_dir>/<tile>.zarr) and
+        keeps them in self.cube. Dates already in a cube are skipped.
+
+        Args:
+            stack_folder (str): Folder of processed stacks, e.g. 8.2.stacks_radd_forest_fmask.
+            cube_dir (str): Folder holding the .zarr cubes.
+            suffix (str): Stack file suffix to pick up.
+            time_chunk (int), spatial_chunk (int): Chunking of appends, see datacube.TileCube.
+            series_spatial_chunk (int or None): Spatial chunk of the read layout the cubes are
+                                                rechunked to afterwards (all dates in one time chunk),
+                                                None to keep the append layout.
+
+        Returns:
+            dict: {tile: TileCube}
+        """
+        self.cube = export_stacks_to_cubes(stack_folder, cube_dir, suffix, time_chunk, spatial_chunk,
+                                           series_spatial_chunk)
+        return self.cube
 
     """"""""
     # Utility Functionalities
@@ -467,77 +1268,127 @@ class prep:
                              "height": out_image.shape[1],
                              "width": out_image.shape[2],
                              "transform": out_transform})
+            out_meta = cog_profile(out_meta, self.codec)
 
             # Write the clipped image
             with rasterio.open(output_file, "w", **out_meta) as dest:
                 dest.write(out_image)
+                add_overviews(dest, self.codec)
+
+    def reorder_and_add_blank_bands(self, input_file, output_file, sparse=True):
+        """
+        Writes [alert, date, HLS bands...]: two zero placeholder bands ahead of the stack's bands.
 
-    def reorder_and_add_blank_bands(self, input_file, output_file):
+        Args:
+            input_file (str): HLS band stack.
+            output_file (str): Output stack with the placeholder bands.
+            sparse (bool): Leave the placeholder blocks unwritten (GDAL SPARSE_OK), so they take no disk
+                           or write time and read back as 0. That only holds when the stack's nodata
+                           is unset or 0; otherwise explicit zero blocks are written as before. HLS
+                           bands are copied block by block along the output tiling.
+
+        The HLS stacks carry nodata -9999, so for them sparse has no effect and the zero blocks are
+        always written: a GeoTIFF has one nodata value for all bands, so unwritten placeholder blocks
+        would read back as -9999, and warp_rasters would then leave -9999 alert labels wherever the
+        RADD raster has no coverage instead of 0 (no alert).
+        """
         with rasterio.open(input_file) as src:
             # Update the metadata: total bands = number of HLS bands (src.count, typically 6) + 2 extra bands
             meta = src.meta.copy()
             meta.update(count=src.count + 2)
+            meta = cog_profile(meta, self.codec)
 
-            with rasterio.open(output_file, 'w', **meta) as dst:
-                # Create a blank band (using the shape of band 1) that will be used for both extra bands
-                blank_band = src.read(1) * 0
+            # Unwritten blocks read back as nodata, or 0 when there is none
+            leave_blank = sparse and (src.nodata is None or src.nodata == 0)
+            if leave_blank:
+                meta.update(sparse_ok=True)
 
-                # Write the extra blank bands with proper descriptions:
-                dst.write(blank_band, 1)
+            with rasterio.open(output_file, 'w', **meta) as dst:
+                if not leave_blank:
+                    # Write the extra blank bands block by block, compression makes zero blocks tiny
+                    for _, window in dst.block_windows(1):
+                        blank_block = np.zeros((int(window.height), int(window.width)), dtype=meta['dtype'])
+                        dst.write(blank_block, 1, window=window)
+                        dst.write(blank_block, 2, window=window)
                 dst.set_band_description(1, "alert")
-                dst.write(blank_band, 2)
                 dst.set_band_description(2, "date")
 
                 # Retrieve HLS band descriptions from self.bands (which holds ['B02', 'B03', ...])
                 # If the source already contains descriptions, you might choose to check them first.
                 for band in range(1, src.count + 1):
-                    data = src.read(band)
                     # Write each HLS band starting at band index 3 in the new output file
-                    dst.write(data, band + 2)
+                    for _, window in dst.block_windows(band + 2):
+                        dst.write(src.read(band, window=window), band + 2, window=window)
                     # Use self.bands to set the description for each HLS band
                     description = self.bands[band - 1] if band - 1 < len(self.bands) else f"Band {band}"
                     dst.set_band_description(band + 2, description)
 
                 # Update per-band statistics for the "date" band (band 2), not affected in qgis sadly.
                 # dst.update_tags(2, STATISTICS_MINIMUM='22000', STATISTICS_MAXIMUM='25000')
+                add_overviews(dst, self.codec)
                 print(f"Written reordered file with extra bands to {output_file}")
         return output_file
 
 
-    def apply_fmask(self, sentinel_stack_path, fmask_path, output_file):
-        import numpy as np
-        import rasterio
+    def apply_fmask(self, sentinel_stack_path, fmask_path, output_file, mask_classes=('cloud', 'shadow'),
+                    block_budget_mb=64):
+        """
+        Sets pixels flagged in the HLS Fmask QA band to nodata, block by block.
+
+        The stack keeps its own dtype and the masked pixels are also recorded as an internal GDAL mask
+        band, so readers can use dataset_mask() / read(masked=True) whatever the nodata value.
 
-        CLOUD_BIT = 1 << 1
-        CLOUD_SHADOW_BIT = 1 << 3
+        Args:
+            sentinel_stack_path (str): Stack to mask.
+            fmask_path (str): Raw HLS Fmask band (HLS.*.Fmask.tif). No need to warp it first, it is
+                              read through a WarpedVRT when its grid differs from the stack's.
+            output_file (str): Masked output stack.
+            mask_classes (tuple): Fmask classes to mask, any of FMASK_BITS ('cirrus', 'cloud',
+                                  'adjacent_cloud', 'shadow', 'snow', 'water').
+            block_budget_mb (float): Pixels held in memory per block across all bands.
+        """
+        bitmask = fmask_bitmask(mask_classes)
 
-        # (you can drop all the glob logic here since you already have the warped Fmask)
+        # fmask_path is the raw HLS Fmask band; it is resampled onto the stack grid on the fly
         if not os.path.exists(fmask_path):
             print(f"Fmask not found: {fmask_path}")
             return
 
-        with rasterio.open(sentinel_stack_path) as ss, rasterio.open(fmask_path) as fm:
-            # Now ss.read() and fm.read(1) will both be (3696, 3696), so masking will work
-            fmask_data = fm.read(1)
-            cloud_mask = (fmask_data & CLOUD_BIT) != 0
-            shadow_mask = (fmask_data & CLOUD_SHADOW_BIT) != 0
-            combined_mask = cloud_mask | shadow_mask
+        with rasterio.Env(GDAL_TIFF_INTERNAL_MASK=True, GDAL_CACHEMAX=max(1, int(block_budget_mb))), \
+                rasterio.open(sentinel_stack_path) as ss, \
+                _open_on_grid(fmask_path, ss.crs, ss.transform, ss.width, ss.height) as fm:
+            profile = ss.profile.copy()
 
-            stack_data = ss.read()
-            nodata_val = ss.nodata if ss.nodata is not None else -9999
+            # Keep the stack's dtype; nodata falls back to -9999 where the dtype can hold it,
+            # otherwise the mask band alone marks the masked pixels
+            nodata_val = ss.nodata
+            if nodata_val is None and _fits_dtype(-9999, profile['dtype']):
+                nodata_val = -9999
+            profile.update(nodata=nodata_val)
+            profile = cog_profile(profile, self.codec)
+            block_height = profile.get('blockysize', ss.block_shapes[0][0])
+
+            budget_bytes = int(block_budget_mb * 1024 * 1024)
+            row_bytes = ss.width * ss.count * np.dtype(profile['dtype']).itemsize
+            with rasterio.open(output_file, 'w', **profile) as dst:
+                for window in _budget_windows(ss.width, ss.height, block_height, row_bytes, budget_bytes):
+                    # fm is on the stack grid, so its window matches the stack's pixel for pixel
+                    masked = bit_mask(fm.read(1, window=window), bitmask)
 
-            # Apply mask
-            masked = np.where(
-                combined_mask[None, :, :],
-                nodata_val,
-                stack_data
-            ).astype(rasterio.float32)
+                    block = ss.read(window=window)
+                    if nodata_val is not None:
+                        block[:, masked] = nodata_val
+                    dst.write(block, window=window)
 
-            profile = ss.profile.copy()
-            profile.update(dtype=rasterio.float32, nodata=nodata_val)
+                    # 255 = valid, 0 = masked by Fmask or already invalid in the source stack
+                    valid = ss.dataset_mask(window=window)
+                    valid[masked] = 0
+                    dst.write_mask(valid, window=window)
 
-            with rasterio.open(output_file, 'w', **profile) as dst:
-                dst.write(masked)
+                for band, description in enumerate(ss.descriptions, start=1):
+                    if description:
+                        dst.set_band_description(band, description)
+                add_overviews(dst, self.codec)
 
         print(f"Written masked output: {output_file}")
 
@@ -654,25 +1505,35 @@ class prep:
             ds = gdal.Open(fp)
             if ds is None:
                 raise FileNotFoundError(f"Cannot open source file: {fp}")
-            band_counts.append((ds.RasterCount, fp))
+            band_counts.append((ds.RasterCount, fp, gdal.GetDataTypeName(ds.GetRasterBand(1).DataType)))
             ds = None  # close dataset
 
         # Sort so that the dataset with the most bands comes first
-        sorted_files = [fp for _, fp in sorted(band_counts, key=lambda x: x[0], reverse=True)]
+        sorted_counts = sorted(band_counts, key=lambda x: x[0], reverse=True)
+        sorted_files = [fp for _, fp, _ in sorted_counts]
+
+        # GDAL names Byte what numpy calls uint8; the other type names match once lowercased
+        dtype = sorted_counts[0][2].lower().replace('byte', 'uint8')
 
         # Now GDAL will create the destination with the band count of the first source
         warp_options = gdal.WarpOptions(
             format='GTiff',
             srcNodata=src_nodata,
             dstNodata=dst_nodata,
-            multithread=True
+            multithread=True,
+            creationOptions=cog_creation_options(dtype, self.codec)
         )
 
-        gdal.Warp(
+        ds = gdal.Warp(
             destNameOrDestDS=output_file,
             srcDSOrSrcDSTab=sorted_files,
             options=warp_options
         )
+        if self.codec is not None:
+            factors = overview_factors(ds.RasterXSize, ds.RasterYSize)
+            if factors:
+                ds.BuildOverviews('NEAREST', factors)
+        ds = None  # close dataset
 
     # def warp_rasters(self, input_files, output_file, src_nodata=None, dst_nodata=None):
     #     # Warp options
@@ -13,6 +13,7 @@ import rasterio
 import numpy as np
 import os
 import rasterio.warp
+from rasterio.windows import Window
 from rasterio.warp import calculate_default_transform, reproject, Resampling
 from shapely.geometry import box
 from shapely.ops import transform as shapely_transform
@@ -24,17 +25,168 @@ import matplotlib.pyplot as plt
 # from mmseg.datasets.builder import PIPELINES
 import datetime as dt
 from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from src.output_profiles import cog_profile, add_overviews
+from src.alert_index import AlertIndex
+from src.class_masks import class_mask
+from src.band_statistics import (BandMoments, band_statistics, global_file_stats, list_files,
+                                 reduce_moments, remove_sidecar, sketch_quantiles, write_band_scaling)
+
+def _normalize_file_blocks(paths, low, high, bands, nodata_value, codec):
+    """
+    Phase two of Loader.normalize_images_fused for one tile: scales the bands to 0-1 between low and
+    high (clipping outside), block by block, and returns the moments of the normalized valid pixels.
+    Module level so it can be pickled into a process pool.
+    """
+    input_path, output_path = paths
+    moments = BandMoments.empty(len(bands))
+    with rasterio.open(input_path) as src:
+        meta = src.meta.copy()
+        meta.update(dtype=rasterio.float32)  # Ensure output data type is float32
+        meta = cog_profile(meta, codec)
+
+        with rasterio.open(output_path, 'w', **meta) as dst:
+            for _, window in dst.block_windows(1):
+                block = src.read(bands, window=window).astype(np.float32)
+                valid = (block != nodata_value) & (block >= 0)
+                scaled = np.clip((block - low[:, None, None]) / (high - low)[:, None, None], 0, 1)
+                scaled = np.where(valid, scaled, nodata_value).astype(np.float32)
+                for i, band_idx in enumerate(bands):
+                    dst.write(scaled[i], band_idx, window=window)
+                if src.count >= 7 and 7 not in bands:  # Handle the 7th band if needed
+                    dst.write(src.read(7, window=window).astype(np.float32), 7, window=window)
+
+                # Post-normalization stats over the same pixels compute_global_mean_std counts (> 0)
+                moments = moments.merge(BandMoments.from_block(scaled, scaled > 0))
+            add_overviews(dst, codec)
+    return moments
+
+
+def radd_yydoy(dates):
+    """
+    YYDOY integers, the date encoding of the RADD alert values, from YYYYDDD date strings.
+
+    Args:
+        dates (str or list): e.g. '2023241' or ['2023241', '2023257'].
+
+    Returns:
+        int or np.ndarray: e.g. 23241.
+    """
+    if isinstance(dates, str):
+        return int(dates[2:])
+    return np.array([int(date[2:]) for date in dates])
+
+
+def radd_labels(radd_alerts, reference_yydoy, nodata_value=-9999):
+    """
+    Binary labels from a RADD alert band: alerts after the reference date become nodata, other
+    alerts 1 and everything else is kept.
+
+    Args:
+        radd_alerts (np.ndarray): (y, x) RADD alert band.
+        reference_yydoy (int or array-like): YYDOY of the stack date, or of several dates of the same
+                                             tile to label them all at once.
+
+    Returns:
+        np.ndarray: (y, x) labels for a single date, (date, y, x) for several; same dtype as radd_alerts.
+    """
+    reference = np.asarray(reference_yydoy)
+    alerts = radd_alerts if reference.ndim == 0 else radd_alerts[None]
+    reference = reference.reshape(reference.shape + (1,) * radd_alerts.ndim)
+    labels = np.where(alerts > 0, 1, alerts)
+    return np.where(alerts > reference, nodata_value, labels).astype(radd_alerts.dtype)
+
+
+def _label_radd_stack(stack_path, nodata_value, codec, in_place):
+    """Labels one *_radd.tif stack for Loader.alter_radd_data_to_label, reading it once."""
+    folder, filename = os.path.split(stack_path)
+    output_path = os.path.join(folder, filename.replace('.tif', '_labelled.tif'))
+    reference = radd_yydoy(filename.split('_')[0])
+
+    if in_place:
+        with rasterio.open(stack_path, 'r+') as dst:
+            if not rasterio.dtypes.in_dtype_range(nodata_value, dst.dtypes[0]):
+                raise ValueError(f"nodata {nodata_value} does not fit the {dst.dtypes[0]} alert band of {stack_path}")
+            dst.write(radd_labels(dst.read(1), reference, nodata_value), 1)
+            dst.nodata = nodata_value
+            if dst.overviews(1):
+                add_overviews(dst, codec)
+        os.replace(stack_path, output_path)
+        return output_path
+
+    with rasterio.open(stack_path) as src:
+        data = src.read()
+        profile = src.profile
+    data[0] = radd_labels(data[0], reference, nodata_value)
+    profile.update(nodata=nodata_value)
+    profile = cog_profile(profile, codec)
+    with rasterio.open(output_path, 'w', **profile) as dst:
+        dst.write(data)
+        add_overviews(dst, codec)
+    os.remove(stack_path)
+    return output_path
+
+
+def _filter_tile_by_agb(job, valid_classes, nodata_value, codec):
+    """
+    Masks one sentinel tile and its RADD label tile to the valid AGB classes, for
+    Loader.filter_stacks_and_radd_by_AGB. Outputs are only created once a block has a valid class.
+
+    Returns:
+        bool: True if the tile had any valid class (outputs written).
+    """
+    sentinel_path, radd_path, output_sentinel_path, output_radd_path = job
+    sources = [rasterio.open(sentinel_path)]
+    outputs = [output_sentinel_path]
+    if radd_path is not None:
+        sources.append(rasterio.open(radd_path))
+        outputs.append(output_radd_path)
+
+    metas = []
+    for src in sources:
+        meta = src.meta.copy()
+        dtype = meta['dtype'] if rasterio.dtypes.in_dtype_range(nodata_value, meta['dtype']) else rasterio.float32
+        meta.update(nodata=nodata_value, dtype=dtype)
+        metas.append(cog_profile(meta, codec))
+    sentinel = sources[0]
+    block_height = metas[0].get('blockysize', 256) if metas[0].get('tiled') else 256
+    block_width = metas[0].get('blockxsize', sentinel.width) if metas[0].get('tiled') else sentinel.width
+
+    dsts = []
+    try:
+        for row_off in range(0, sentinel.height, block_height):
+            for col_off in range(0, sentinel.width, block_width):
+                window = Window(col_off, row_off, min(block_width, sentinel.width - col_off),
+                                min(block_height, sentinel.height - row_off))
+                mask = class_mask(sentinel.read(7, window=window), valid_classes)  # AGB band is the 7th band
+                if not mask.any():
+                    continue  # left unwritten, reads back as nodata
+                if not dsts:
+                    dsts = [rasterio.open(path, 'w', **meta) for path, meta in zip(outputs, metas)]
+                for src, dst in zip(sources, dsts):
+                    data = src.read(window=window).astype(dst.dtypes[0], copy=False)
+                    dst.write(np.where(mask, data, np.asarray(nodata_value, dtype=data.dtype)), window=window)
+        for dst in dsts:
+            add_overviews(dst, codec)
+    finally:
+        for dataset in sources + dsts:
+            dataset.close()
+    return bool(dsts)
+
 
 class Loader:
 
 
-    def __init__(self, source_dir, train_dir, val_dir, output_folder, tile_size=512):
+    def __init__(self, source_dir, train_dir, val_dir, output_folder, tile_size=512, codec='auto'):
             """
             Args:
                 path (list): List of file paths to Sentinel-2 imagery.
                 stack_path_list (str): Path to directory where output raster stacks will be stored.
                 bands (list): List of Sentinel-2 band names to include in the stack (e.g., ['B02', 'B03', 'B04', 'B08', 'B11', 'B12']).
                 shp (geopandas.GeoDataFrame, optional): GeoDataFrame containing study area polygon.
+                codec (str or None): Compression for written rasters, see output_profiles.cog_profile.
+                                     None copies source profiles as-is.
 
             Attributes:
                 cube (None or xarray.DataArray): Multi-dimensional, named array for storing data.
@@ -48,6 +200,7 @@ class Loader:
             self.val_dir = val_dir
             self.output_folder = output_folder
             self.nodata_value = -9999
+            self.codec = codec
             # Initialize a list to store titles of processed files (optional)
 
 
@@ -86,6 +239,7 @@ class Loader:
                         "width": dst_width,
                         "height": dst_height
                     })
+                    dst_profile = cog_profile(dst_profile, self.codec)
 
                     # Create stack directory if it doesn't exist
                     if not os.path.exists(self.stack_path_list):
@@ -97,6 +251,7 @@ class Loader:
                             with rasterio.open(file_path) as src:
                                 data = src.read(1)  # Read the first band
                                 dst.write(data, i)
+                        add_overviews(dst, self.codec)
 
     import rasterio
 
@@ -113,114 +268,74 @@ class Loader:
     # alert_count = count_radd_alerts(tif_file)
     # print(f"Number of RADD alerts: {alert_count}")
 
-    def alter_radd_data_to_label(self, sentinel_stack_path):
-        # Convert the Sentinel stack date string to a datetime object
-        #sentinel_stack_date = datetime.datetime.strptime(sentinel_stack_date_str, "%Y%j").date()
-
-        for sentinel_stack in os.listdir(sentinel_stack_path):
-            # if sentinel_stack.endswith('.tif') and not sentinel_stack.endswith('_radd.tif') and not sentinel_stack.endswith("sentinel.tif"):#sentinel_stack.endswith('_radd_modified.tif') and not sentinel_stack.endswith(""):
-            if sentinel_stack.endswith('_radd.tif'):    # Extract the date from the filename
-                sentinel_date_str = sentinel_stack.split('_')[0]
-                sentinel_date = dt.datetime.strptime(sentinel_date_str, "%Y%j").date()
-
-                sentinel_date_yydoy = int(datetime.strftime(sentinel_date, "%y%j"))
-
-                stack_path = os.path.join(sentinel_stack_path, sentinel_stack)
-
-                with rasterio.open(stack_path) as src:
-                    profile = src.profile
-                    #src.nodata = -9999
-                    radd_alerts = src.read(1)  # RADD alerts are assumed to be in the first band
-                    sentinel_data = src.read()[1:]  # Sentinel-2 data spans bands 2 to 7
-                    profile = src.profile
-
-                    # Assuming your RADD alerts contain date information encoded in a specific way
-                    # For demonstration, we create a mask for alerts beyond the Sentinel date (this part needs your actual implementation)
-                    future_events_mask = radd_alerts > sentinel_date_yydoy
-
-                    # tile, date = os.path.basename(sentinel_stack_path).split('_')[0].split('.')
-
-                    nodata_value = -9999
-
-                    # Apply the future events mask to set these alerts to nodata
-                    radd_alerts[future_events_mask] = nodata_value
-
-                    # Convert remaining values greater than 0 to 1 (RADD alerts to binary)
-                    radd_alerts[radd_alerts > 0] = 1
-
-                    # Ensure the profile is updated with the correct nodata value
-                    profile.update(nodata=nodata_value)
-
-                    # Save the modified stack with updated RADD alerts
-                    output_filename = sentinel_stack.replace('.tif', '_labelled.tif')
-                    output_path = os.path.join(sentinel_stack_path, output_filename)
-                    with rasterio.open(output_path, 'w', **profile) as dst:
-                        dst.write(radd_alerts, 1)  # Write modified RADD alerts to band 1
-                        for i, band in enumerate(sentinel_data, start=2):  # Write original Sentinel-2 data back
-                            dst.write(band, i)
-                    src.close()
-                os.remove(stack_path)
-                print(f"Done applying radd future_mask, Wrote to: {output_path}, Deleted: {stack_path}")
-
-
-
-
-
-    def filter_stacks(self, stack_directory, suffix, alert_label_value, min_alert_pixels=0):
+    def alter_radd_data_to_label(self, sentinel_stack_path, in_place=False, workers=None):
         """
-        Filters stacks based on the count of RADD alert labels.
+        Turns the RADD alert band (band 1) of every *_radd.tif stack into binary labels: alerts dated
+        after the stack's date become nodata, remaining alerts 1. Results are *_radd_labelled.tif.
 
         Args:
-            alert_label_value (int): Pixel value that represents a RADD alert.
-            min_alert_pixels (int): Minimum number of alert pixels required to keep a stack.
+            sentinel_stack_path (str): Folder of YYYYDDD_*_radd.tif stacks.
+            in_place (bool): Rewrite only band 1 of each stack and rename it, instead of writing a
+                             full copy and deleting the original.
+            workers (int, optional): Process pool size.
         """
-        alert_counts = []
-        file_names = []
-        for file in os.listdir(stack_directory):
-            # if file.endswith("fmask_stack.tif") or (stack_directory.endswith("Tiles_512_30pc_cc") and file.endswith(".tif") and not file.endswith("radd.tif") and not file.endswith("sentinel.tif")):
-            if file.endswith(suffix): #"radd_modified_radd_agb.tif"): #"_radd_labelled_agb.tif"):
+        stacks = sorted(os.path.join(sentinel_stack_path, f) for f in os.listdir(sentinel_stack_path)
+                        if f.endswith('_radd.tif'))
+        label = partial(_label_radd_stack, nodata_value=self.nodata_value, codec=self.codec, in_place=in_place)
+        if not workers or workers <= 1:
+            outputs = list(map(label, stacks))
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                outputs = list(executor.map(label, stacks, chunksize=max(1, len(stacks) // (workers * 4))))
+        for stack_path, output_path in zip(stacks, outputs):
+            print(f"Done applying radd future_mask, Wrote to: {output_path}, Replaced: {stack_path}")
 
-                file_path = os.path.join(stack_directory, file)
+    def filter_stacks(self, stack_directory, suffix, alert_label_value, min_alert_pixels=0, delete=True,
+                      workers=None, max_nodata_fraction=None):
+        """
+        Filters stacks based on the count of RADD alert labels.
 
-                with rasterio.open(file_path) as src:
-                    radd_alerts = src.read(1)  # Assuming the RADD alert band is the first band
-                    alert_count = np.count_nonzero(radd_alerts > 0)  ### alert_label_value)
-                    print(f"file:{file}, alert count: {alert_count}")
-                    alert_counts.append(alert_count)
-                    file_names.append(file)  # Keep track of the file names
+        Alert counts come from the directory's alert index (alert_index.sqlite), which only reads tiles
+        that are new or rewritten since the last call, so threshold sweeps are index queries.
 
-                    src.close()
-                    if alert_count < min_alert_pixels:
-                        base_name = file.replace(suffix, '')
-                        for suffix in ['_radd_.tif', '_radd.tif', '_sentinel.tif',"_sentinel_agb_normalized.tif", suffix]:
-                            file_to_delete = os.path.join(stack_directory, f"{base_name}{suffix}")  # Ensure to add the suffix when deleting
-                            if os.path.exists(file_to_delete):
-                                os.remove(file_to_delete)
-                                print(f"Removed file {file_to_delete}")
+        Args:
+            alert_label_value (int): Pixel value that represents a RADD alert (any label > 0 counts).
+            min_alert_pixels (int): Minimum number of alert pixels required to keep a stack.
+            delete (bool): Delete the stacks below min_alert_pixels (in batches), together with their
+                           companion tiles (alert_index.COMPANION_SUFFIXES, which now also covers the
+                           native-dtype _sentinel_agb.tif). False only reports.
+            workers (int, optional): Process pool size for indexing.
+            max_nodata_fraction (float, optional): Also drop stacks with more nodata labels than this.
 
-                        print(f"Removed stack {file} due to insufficient RADD alerts:{alert_count}.")
+        Returns:
+            list: Alert counts of all indexed stacks, before deletion.
+        """
+        with AlertIndex(stack_directory, suffix, self.nodata_value) as index:
+            index.update(workers=workers)
+            rows = index.query()
+            alert_counts = [row['alert_count'] for row in rows]
+
+            to_remove = [row for row in rows if row['alert_count'] < min_alert_pixels
+                         or (max_nodata_fraction is not None and row['nodata_fraction'] > max_nodata_fraction)]
+            if delete and to_remove:
+                index.delete_tiles(to_remove)
+            print(f"{len(to_remove)}/{len(rows)} stacks below {min_alert_pixels} alerts"
+                  f"{' removed' if delete else ''}.")
 
         # Find and print the file with the maximum alerts
         if alert_counts:  # Ensure there are alert counts to process
-            max_alert_count = max(alert_counts)
-            max_index = alert_counts.index(max_alert_count)
-            max_alert_file = file_names[max_index]
-
-            min_alert_count = min(alert_counts)
-            min_index = alert_counts.index(min_alert_count)
-            min_alert_file = file_names[min_index]
-
-            print(f"The file with the maximum alerts is '{max_alert_file}' with {max_alert_count} alerts.")
-            print(f"The file with the minimum alerts is '{min_alert_file}' with {min_alert_count} alerts.")
+            max_row = max(rows, key=lambda row: row['alert_count'])
+            min_row = min(rows, key=lambda row: row['alert_count'])
+            print(f"The file with the maximum alerts is '{os.path.basename(max_row['path'])}' with {max_row['alert_count']} alerts.")
+            print(f"The file with the minimum alerts is '{os.path.basename(min_row['path'])}' with {min_row['alert_count']} alerts.")
         else:
             print("No alert counts to process.")
 
-
-
         return alert_counts
 
 
-    def filter_stacks_and_radd_by_AGB(self, input_folder, output_folder, valid_classes=[2, 3, 4, 5], nodata_value=-9999):
+    def filter_stacks_and_radd_by_AGB(self, input_folder, output_folder, valid_classes=[2, 3, 4, 5], nodata_value=-9999,
+                                      workers=None):
         """
         Filters Sentinel stacks and corresponding RADD alert files by AGB land classification.
 #     # 1 = Intact Lowland Forest
@@ -239,51 +354,43 @@ class Loader:
             output_folder (str): Path to the folder where filtered files will be saved.
             valid_classes (list): AGB class values to retain.
             nodata_value (int): No-data value for filtered pixels.
+            workers (int, optional): Process pool size.
+
+        Each sentinel tile and its RADD label tile are masked together in one block-wise pass, keeping
+        their dtypes (float32 only if nodata_value does not fit). Blocks without a valid class are
+        never written and read back as nodata; tiles without any are dropped without output.
         """
 
         if not os.path.exists(output_folder):
             os.makedirs(output_folder)
 
-        for filename in os.listdir(input_folder):
-            if filename.endswith('sentinel.tif'):
-                sentinel_file_path = os.path.join(input_folder, filename)
-
-                with rasterio.open(sentinel_file_path) as sentinel_src:
-                    agb_band = sentinel_src.read(7)  # Assuming AGB band is the 7th band
-
-                    radd_filename = filename.replace('_sentinel.tif', '_radd_labelled.tif')
-                    radd_file_path = os.path.join(input_folder, radd_filename)
-
-                    # Check if any of the valid classes are present in the AGB band
-                    if not np.any(np.isin(agb_band, valid_classes)):
-                        print(f"removing {radd_filename, sentinel_file_path} as it does not contain any of the valid AGB classes.")
-                        # radd_src.close()
-                        sentinel_src.close()
-                        if os.path.exists(radd_file_path):
-                            os.remove(radd_file_path)
-                        os.remove(sentinel_file_path)
-
-                        continue  # Skip this file
-
-                    agb_mask = np.isin(agb_band, valid_classes)
-
-                    # Process Sentinel file
-                    output_sentinel_filename = f"{filename.replace('.tif', '')}_agb.tif"
-                    output_sentinel_path = os.path.join(output_folder, output_sentinel_filename)
-                    self.apply_mask_and_save(sentinel_src, agb_mask, output_sentinel_path, nodata_value)
-
-                    # Check and process corresponding RADD file if it exists
-
-                    if os.path.exists(radd_file_path):
-                        with rasterio.open(radd_file_path) as radd_src:
-                            output_radd_filename = f"{radd_filename.replace('.tif', '')}_agb.tif"
-                            output_radd_path = os.path.join(output_folder, output_radd_filename)
-                            self.apply_mask_and_save(radd_src, agb_mask, output_radd_path, nodata_value)
-
-                            radd_src.close()
-                        os.remove(radd_file_path)
-                    sentinel_src.close()
-                os.remove(sentinel_file_path)
+        sentinel_files = sorted(f for f in os.listdir(input_folder) if f.endswith('sentinel.tif'))
+        jobs = []
+        for filename in sentinel_files:
+            radd_filename = filename.replace('_sentinel.tif', '_radd_labelled.tif')
+            radd_file_path = os.path.join(input_folder, radd_filename)
+            jobs.append((os.path.join(input_folder, filename),
+                         radd_file_path if os.path.exists(radd_file_path) else None,
+                         os.path.join(output_folder, f"{filename.replace('.tif', '')}_agb.tif"),
+                         os.path.join(output_folder, f"{radd_filename.replace('.tif', '')}_agb.tif")))
+
+        filter_tile = partial(_filter_tile_by_agb, valid_classes=valid_classes, nodata_value=nodata_value,
+                              codec=self.codec)
+        if not workers or workers <= 1:
+            results = list(map(filter_tile, jobs))
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(filter_tile, jobs, chunksize=max(1, len(jobs) // (workers * 4))))
+
+        for (sentinel_file_path, radd_file_path, output_sentinel_path, _), kept in zip(jobs, results):
+            if kept:
+                print(f"Processed file saved as: {output_sentinel_path}, Deleted File: {sentinel_file_path}")
+            else:
+                print(f"removing {radd_file_path, sentinel_file_path} as it does not contain any of the valid AGB classes.")
+            if radd_file_path is not None:
+                os.remove(radd_file_path)
+            os.remove(sentinel_file_path)
+            remove_sidecar(sentinel_file_path)
 
     def apply_mask_and_save(self, src, mask, output_path, nodata_value):
         """
@@ -296,12 +403,14 @@ class Loader:
         """
         meta = src.meta.copy()
         meta.update(nodata=nodata_value, dtype=rasterio.float32)
+        meta = cog_profile(meta, self.codec)
 
         with rasterio.open(output_path, 'w', **meta) as dst:
             for i in range(1, src.count + 1):
                 data = src.read(i).astype(rasterio.float32)
                 masked_data = np.where(mask, data, nodata_value)
                 dst.write(masked_data, i)
+            add_overviews(dst, self.codec)
 
 
         print(f"Processed file saved as: {output_path}, Deleted File: {src}")
@@ -345,66 +454,41 @@ class Loader:
         return distribution
 
 
-    def calculate_band_statistics(self, directories, nan_value=-9999):
+    def calculate_band_statistics(self, directories, nan_value=-9999, workers=None, bands=None,
+                                  suffix='_sentinel_normalized.tif'):
         """
         Calculates the mean and standard deviation of each Sentinel band,
         excluding specified NaN values.
 
+        Files are streamed block by block into mergeable Welford/Chan aggregates (see
+        band_statistics), one file per worker, so memory no longer grows with tile size.
+
         Args:
             directories (list): List of directories to process.
             nan_value (int): Value to be treated as NaN and excluded from calculations.
+            workers (int, optional): Process pool size. None or 1 runs in this process.
+            bands (list, optional): 1-based band indexes. Defaults to all bands.
+            suffix (str): Suffix of the files to include.
 
         Returns:
-            dict: Dictionary containing means and stds for each band.
+            dict: Dictionary containing means and stds for each band, as plain floats in the form
+                  cfg.img_norm_cfg in bin/run_commands/run_config.py expects.
         """
-        band_sums = []
-        band_squares = []
-        band_counts = []
-        initialized = False
+        files = list_files(directories, suffix)
+        stats = band_statistics(files, bands=bands, nan_value=nan_value, workers=workers)
+        print(f"cfg.img_norm_cfg = dict(\n    means={stats['means']},\n    stds={stats['stds']},\n)")
+        return stats
 
-        for directory in directories:
-            for file in os.listdir(directory):
-                if file.endswith('_sentinel_normalized.tif'):
-                    file_path = os.path.join(directory, file)
-
-                    with rasterio.open(file_path) as src:
-                        bands = src.read()
-
-                        if not initialized:
-                            # Initialize sum, sum of squares, and count arrays
-                            band_sums = [np.zeros(band.shape) for band in bands]
-                            band_squares = [np.zeros(band.shape) for band in bands]
-                            band_counts = [0 for _ in bands]
-                            initialized = True
-
-                        for i, band in enumerate(bands):
-                            valid_mask = band != nan_value
-                            band_sums[i] += np.where(valid_mask, band, 0)
-                            band_squares[i] += np.where(valid_mask, np.square(band), 0)
-                            band_counts[i] += np.count_nonzero(valid_mask)
-
-        means = [np.sum(band_sum) / band_count if band_count > 0 else 0 for band_sum, band_count in zip(band_sums, band_counts)]
-        stds = [np.sqrt(max(np.sum(band_square) / band_count - mean ** 2, 0)) if band_count > 0 else 0 for band_square, band_count, mean in zip(band_squares, band_counts, means)]
-
-        return {"means": means, "stds": stds}
-
-    def compute_global_min_max(self, input_folder, bands=[1, 2, 3, 4, 5, 6]):
-        global_min = np.full(len(bands), np.inf)
-        global_max = np.full(len(bands), -np.inf)
+    def compute_global_min_max(self, input_folder, bands=[1, 2, 3, 4, 5, 6], workers=None):
+        """
+        Global min and max of each band over the valid (> 0) pixels of the *_sentinel_agb.tif tiles.
 
-        for filename in os.listdir(input_folder):
-            if filename.endswith('_sentinel_agb.tif'):
-                filepath = os.path.join(input_folder, filename)
-                with rasterio.open(filepath) as src:
-                    for i, band_idx in enumerate(bands):
-                        band = src.read(band_idx).astype(np.float32)
-                        valid_mask = band > 0  # Assuming negative values are not valid
-                        valid_pixels = band[valid_mask]
-                        if valid_pixels.size > 0:  # Ensure there are valid pixels
-                            global_min[i] = min(np.min(valid_pixels), global_min[i])
-                            global_max[i] = max(np.max(valid_pixels), global_max[i])
-
-        return global_min, global_max
+        Reduced from the per-file stats sidecars (band_statistics.file_stats), so only tiles that are
+        new or changed since their sidecar was written are read.
+        """
+        files = list_files([input_folder], '_sentinel_agb.tif')
+        stats = global_file_stats(files, bands, rule=('gt', 0), workers=workers)
+        return stats['min'], stats['max']
 
     def normalize_images_global(self, input_folder, output_folder, global_min, global_max, bands=[1, 2, 3, 4, 5, 6]):
         if not os.path.exists(output_folder):
@@ -418,6 +502,7 @@ class Loader:
                 with rasterio.open(input_path) as src:
                     meta = src.meta.copy()
                     meta.update(dtype=rasterio.float32)  # Ensure output data type is float32
+                    meta = cog_profile(meta, self.codec)
 
                     with rasterio.open(output_path, 'w', **meta) as dst:
                         for i in range(1, src.count + 1):  # Include all bands, adjusting loop to iterate through all bands
@@ -430,34 +515,114 @@ class Loader:
                             elif i == 7:  # Handle the 7th band if needed
                                 classification_band = src.read(i).astype(np.float32)
                                 dst.write(classification_band, i)
+                        add_overviews(dst, self.codec)
 
                     src.close()
                 os.remove(input_path)
+                remove_sidecar(input_path)
                 print(f"Normalized file saved as: {output_path}, Deleted: {input_path}")
 
 
-    def compute_global_mean_std(self, input_folder, bands=[1, 2, 3, 4, 5, 6]):
-        sum_means = np.zeros(len(bands))
-        sum_variances = np.zeros(len(bands))
-        total_pixels = 0
+    def _scaling_range(self, files, bands, clip_percentiles, workers):
+        """Per-band (low, high) to scale between, and the raw stats, from the files' stats sidecars."""
+        if not files:
+            raise ValueError("No *_sentinel_agb.tif files to compute the scaling from")
+        stats = global_file_stats(files, bands, rule=('gt', 0), workers=workers)
+        if clip_percentiles is None:
+            low, high = stats['min'], stats['max']
+        else:
+            low, high = sketch_quantiles(stats, clip_percentiles)
+        return low.astype(np.float32), high.astype(np.float32), stats
 
-        for filename in os.listdir(input_folder):
-            if not filename.endswith('_sentinel_agb_normalized.tif'):
-                continue  # Skip non-sentinel files
-            filepath = os.path.join(input_folder, filename)
-            with rasterio.open(filepath) as src:
-                for i, band_idx in enumerate(bands):
-                    band = src.read(band_idx).astype(np.float32)
-                    valid_mask = band > 0  # Assuming negative values are not valid
-                    valid_pixels = band[valid_mask]
-                    sum_means[i] += valid_pixels.mean()
-                    sum_variances[i] += valid_pixels.var()
-                    total_pixels += valid_pixels.size
+    def write_band_scaling(self, input_folder, scaling_path, bands=[1, 2, 3, 4, 5, 6],
+                           clip_percentiles=(0.5, 99.5), workers=None):
+        """
+        Phase one of normalize_images_fused only: writes the per-band scale and offset to a band
+        scaling file instead of rewriting the tiles, for normalization at read time with the
+        ApplyBandScaling pipeline transform (src/custom_pipelines.py). The tiles keep their native
+        dtype and names, and new stats only mean a new scaling file.
+
+        The stored mean and std of the scaled bands are the raw ones put through the same linear map,
+        which ignores clipping (exact with clip_percentiles=None).
 
-        global_means = sum_means / len(os.listdir(input_folder))
-        global_stds = np.sqrt(sum_variances / len(os.listdir(input_folder)))
+        Args:
+            input_folder (str): Folder with the *_sentinel_agb.tif tiles.
+            scaling_path (str): Band scaling JSON to write or update.
+            bands (list): 1-based bands to scale.
+            clip_percentiles (tuple or None): See normalize_images_fused.
+            workers (int, optional): Process pool size for tiles without a current sidecar.
+
+        Returns:
+            dict: The band scaling, see band_statistics.write_band_scaling.
+        """
+        files = list_files([input_folder], '_sentinel_agb.tif')
+        low, high, stats = self._scaling_range(files, bands, clip_percentiles, workers)
+        span = np.where(high > low, high - low, 1)
+        scaling = write_band_scaling(scaling_path, bands, low, high, self.nodata_value, rule=('ge', 0),
+                                     means=(stats['mean'] - low) / span, stds=stats['std'] / span)
+        print(f"Band scaling for {len(files)} files written to {scaling_path}")
+        return scaling
+
+    def normalize_images_fused(self, input_folder, output_folder, bands=[1, 2, 3, 4, 5, 6],
+                               clip_percentiles=(0.5, 99.5), workers=None, delete_input=True):
+        """
+        compute_global_min_max, normalize_images_global and compute_global_mean_std in two phases.
 
-        return global_means, global_stds
+        Phase one reduces the per-file stats sidecars (only new or changed tiles are read, all bands
+        per block) to global per-band percentiles, using the sidecar histograms as mergeable quantile
+        sketches. Phase two writes each *_sentinel_agb_normalized.tif block by block, scaled to 0-1
+        between the low and high percentile and clipped outside them, and accumulates the normalized
+        mean and std on the way, so no third pass is needed.
+
+        Args:
+            input_folder (str): Folder with the *_sentinel_agb.tif tiles.
+            output_folder (str): Folder for the normalized tiles.
+            bands (list): 1-based bands to normalize; band 7 is copied as is.
+            clip_percentiles (tuple or None): (low, high) percentiles to scale between. None uses the
+                                              exact min and max, like normalize_images_global.
+            workers (int, optional): Process pool size for both phases.
+            delete_input (bool): Delete each input tile once normalized, like normalize_images_global.
+
+        Returns:
+            tuple: (low, high, means, stds) per band.
+        """
+        os.makedirs(output_folder, exist_ok=True)
+        files = list_files([input_folder], '_sentinel_agb.tif')
+
+        # Phase one: global min/max and quantile sketch from the sidecars
+        low, high, _ = self._scaling_range(files, bands, clip_percentiles, workers)
+        print(f"Phase one: scaling between {low} and {high}")
+
+        # Phase two: normalize block by block, collecting post-normalization moments
+        paths = [(f, os.path.join(output_folder, os.path.splitext(os.path.basename(f))[0] + '_normalized.tif'))
+                 for f in files]
+        normalize = partial(_normalize_file_blocks, low=low, high=high, bands=bands,
+                            nodata_value=self.nodata_value, codec=self.codec)
+        if not workers or workers <= 1:
+            moments = reduce_moments(map(normalize, paths), len(bands))
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                moments = reduce_moments(executor.map(normalize, paths), len(bands))
+
+        if delete_input:
+            for input_path, output_path in paths:
+                if os.path.abspath(input_path) != os.path.abspath(output_path):
+                    os.remove(input_path)
+                    remove_sidecar(input_path)
+        print(f"Normalized {len(paths)} files into {output_folder}")
+        return low, high, moments.mean, moments.std
+
+    def compute_global_mean_std(self, input_folder, bands=[1, 2, 3, 4, 5, 6], workers=None):
+        """
+        Global mean and standard deviation of each band over the valid (> 0) pixels of the
+        *_sentinel_agb_normalized.tif tiles.
+
+        Pixel-weighted and exact (pooled over all valid pixels, not an average of per-file means),
+        reduced from the per-file stats sidecars.
+        """
+        files = list_files([input_folder], '_sentinel_agb_normalized.tif')
+        stats = global_file_stats(files, bands, rule=('gt', 0), workers=workers)
+        return stats['mean'], stats['std']
 
     #
     # def normalize_images_global(self, input_folder,output_folder, global_means, global_stds, bands=[1, 2, 3, 4, 5, 6]):
@@ -507,6 +672,7 @@ class Loader:
             with rasterio.open(file_path) as src:
                 meta = src.meta
                 meta.update(dtype=rasterio.float32)
+                meta = cog_profile(meta, self.codec)
 
                 with rasterio.open(output_path, 'w', **meta) as dst:
                     for i in range(1, src.count + 1):  # Process all bands
@@ -527,6 +693,7 @@ class Loader:
 
                         else:  # Directly add the 7th band without normalization
                             dst.write_band(i, band)
+                    add_overviews(dst, self.codec)
             os.remove(file_path)
             print(f"Normalized file saved as: {output_path}")
 
@@ -691,8 +858,10 @@ class Loader:
             new_meta = src.meta.copy()
             # Update the metadata with new nodata value
             new_meta.update(nodata=new_nodata_value)
+            new_meta = cog_profile(new_meta, self.codec)
 
             with rasterio.open(output_filepath, 'w', **new_meta) as dst:
                 dst.write(data)
+                add_overviews(dst, self.codec)
 
 
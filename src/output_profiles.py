@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""
+Shared output profile for every raster the pipeline writes: tiled, compressed GeoTIFFs with internal
+overviews, laid out so windowed reads, tile cropping and QGIS browsing touch only the blocks they need.
+
+@Time    : 17/10/2026
+@Author  : Colm Keyes
+@Email   : keyesco@tcd.ie
+@File    : output_profiles.py
+"""
+
+import numpy as np
+import rasterio
+import rasterio.shutil
+from rasterio.enums import Resampling
+
+
+# GeoTIFF compression codecs accepted by cog_profile
+CODECS = ('ZSTD', 'DEFLATE', 'LZW', 'LERC', 'LERC_ZSTD', 'LERC_DEFLATE')
+
+# Creation options that are replaced rather than inherited from a source profile
+_LAYOUT_KEYS = ('tiled', 'blockxsize', 'blockysize', 'compress', 'predictor', 'interleave',
+                'zstd_level', 'zlevel', 'max_z_error', 'photometric')
+
+
+def resolve_codec(dtype, codec='auto'):
+    """
+    Picks the codec for a dtype. 'auto' is ZSTD for integer data and lossless LERC_ZSTD for floats.
+    """
+    if codec == 'auto':
+        return 'LERC_ZSTD' if np.issubdtype(np.dtype(dtype), np.floating) else 'ZSTD'
+    codec = codec.upper()
+    if codec not in CODECS:
+        raise ValueError(f"Invalid codec specified. Choose 'auto' or one of {CODECS}.")
+    return codec
+
+
+def cog_profile(profile, codec='auto', blocksize=512):
+    """
+    Returns a copy of a rasterio profile/meta set up for tiled, compressed GeoTIFF output.
+
+    Call after dtype, count and size are final, since the codec and predictor depend on them.
+
+    Args:
+        profile (dict): Source profile or meta (e.g. src.profile, src.meta).
+        codec (str or None): 'auto', one of CODECS, or None to return the profile unchanged.
+        blocksize (int): Internal tile size in pixels, capped to the raster size (multiple of 16).
+
+    Returns:
+        dict: Profile for rasterio.open(path, 'w', **profile).
+    """
+    out = dict(profile)
+    if codec is None:
+        return out
+
+    for key in _LAYOUT_KEYS:
+        out.pop(key, None)
+
+    dtype = np.dtype(out['dtype'])
+    codec = resolve_codec(dtype, codec)
+
+    # Blocks never need to be larger than the raster itself, rounded up to GeoTIFF's multiple of 16
+    largest = max(out['width'], out['height'])
+    blocksize = min(blocksize, 16 * -(-largest // 16))
+
+    out.update(driver='GTiff', tiled=True, blockxsize=blocksize, blockysize=blocksize,
+               compress=codec, interleave='band', bigtiff='IF_SAFER')
+    if codec.startswith('LERC'):
+        out['max_z_error'] = 0  # lossless
+    else:
+        out['predictor'] = 3 if np.issubdtype(dtype, np.floating) else 2
+    if codec in ('ZSTD', 'LERC_ZSTD'):
+        out['zstd_level'] = 9
+    return out
+
+
+def cog_creation_options(dtype, codec='auto', blocksize=512):
+    """
+    The same layout as cog_profile, as a GDAL creation option list (for gdal.Warp/Translate).
+    """
+    if codec is None:
+        return []
+    profile = cog_profile({'dtype': dtype, 'width': blocksize, 'height': blocksize}, codec, blocksize)
+    return [f"{key.upper()}={'YES' if value is True else value}" for key, value in profile.items()
+            if key not in ('dtype', 'width', 'height', 'driver')]
+
+
+def overview_factors(width, height, blocksize=512):
+    """Decimation factors (2, 4, 8, ...) until the smallest overview fits in a single block."""
+    factors = []
+    factor = 2
+    while max(width, height) / factor >= blocksize:
+        factors.append(factor)
+        factor *= 2
+    return factors
+
+
+def add_overviews(dst, codec='auto', resampling=Resampling.nearest):
+    """
+    Builds internal overviews on a dataset opened for writing, just before it is closed.
+
+    Nearest resampling is the default because most pipeline rasters carry labels, alert dates or
+    class codes alongside reflectance. Rasters that fit in a single block get no overviews.
+    """
+    if codec is None:
+        return
+    factors = overview_factors(dst.width, dst.height, dst.block_shapes[0][0])
+    if factors:
+        dst.build_overviews(factors, resampling)
+        dst.update_tags(ns='rio_overview', resampling=resampling.name)
+
+
+def to_cog(src_path, dst_path, codec='auto', blocksize=512):
+    """
+    Copies a raster into a strict Cloud Optimized GeoTIFF (overviews ahead of full resolution data).
+
+    Files written through cog_profile/add_overviews already have the tiling, compression and
+    overviews readers use; this extra copy is only needed when the file must validate as a COG.
+    """
+    with rasterio.open(src_path) as src:
+        dtype = src.dtypes[0]
+    codec = resolve_codec(dtype, codec)
+    options = {'compress': codec, 'blocksize': blocksize, 'overview_resampling': 'NEAREST',
+               'bigtiff': 'IF_SAFER'}
+    if codec.startswith('LERC'):
+        options['max_z_error'] = 0
+    else:
+        options['predictor'] = 'YES'
+    rasterio.shutil.copy(src_path, dst_path, driver='COG', **options)
+    return dst_path
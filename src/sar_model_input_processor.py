@@ -14,6 +14,7 @@ import rasterio
 import numpy as np
 import re
 from datetime import datetime
+from src.band_statistics import global_file_stats, list_files, write_band_scaling
 
 
 class SARLoader:
@@ -24,25 +25,25 @@ class SARLoader:
         self.nodata_value = -9999  # Adjust this as needed
         self.data_type = data_type
 
-    def compute_global_min_max(self, input_folder, bands=[6, 7]):
-        global_min = np.full(len(bands), np.inf)
-        global_max = np.full(len(bands), -np.inf)
-
-        for filename in os.listdir(input_folder):
-            if filename.endswith('_sentinel_agb_normalized_sar_masked.tif') and self.data_type in filename:
-                filepath = os.path.join(input_folder, filename)
-                with rasterio.open(filepath) as src:
-                    for band_idx in bands:
-                        band = src.read(band_idx).astype(np.float32)
-                        valid_mask = band > self.nodata_value  # Assuming self.nodata_value is defined
-                        valid_pixels = band[valid_mask]
-                        if valid_pixels.size > 0:
-                            # Map band 6 to index 0 and band 7 to index 1
-                            index = band_idx - 6
-                            global_min[index] = min(np.min(valid_pixels), global_min[index])
-                            global_max[index] = max(np.max(valid_pixels), global_max[index])
-
-        return global_min, global_max
+    def compute_global_min_max(self, input_folder, bands=[6, 7], workers=None):
+        """
+        Global min and max of the SAR bands over pixels above nodata, for this data_type's
+        *_sentinel_agb_normalized_sar_masked.tif stacks, reduced from the per-file stats sidecars.
+        """
+        files = [f for f in list_files([input_folder], '_sentinel_agb_normalized_sar_masked.tif')
+                 if self.data_type in os.path.basename(f)]
+        stats = global_file_stats(files, bands, rule=('gt', self.nodata_value), workers=workers)
+        return stats['min'], stats['max']
+
+    def write_band_scaling(self, input_folder, scaling_path, bands=[6, 7], workers=None):
+        """
+        Stores the SAR bands' global min/max scaling in a band scaling file (merged with the HLS bands
+        if the file already has them) for normalization at read time, instead of normalize_images_global
+        writing *_masked_normalized.tif copies.
+        """
+        global_min, global_max = self.compute_global_min_max(input_folder, bands, workers)
+        return write_band_scaling(scaling_path, bands, global_min, global_max, self.nodata_value,
+                                  rule=('gt', self.nodata_value))
 
     def normalize_images_global(self, input_file, output_file, global_min, global_max, bands=[6, 7]):
 
@@ -63,33 +64,15 @@ class SARLoader:
         # os.remove(input_path)
         print(f"Normalized and masked file saved as: {output_file}")
 
-    def compute_global_mean_std(self, input_folder, bands=[6, 7]):
-        sum_means = np.zeros(len(bands))
-        sum_variances = np.zeros(len(bands))
-        total_pixels = np.zeros(len(bands))
-
-        for filename in os.listdir(input_folder):
-            if filename.endswith('_normalized.tif') and self.data_type in filename:
-                filepath = os.path.join(input_folder, filename)
-                with rasterio.open(filepath) as src:
-                    for band_idx in bands:
-                        band = src.read(band_idx).astype(np.float32)
-                        valid_mask = band > self.nodata_value
-                        valid_pixels = band[valid_mask]
-
-                        # Map band 6 to index 0 and band 7 to index 1
-                        index = band_idx - 6
-                        sum_means[index] += valid_pixels.mean() * valid_pixels.size
-                        sum_variances[index] += valid_pixels.var() * valid_pixels.size
-                        total_pixels[index] += valid_pixels.size
-
-        # Avoid division by zero for total_pixels
-        total_pixels[total_pixels == 0] = 1
-        global_means = sum_means / total_pixels
-        global_stds = np.sqrt(sum_variances / total_pixels)
-
-        return global_means, global_stds
-
+    def compute_global_mean_std(self, input_folder, bands=[6, 7], workers=None):
+        """
+        Pooled global mean and standard deviation of the SAR bands over pixels above nodata, for this
+        data_type's *_normalized.tif stacks, reduced from the per-file stats sidecars.
+        """
+        files = [f for f in list_files([input_folder], '_normalized.tif')
+                 if self.data_type in os.path.basename(f)]
+        stats = global_file_stats(files, bands, rule=('gt', self.nodata_value), workers=workers)
+        return stats['mean'], stats['std']
 
     def rename_processed_files(self):
         # Define the pattern to match the filenames based on the data type
@@ -21,6 +21,7 @@ from datetime import datetime, timedelta
 import re
 from shapely.ops import transform as shapely_transform
 from rasterio.coords import BoundingBox
+from src.output_profiles import cog_profile, add_overviews
 
 
 class SARProcessing:
@@ -28,18 +29,21 @@ class SARProcessing:
     A class for processing SAR imagery data in preparation for assimilation with Sentinel-2 data.
     """
 
-    def __init__(self, sar_data_path, sen2_stack_path, base_tile_path, output_path,data_type ):
+    def __init__(self, sar_data_path, sen2_stack_path, base_tile_path, output_path,data_type, codec='auto'):
         """
         Args:
             sar_data_path (str): Path to the directory containing SAR data.
             sen2_stack_path (str): Path to the directory containing Sentinel-2 stack data.
             output_path (str): Path to the directory where the processed SAR data will be stored.
+            codec (str or None): Compression for written rasters, see output_profiles.cog_profile.
+                                 None copies source profiles as-is.
         """
         self.sar_data_path = sar_data_path
         self.sen2_stack_path = sen2_stack_path
         self.output_path = output_path
         self.base_tile_path = base_tile_path
         self.data_type = data_type
+        self.codec = codec
         self.vh_dir = os.path.join(base_tile_path, "28m_window", "pol_VH_backscatter_multilook_window_28")
         self.vv_dir = os.path.join(base_tile_path, "28m_window", "pol_VV_backscatter_multilook_window_28")
 
@@ -80,6 +84,7 @@ class SARProcessing:
 
                         profile = vh_src.meta
                         profile.update(count=2)
+                        profile = cog_profile(profile, self.codec)
 
                         # Construct the output filename with the additional details
                         output_filename = f"{identifier}_VV_{additional_details}_{tile_id}.tif"
@@ -92,6 +97,7 @@ class SARProcessing:
                         with rasterio.open(output_path, 'w', **profile) as dst:
                             dst.write(vv_data, 1)
                             dst.write(vh_data, 2)
+                            add_overviews(dst, self.codec)
 
                         print(f"Combined VV-VH {self.data_type} file saved to {output_filename}")
                 else:
@@ -170,6 +176,7 @@ class SARProcessing:
                 'height': height,
                 'nodata': sar_src.nodata  # Preserve the original NoData value
             })
+            out_meta = cog_profile(out_meta, self.codec)
 
             # Perform the reprojection and resampling
             with rasterio.open(output_file_path, 'w', **out_meta) as dst:
@@ -182,6 +189,7 @@ class SARProcessing:
                         dst_transform=transform,
                         dst_crs=sen2_src.crs,
                         resampling=Resampling.nearest)
+                add_overviews(dst, self.codec)
 
         # os.remove(sar_file_path)
             return output_file_path
@@ -199,7 +207,7 @@ class SARProcessing:
             output_file_name = os.path.basename(sen2_file_path).replace('.tif', '_sar.tif')
             output_file_path = os.path.join(self.output_path, output_file_name)
 
-            with rasterio.open(output_file_path, 'w', **sen2_meta) as dest:
+            with rasterio.open(output_file_path, 'w', **cog_profile(sen2_meta, self.codec)) as dest:
                 for i in range(1, 6):
                     dest.write(sen2_dataset.read(i), i)
 
@@ -216,6 +224,7 @@ class SARProcessing:
 
                 for i in range(8, sen2_dataset.count + 1):
                     dest.write(sen2_dataset.read(i), i)
+                add_overviews(dest, self.codec)
 
                 print(f"Replaced Sentinel-2 bands with scaled SAR data at {output_file_name}")
                 return output_file_path
@@ -247,9 +256,11 @@ class SARProcessing:
                 'transform': transform,
                 'count': sar_dataset.count
             })
+            output_profile = cog_profile(output_profile, self.codec)
 
             with rasterio.open(output_file_path, 'w', **output_profile) as dest:
                 dest.write(sar_cropped)
+                add_overviews(dest, self.codec)
 
 
             return output_file_path
@@ -340,10 +351,12 @@ class SARProcessing:
                 'transform': transform,
                 'count' : image_raster.count  #1 ##is 1 for a single band crop
             })
+            output_profile = cog_profile(output_profile, self.codec)
 
             with rasterio.open(output_file_path, 'w', **output_profile) as dest:
                 for band in range(1, image_raster.count + 1):
                     dest.write(image_cropped[band-1], band)
+                add_overviews(dest, self.codec)
                 print(f"written {output_file_name}")
 
             return output_file_path
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""
+Tar shards of model input tiles, as an alternative to one GeoTIFF per 512x512 tile.
+
+Each shard is a plain tar of up to shard_size tiles, stored as consecutive members
+<tile_id>.image.npy, <tile_id>.label.npy and <tile_id>.json (the webdataset layout), so readers
+stream a shard front to back with one open and no per-tile metadata lookups. Every shard has a JSON
+index next to it (tile id, source stack, window, date, alert count, ...), and the writer keeps a
+combined index.json over all shards for filtering and splitting without opening any tar.
+
+@Time    : 17/10/2026
+@Author  : Colm Keyes
+@Email   : keyesco@tcd.ie
+@File    : tile_shards.py
+"""
+
+import io
+import json
+import os
+import tarfile
+
+import numpy as np
+
+INDEX_FILE = 'index.json'
+
+
+def _add_member(tar, name, payload):
+    info = tarfile.TarInfo(name)
+    info.size = len(payload)
+    tar.addfile(info, io.BytesIO(payload))
+
+
+def _npy_bytes(array):
+    buffer = io.BytesIO()
+    np.save(buffer, array, allow_pickle=False)
+    return buffer.getvalue()
+
+
+class ShardWriter:
+    """
+    Writes tiles into <output_folder>/<prefix>-NNNNNN.tar shards of at most shard_size tiles.
+
+    Use as a context manager, or call close() to finish the last shard and write index.json.
+    """
+
+    def __init__(self, output_folder, prefix='tiles', shard_size=1024):
+        self.output_folder = output_folder
+        self.prefix = prefix
+        self.shard_size = shard_size
+        self.index = []
+        self._tar = None
+        self._shard_entries = []
+        self._shard_number = 0
+        os.makedirs(output_folder, exist_ok=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def _shard_name(self):
+        return f"{self.prefix}-{self._shard_number:06d}.tar"
+
+    def _finish_shard(self):
+        if self._tar is None:
+            return
+        self._tar.close()
+        with open(os.path.join(self.output_folder, self._shard_name.replace('.tar', '.json')), 'w') as f:
+            json.dump(self._shard_entries, f)
+        self.index.extend(self._shard_entries)
+        self._tar = None
+        self._shard_entries = []
+        self._shard_number += 1
+
+    def write(self, tile_id, image, label, **meta):
+        """
+        Adds one tile.
+
+        Args:
+            tile_id (str): Unique key, e.g. '<stack name>_<col>_<row>'. Must not contain dots.
+            image (np.ndarray): (band, y, x) model input.
+            label (np.ndarray): (y, x) label.
+            **meta: JSON-serializable tile metadata (source, window, date, alert_count, ...).
+        """
+        if '.' in tile_id:
+            raise ValueError(f"Tile id {tile_id} must not contain dots, they separate the tar member fields")
+        if self._tar is None:
+            self._tar = tarfile.open(os.path.join(self.output_folder, self._shard_name), 'w')
+        entry = dict(tile_id=tile_id, shard=self._shard_name, **meta)
+        _add_member(self._tar, f"{tile_id}.image.npy", _npy_bytes(image))
+        _add_member(self._tar, f"{tile_id}.label.npy", _npy_bytes(label))
+        _add_member(self._tar, f"{tile_id}.json", json.dumps(entry).encode())
+        self._shard_entries.append(entry)
+        if len(self._shard_entries) >= self.shard_size:
+            self._finish_shard()
+
+    def close(self):
+        """Finishes the last shard and writes the combined index."""
+        self._finish_shard()
+        with open(os.path.join(self.output_folder, INDEX_FILE), 'w') as f:
+            json.dump(self.index, f)
+
+
+def load_shard_index(shard_folder):
+    """Combined index of a shard folder: one dict per tile, in shard order."""
+    with open(os.path.join(shard_folder, INDEX_FILE)) as f:
+        return json.load(f)
+
+
+def shard_paths(shard_folder, min_alert_pixels=None):
+    """
+    Shards of a folder in order, optionally only those holding a tile with enough alert pixels.
+    """
+    index = load_shard_index(shard_folder)
+    shards = []
+    for entry in index:
+        if min_alert_pixels is not None and entry.get('alert_count', 0) < min_alert_pixels:
+            continue
+        if entry['shard'] not in shards:
+            shards.append(entry['shard'])
+    return [os.path.join(shard_folder, shard) for shard in shards]
+
+
+def iter_shard_tiles(paths, min_alert_pixels=None):
+    """
+    Streams the tiles of shards in order, reading each tar sequentially.
+
+    Args:
+        paths (list): Shard .tar paths.
+        min_alert_pixels (int, optional): Skip tiles with fewer alert pixels (their arrays are not decoded).
+
+    Yields:
+        tuple: (image, label, meta) per tile.
+    """
+    for path in paths:
+        with tarfile.open(path, 'r|') as tar:
+            tile = {}
+            for member in tar:
+                tile_id, field = member.name.split('.', 1)
+                if tile.get('tile_id') not in (None, tile_id):
+                    tile = {}
+                tile['tile_id'] = tile_id
+                tile[field] = tar.extractfile(member).read()
+                if 'json' in tile and 'image.npy' in tile and 'label.npy' in tile:
+                    meta = json.loads(tile['json'])
+                    if min_alert_pixels is None or meta.get('alert_count', 0) >= min_alert_pixels:
+                        yield (np.load(io.BytesIO(tile['image.npy'])), np.load(io.BytesIO(tile['label.npy'])), meta)
+                    tile = {}